@@ -1,44 +1,27 @@
 # ai_studio_ocr.py
 from typing import List, Optional
-from io import BytesIO
-from PIL import Image
-import math
 
-from google import genai
-from google.genai import types
+import gemini_transport
+import page_packing
+from upload_encoder import encode_for_upload
 
 # Model mặc định: nhanh. Có thể đổi "gemini-2.5-pro" nếu cần độ chính xác cao hơn.
 DEFAULT_VISION_MODEL = "gemini-2.5-flash"
 
-_client = genai.Client()  # Tự lấy GEMINI_API_KEY từ env, theo docs.
-
-def _ensure_rgb_jpeg(image_bytes: bytes, max_side: int = 1800, jpeg_quality: int = 85) -> bytes:
-    """
-    - Đọc ảnh bytes -> PIL -> ép về RGB + nén JPEG
-    - Giới hạn cạnh dài để giữ request <~ vài MB (SDK khuyến nghị inline < 20MB)
-    """
-    im = Image.open(BytesIO(image_bytes))
-    im = im.convert("RGB")
-    w, h = im.size
-    scale = min(1.0, max_side / max(w, h))
-    if scale < 1.0:
-        im = im.resize((math.floor(w * scale), math.floor(h * scale)), Image.LANCZOS)
-    out = BytesIO()
-    im.save(out, format="JPEG", quality=jpeg_quality, optimize=True)
-    return out.getvalue()
-
-def _image_bytes_to_part(image_bytes: bytes, mime: str = "image/jpeg") -> types.Part:
-    return types.Part.from_bytes(data=image_bytes, mime_type=mime)
+def _image_bytes_to_part(image_bytes: bytes, mime: str = "image/jpeg"):
+    return gemini_transport.bytes_part(image_bytes, mime)
 
 def gemini_ocr_image(image_bytes: bytes,
                      prompt: Optional[str] = None,
-                     model: str = DEFAULT_VISION_MODEL) -> str:
+                     model: str = DEFAULT_VISION_MODEL,
+                     client=None) -> str:
     """
     OCR 1 ảnh bằng Gemini.
     prompt: nếu None sẽ dùng mặc định (trích xuất thuần văn bản, giữ dòng).
+    client: client có `models.generate_content` (mặc định: client dùng chung của gemini_transport).
     """
-    # Chuẩn hóa ảnh -> JPEG gọn nhẹ
-    jpeg_bytes = _ensure_rgb_jpeg(image_bytes)
+    # Nén ảnh theo ngân sách byte (JPEG/WebP, xám nếu ảnh không màu)
+    data, mime = encode_for_upload(image_bytes)
 
     user_prompt = prompt or (
         "Extract all readable text from this image in natural reading order. "
@@ -46,27 +29,50 @@ def gemini_ocr_image(image_bytes: bytes,
     )
 
     contents = [
-        _image_bytes_to_part(jpeg_bytes, "image/jpeg"),
+        _image_bytes_to_part(data, mime),
         user_prompt
     ]
 
-    resp = _client.models.generate_content(model=model, contents=contents)
-    return (resp.text or "").strip()
+    resp = gemini_transport.generate_content(contents, model=model, client=client)
+    return gemini_transport.response_text(resp)
 
 def gemini_ocr_images(images: List[bytes],
                       per_page_prompt: Optional[str] = None,
                       joiner: str = "\n\n---\n\n",
-                      model: str = DEFAULT_VISION_MODEL) -> str:
+                      model: str = DEFAULT_VISION_MODEL,
+                      max_inflight: Optional[int] = None,
+                      client=None,
+                      pack_pages: Optional[int] = None) -> str:
     """
     OCR nhiều ảnh (ví dụ các trang PDF đã render).
-    Ghép kết quả lại, có vạch ngăn cách giữa các trang.
+    Các trang được gửi song song (tối đa `max_inflight` request cùng lúc, mặc định GEMINI_MAX_INFLIGHT),
+    kết quả ghép lại đúng thứ tự trang, có vạch ngăn cách giữa các trang.
+    Trang lỗi được ghi chú tại chỗ, không làm hỏng các trang còn lại.
+    pack_pages: gộp tối đa bấy nhiêu trang vào 1 request (None = GEMINI_PACK_PAGES, 1 = mỗi trang 1 request);
+                trang không tách được từ câu trả lời gộp sẽ được gửi lại riêng.
     """
-    results = []
-    for idx, img_bytes in enumerate(images, start=1):
-        text = gemini_ocr_image(
+    def _one(job):
+        idx, img_bytes = job
+        return gemini_ocr_image(
             img_bytes,
             prompt=per_page_prompt or f"Page {idx}: extract text. Keep line breaks.",
-            model=model
+            model=model,
+            client=client
         )
-        results.append(text)
+
+    results = []
+    jobs = enumerate(images, start=1)
+    packed = page_packing.packed_ordered_map(
+        jobs,
+        encode=lambda job: encode_for_upload(job[1]),
+        single=_one,
+        task=per_page_prompt or "Extract all readable text in natural reading order. Keep line breaks. "
+                                "Vietnamese + English. Plain text only.",
+        model=model,
+        client=client,
+        max_pages=pack_pages,
+        max_inflight=max_inflight,
+    )
+    for idx, (text, err) in enumerate(packed, start=1):
+        results.append(text if err is None else f"[Lỗi OCR trang {idx}: {err}]")
     return joiner.join(results).strip()
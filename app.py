@@ -1,7 +1,8 @@
 # app.py — Universal OCR App (final polished version with 2-column layout)
 from io import BytesIO
+import hashlib
 import os
-import tempfile
+import threading
 import streamlit as st
 import audiorecorder
 
@@ -9,8 +10,11 @@ import audiorecorder
 from image_to_text import image_to_text
 from pdf_to_text import pdf_to_text
 from speech_to_text import speech_to_text
+import offline_speech
 from smart_ai_extract import analyze_document_ai
 from scan_to_text import scan_to_text  # bản của bạn (có/không có engine tuỳ phiên bản)
+import tess_pool
+from jobs import JobExecutor, run_callable, run_pdf
 
 # ====== UI layer (từ frontend.py) ======
 from frontend import (
@@ -24,6 +28,35 @@ from frontend import (
 st.set_page_config(page_title="Universal OCR App", page_icon="🧠", layout="wide")
 os.environ["GEMINI_API_KEY"] = os.getenv("GEMINI_API_KEY", "Your API Key Here")
 
+
+@st.cache_resource(show_spinner=False)
+def _warm_tesseract():
+    """Nạp sẵn model Tesseract 1 lần cho cả process (chạy nền, không chặn UI)."""
+    t = threading.Thread(target=tess_pool.warm_up, daemon=True)
+    t.start()
+    return t
+
+
+_warm_tesseract()
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_speech_engine(engine: str):
+    """Nạp sẵn model nhận diện giọng nói offline (1 lần / engine, chạy nền)."""
+    t = threading.Thread(target=offline_speech.warmup, args=(engine,), daemon=True)
+    t.start()
+    return t
+
+
+@st.cache_resource(show_spinner=False)
+def _get_job_executor() -> JobExecutor:
+    """Executor dùng chung cả process: job chạy nền, sống qua các lượt rerun / đổi chế độ."""
+    return JobExecutor()
+
+
+_jobs = _get_job_executor()
+st.session_state.setdefault("jobs", {})  # slot -> job id của phiên này
+
 # Sidebar: Language + Theme
 ui = get_ui_prefs()
 st.session_state.setdefault("ui_lang", ui["lang"])  # tránh xung đột key widget
@@ -31,8 +64,13 @@ inject_theme_css(ui["theme"])
 
 # Sidebar: Engine / Model / Mode
 st.sidebar.subheader("🧠 OCR Engine")
-engine_choice = st.sidebar.radio("Engine", ["Tesseract (Local)", "Google AI Studio (Gemini)"], index=1, key="global_engine")
+_ENGINE_KEYS = {"Auto (Tesseract → Hybrid → Gemini)": "auto", "Tesseract (Local)": "tesseract",
+                "Google AI Studio (Gemini)": "gemini"}
+engine_choice = st.sidebar.radio("Engine", list(_ENGINE_KEYS), index=0, key="global_engine")
 gem_model = st.sidebar.selectbox("🤖 Gemini Model", ["gemini-2.5-flash", "gemini-2.5-pro"], index=0, key="global_model")
+ocr_engine = _ENGINE_KEYS[engine_choice]
+# auto: gem_model được thêm vào chuỗi leo thang (chọn pro = bật bước pro); Gemini: dùng đúng model
+route_model = gem_model if ocr_engine != "tesseract" else None
 
 modes = ["📸 Image", "📄 PDF", "📷 Scan", "🎤 Speech"] if ui["lang"] == "English" else ["📸 Ảnh", "📄 PDF", "📷 Quét", "🎤 Giọng nói"]
 mode = st.sidebar.radio("🧩 " + ("Select Mode" if ui["lang"] == "English" else "Chọn chế độ"), modes, index=0, key="global_mode")
@@ -53,6 +91,63 @@ divider()
 def _is_en() -> bool:
     return ui["lang"] == "English"
 
+
+def _start_job(slot: str, fn, *args, data: bytes = b"", pdf: bool = False, **kwargs) -> None:
+    """Bấm nút -> tạo job nền và trả về ngay. Cùng dữ liệu + cùng thao tác -> dùng lại job cũ (trừ khi job đó lỗi)."""
+    opts = sorted((k, v) for k, v in kwargs.items() if not isinstance(v, (bytes, bytearray)))
+    key = f"{slot}:{hashlib.sha256(data).hexdigest()}:{args[1:] if pdf else ''}:{opts}"
+    if pdf:
+        job_id = _jobs.submit(slot, run_pdf, *args, key=key, **kwargs)
+    else:
+        job_id = _jobs.submit(slot, run_callable, fn, *args, key=key, **kwargs)
+    st.session_state["jobs"][slot] = job_id
+
+
+def _job_panel(slot: str, file_name: str = "result.txt", ai_state_key: str = None, show_text: bool = True) -> None:
+    """
+    Hiển thị trạng thái job của slot: đang chạy -> thanh tiến độ + text từng phần (tự làm mới mỗi giây);
+    xong -> kết quả. ai_state_key: lưu text vào session_state cho phần hậu xử lý.
+    """
+    job = _jobs.get(st.session_state["jobs"].get(slot))
+    if job is None:
+        return
+
+    if job.finished:
+        result = job.result or {}
+        if result.get("success"):
+            if ai_state_key and st.session_state.get(f"{slot}_applied") != job.id:
+                st.session_state[ai_state_key] = result["text"]
+                st.session_state[f"{slot}_applied"] = job.id
+            if show_text:
+                st.text_area("📜 Result" if _is_en() else "📜 Kết quả",
+                             result["text"], height=350, key=f"{slot}_result_{job.id}")
+                st.download_button("💾 TXT", result["text"], file_name=file_name, key=f"{slot}_dl_{job.id}")
+            else:
+                st.success("✅ Done!" if _is_en() else "✅ Hoàn tất!")
+        else:
+            st.error(result.get("message", job.error or "Error"))
+        return
+
+    @st.fragment(run_every=1.0)
+    def _poll():
+        j = _jobs.get(job.id)
+        if j is None or j.finished:
+            st.rerun()  # chạy lại cả trang để hiện kết quả cuối + phần hậu xử lý
+            return
+        if j.total:
+            label = (f"Page {len(j.pages)}/{j.total}" if _is_en() else f"Trang {len(j.pages)}/{j.total}")
+        else:
+            label = "⏳ Processing..." if _is_en() else "⏳ Đang xử lý..."
+        st.progress(j.progress(), text=label)
+        partial = j.partial_text()
+        if partial.strip():
+            st.text_area("📜 Partial result" if _is_en() else "📜 Kết quả từng phần",
+                         partial, height=350, disabled=True)
+        if st.button("⛔ Cancel" if _is_en() else "⛔ Huỷ", key=f"{slot}_cancel_{j.id}"):
+            j.cancel()
+
+    _poll()
+
 # ====== KÍCH HOẠT ANIMATION CHUYỂN TRANG ======
 begin_route_transition(mode)
 transition_container_start()
@@ -78,53 +173,43 @@ if mode in ["📸 Image", "📸 Ảnh"]:
             st.subheader("📄 Text Extraction" if _is_en() else "📄 Nhận diện văn bản")
             c1, c2 = st.columns(2)
             with c1:
-                run_tess = st.button("🧠 Tesseract OCR", key="img_btn_tess")
+                run_tess = st.button(f"🧠 OCR ({engine_choice.split(' (')[0]})", key="img_btn_tess")
             with c2:
                 run_ai = st.button("🤖 Gemini AI Analysis", key="img_btn_ai")
 
-            # Tesseract branch
+            # Tesseract branch (job nền)
             if run_tess:
-                with st.spinner("🔍 Extracting..." if _is_en() else "🔍 Đang nhận diện..."):
-                    tmp_path = "temp_image.png"
-                    with open(tmp_path, "wb") as f:
-                        f.write(img_bytes)
-                    result = image_to_text(tmp_path)
-                    if result.get("success"):
-                        st.text_area("📜 Result" if _is_en() else "📜 Kết quả",
-                                     result["text"], height=350, key="img_tess_result")
-                        st.download_button("💾 TXT", result["text"], file_name="ocr_image.txt", key="img_tess_dl")
-                    else:
-                        st.error(result.get("message", "Error"))
-
-            # Gemini branch
-            if run_ai:
-                with st.spinner("🔮 Analyzing with Gemini..." if _is_en() else "🔮 Đang phân tích bằng Gemini..."):
-                    ai_result = analyze_document_ai(img_bytes, file_type="image")
-                    if ai_result.get("success"):
-                        st.session_state["img_ai_text"] = ai_result["text"]
-                        st.success("✅ Done!" if _is_en() else "✅ Hoàn tất!")
-                    else:
-                        st.error(ai_result.get("message", "AI error"))
-
-        # Hậu xử lý/phân loại (Image)
-        if "img_ai_text" in st.session_state:
-            divider("Post-processing" if _is_en() else "Hậu xử lý")
-            extract_mode = st.radio(
-                "🧠 Select extraction mode:" if _is_en() else "🧠 Chọn cách trích xuất:",
-                ["📄 Full Text", "✅ Manual Field Selection"] if _is_en() else ["📄 Lấy toàn bộ văn bản", "✅ Chọn thủ công các trường"],
-                horizontal=True,
-                key="img_extract_mode"
-            )
+                _start_job("img_tess", image_to_text, img_bytes, data=img_bytes, engine=ocr_engine, model=route_model)
+            _job_panel("img_tess", file_name="ocr_image.txt")
 
-            lines = [ln.strip() for ln in st.session_state["img_ai_text"].split("\n") if ln.strip()]
-            if extract_mode.startswith("📄") or extract_mode.startswith("Full"):
-                filtered_text = "\n".join(lines)
-            else:
-                filtered_text, _ = manual_kv_selector_ui(st.session_state["img_ai_text"], ui["lang"], session_prefix="img")
+            # Gemini branch (job nền)
+            if run_ai:
+                _start_job("img_ai", analyze_document_ai, img_bytes, data=img_bytes, file_type="image")
+            _job_panel("img_ai", ai_state_key="img_ai_text", show_text=False)
+    else:
+        # Chưa có file (vd: vừa đổi chế độ) -> vẫn hiện job đang chạy/đã xong của phiên
+        _job_panel("img_tess", file_name="ocr_image.txt")
+        _job_panel("img_ai", ai_state_key="img_ai_text", show_text=False)
+
+    # Hậu xử lý/phân loại (Image)
+    if "img_ai_text" in st.session_state:
+        divider("Post-processing" if _is_en() else "Hậu xử lý")
+        extract_mode = st.radio(
+            "🧠 Select extraction mode:" if _is_en() else "🧠 Chọn cách trích xuất:",
+            ["📄 Full Text", "✅ Manual Field Selection"] if _is_en() else ["📄 Lấy toàn bộ văn bản", "✅ Chọn thủ công các trường"],
+            horizontal=True,
+            key="img_extract_mode"
+        )
+
+        lines = [ln.strip() for ln in st.session_state["img_ai_text"].split("\n") if ln.strip()]
+        if extract_mode.startswith("📄") or extract_mode.startswith("Full"):
+            filtered_text = "\n".join(lines)
+        else:
+            filtered_text, _ = manual_kv_selector_ui(st.session_state["img_ai_text"], ui["lang"], session_prefix="img")
 
-            st.text_area("📜 Processed Result" if _is_en() else "📜 Kết quả sau xử lý",
-                         filtered_text, height=350, key="img_processed")
-            download_block(filtered_text, "ai_result", "img_dl")
+        st.text_area("📜 Processed Result" if _is_en() else "📜 Kết quả sau xử lý",
+                     filtered_text, height=350, key="img_processed")
+        download_block(filtered_text, "ai_result", "img_dl")
 
 # =============================== PDF MODE ===============================
 elif mode in ["📄 PDF"]:
@@ -146,58 +231,44 @@ elif mode in ["📄 PDF"]:
             st.subheader("⚙️ Process PDF" if _is_en() else "⚙️ Xử lý PDF")
             c1, c2 = st.columns(2)
             with c1:
-                run_tess = st.button("🧠 OCR PDF (Tesseract)", key="pdf_btn_tess")
+                # PDF chưa đi qua router: Auto -> Tesseract từng trang (trang có text layer thì dùng luôn)
+                pdf_engine = "gemini" if ocr_engine == "gemini" else "tesseract"
+                run_tess = st.button(f"🧠 OCR PDF ({pdf_engine.title()})", key="pdf_btn_tess")
             with c2:
                 run_ai = st.button("🤖 Gemini AI (PDF)", key="pdf_btn_ai")
 
-            # Tesseract OCR for PDF: ghi file tạm
+            # Tesseract OCR for PDF: job nền, tiến độ + text theo từng trang
             if run_tess:
-                with st.spinner("📄 Processing PDF..." if _is_en() else "📄 Đang xử lý PDF..."):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-                        tmp_pdf.write(pdf_bytes)
-                        tmp_pdf_path = tmp_pdf.name
-                    result = pdf_to_text(tmp_pdf_path, engine="tesseract")
-                    try:
-                        os.remove(tmp_pdf_path)
-                    except Exception:
-                        pass
-
-                    if result.get("success"):
-                        st.text_area("📜 Result" if _is_en() else "📜 Kết quả",
-                                     result["text"], height=350, key="pdf_tess_result")
-                        st.download_button("💾 TXT", result["text"], file_name="pdf_result.txt", key="pdf_tess_dl")
-                    else:
-                        st.error(result.get("message", "Error"))
-
-            # Gemini AI for PDF: dùng bytes trực tiếp
-            if run_ai:
-                with st.spinner("🔮 Analyzing PDF with Gemini..." if _is_en() else "🔮 Đang phân tích PDF bằng Gemini..."):
-                    ai_result = analyze_document_ai(pdf_bytes, file_type="pdf")
-                    if ai_result.get("success"):
-                        st.session_state["pdf_ai_text"] = ai_result["text"]
-                        st.success("✅ Done!" if _is_en() else "✅ Hoàn tất!")
-                    else:
-                        st.error(ai_result.get("message", "AI error"))
-
-        # Hậu xử lý/phân loại (PDF)
-        if "pdf_ai_text" in st.session_state:
-            divider("Post-processing" if _is_en() else "Hậu xử lý")
-            extract_mode = st.radio(
-                "🧠 Select extraction mode:" if _is_en() else "🧠 Chọn cách trích xuất:",
-                ["📄 Full Text", "✅ Manual Field Selection"] if _is_en() else ["📄 Lấy toàn bộ văn bản", "✅ Chọn thủ công các trường"],
-                horizontal=True,
-                key="pdf_extract_mode"
-            )
+                _start_job("pdf_tess", None, pdf_bytes, pdf_engine, gem_model, data=pdf_bytes, pdf=True)
+            _job_panel("pdf_tess", file_name="pdf_result.txt")
 
-            lines = [ln.strip() for ln in st.session_state["pdf_ai_text"].split("\n") if ln.strip()]
-            if extract_mode.startswith("📄") or extract_mode.startswith("Full"):
-                filtered_text = "\n".join(lines)
-            else:
-                filtered_text, _ = manual_kv_selector_ui(st.session_state["pdf_ai_text"], ui["lang"], session_prefix="pdf")
+            # Gemini AI for PDF: dùng bytes trực tiếp (job nền)
+            if run_ai:
+                _start_job("pdf_ai", analyze_document_ai, pdf_bytes, data=pdf_bytes, file_type="pdf")
+            _job_panel("pdf_ai", ai_state_key="pdf_ai_text", show_text=False)
+    else:
+        _job_panel("pdf_tess", file_name="pdf_result.txt")
+        _job_panel("pdf_ai", ai_state_key="pdf_ai_text", show_text=False)
+
+    # Hậu xử lý/phân loại (PDF)
+    if "pdf_ai_text" in st.session_state:
+        divider("Post-processing" if _is_en() else "Hậu xử lý")
+        extract_mode = st.radio(
+            "🧠 Select extraction mode:" if _is_en() else "🧠 Chọn cách trích xuất:",
+            ["📄 Full Text", "✅ Manual Field Selection"] if _is_en() else ["📄 Lấy toàn bộ văn bản", "✅ Chọn thủ công các trường"],
+            horizontal=True,
+            key="pdf_extract_mode"
+        )
+
+        lines = [ln.strip() for ln in st.session_state["pdf_ai_text"].split("\n") if ln.strip()]
+        if extract_mode.startswith("📄") or extract_mode.startswith("Full"):
+            filtered_text = "\n".join(lines)
+        else:
+            filtered_text, _ = manual_kv_selector_ui(st.session_state["pdf_ai_text"], ui["lang"], session_prefix="pdf")
 
-            st.text_area("📜 Processed Result" if _is_en() else "📜 Kết quả sau xử lý",
-                         filtered_text, height=350, key="pdf_processed")
-            download_block(filtered_text, "ai_pdf_result", "pdf_dl")
+        st.text_area("📜 Processed Result" if _is_en() else "📜 Kết quả sau xử lý",
+                     filtered_text, height=350, key="pdf_processed")
+        download_block(filtered_text, "ai_pdf_result", "pdf_dl")
 
 # =============================== SCAN MODE ===============================
 elif mode in ["📷 Scan", "📷 Quét"]:
@@ -206,7 +277,9 @@ elif mode in ["📷 Scan", "📷 Quét"]:
             icon="📷")
 
     # Một số bạn đã nâng cấp scan_to_text(engine="gemini"); ta gọi an toàn:
-    scan_engine = st.radio("🧠 Engine", ["Gemini", "Tesseract"], horizontal=True, index=0, key="scan_engine")
+    scan_engines = {"Auto": "auto", "Gemini": "gemini", "Tesseract": "tesseract"}
+    scan_engine = st.radio("🧠 Engine", list(scan_engines), horizontal=True,
+                           index=list(scan_engines.values()).index(ocr_engine), key="scan_engine")
     cam = st.camera_input("📸 Take a photo" if _is_en() else "📸 Chụp ảnh", key="scan_cam")
 
     if cam:
@@ -222,10 +295,9 @@ elif mode in ["📷 Scan", "📷 Quét"]:
 
             # Gọi linh hoạt tuỳ phiên bản scan_to_text (có/không có engine)
             try:
-                if scan_engine == "Gemini":
-                    result = scan_to_text(img_bytes, lang=ui["lang"], engine="gemini", gem_model=gem_model)
-                else:
-                    result = scan_to_text(img_bytes, lang=ui["lang"], engine="tesseract")
+                scan_key = scan_engines[scan_engine]
+                result = scan_to_text(img_bytes, lang=ui["lang"], engine=scan_key,
+                                      gem_model=gem_model if scan_key != "tesseract" else None)
             except TypeError:
                 # Fall back: phiên bản cũ chỉ nhận (image_bytes, lang)
                 result = scan_to_text(img_bytes, lang=ui["lang"])
@@ -233,6 +305,8 @@ elif mode in ["📷 Scan", "📷 Quét"]:
             if result.get("success"):
                 st.text_area("📜 Result" if _is_en() else "📜 Kết quả",
                              result["text"], height=350, key="scan_result")
+                if result.get("route"):
+                    st.caption(" → ".join(f"{r['engine']} ({r['outcome']})" for r in result["route"]))
                 st.download_button("💾 TXT", result["text"], file_name="scan_result.txt", key="scan_dl")
             else:
                 st.error(result.get("message", "Scan error"))
@@ -249,6 +323,16 @@ elif mode in ["🎤 Speech", "🎤 Giọng nói"]:
          "📁 Upload file" if _is_en() else "📁 Tải file âm thanh"],
         key="sp_mode"
     )
+    speech_engines = {"Google (online)": "google", "Vosk (offline)": "vosk", "Whisper (offline)": "whisper"}
+    sp_engine = speech_engines[st.radio("🧠 Engine", list(speech_engines), horizontal=True, index=0,
+                                        key="sp_engine")]
+    if sp_engine != "google":
+        if not offline_speech.available()[sp_engine]:
+            st.warning(f"{sp_engine}: not installed or no local model configured (VOSK_MODEL_VI / VOSK_MODEL_EN)."
+                       if _is_en() else
+                       f"{sp_engine}: chưa cài hoặc chưa cấu hình model có sẵn (VOSK_MODEL_VI / VOSK_MODEL_EN).")
+        else:
+            _warm_speech_engine(sp_engine)
     left, right = two_columns(1.2, 1.0)
 
     with left:
@@ -260,17 +344,14 @@ elif mode in ["🎤 Speech", "🎤 Giọng nói"]:
             )
             if len(audio) > 0:
                 buf = BytesIO()
-                audio.export(buf, format="wav")
+                # xuất thẳng 16 kHz mono 16-bit -> speech_to_text dùng nguyên, không giải mã lại
+                audio.set_channels(1).set_frame_rate(16000).set_sample_width(2).export(buf, format="wav")
                 wav_bytes = buf.getvalue()
                 st.audio(wav_bytes, format="audio/wav")
                 if st.button("🧠 Transcribe" if _is_en() else "🧠 Nhận diện", key="sp_btn_recognize"):
-                    result = speech_to_text(audio_bytes=wav_bytes, lang=ui["lang"])
-                    if result.get("success"):
-                        st.text_area("📜 Result" if _is_en() else "📜 Kết quả",
-                                     result["text"], height=350, key="sp_text_res")
-                        st.download_button("💾 TXT", result["text"], file_name="speech_result.txt", key="sp_txt_dl")
-                    else:
-                        st.error(result.get("message", "Speech error"))
+                    _start_job("sp_rec", speech_to_text, data=wav_bytes, audio_bytes=wav_bytes, lang=ui["lang"],
+                               engine=sp_engine)
+            _job_panel("sp_rec", file_name="speech_result.txt")
         else:
             up = st.file_uploader("📁 Upload audio" if _is_en() else "📁 Chọn file âm thanh",
                                   type=["wav", "mp3", "m4a", "aac", "ogg", "flac"],
@@ -278,13 +359,10 @@ elif mode in ["🎤 Speech", "🎤 Giọng nói"]:
             if up:
                 st.audio(up)
                 if st.button("🧠 Recognize file" if _is_en() else "🧠 Nhận diện file", key="sp_btn_file"):
-                    result = speech_to_text(uploaded_file=up, lang=ui["lang"])
-                    if result.get("success"):
-                        st.text_area("📜 Result" if _is_en() else "📜 Kết quả",
-                                     result["text"], height=350, key="sp_file_res")
-                        st.download_button("💾 TXT", result["text"], file_name="audio_result.txt", key="sp_file_dl")
-                    else:
-                        st.error(result.get("message", "Speech error"))
+                    file_bytes = up.getvalue()
+                    _start_job("sp_file", speech_to_text, data=file_bytes, audio_bytes=file_bytes, lang=ui["lang"],
+                               engine=sp_engine)
+            _job_panel("sp_file", file_name="audio_result.txt")
 
     with right:
         tip = "Upload or record audio to convert speech to text." if _is_en() else "Ghi âm hoặc tải file giọng nói để nhận diện."
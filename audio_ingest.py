@@ -0,0 +1,162 @@
+# audio_ingest.py — Giải mã âm thanh đúng 1 lần về PCM 16 kHz / mono / 16-bit (định dạng recognizer cần)
+# - Nguồn: bytes hoặc file object nhị phân (file upload, file trên đĩa) — file object được đọc dần từng khối
+#   đẩy vào ffmpeg, không đọc hết vào RAM trước
+# - WAV đã đúng 16 kHz / mono / 16-bit -> dùng nguyên, không giải mã lại
+# - Còn lại: stream qua ffmpeg (stdin -> stdout theo từng khối), ffmpeg resample + downmix ngay khi giải mã
+#   thay vì AudioSegment.from_file (giải mã cả file ở tần số / số kênh gốc rồi mới chuyển)
+# - PCM ra được gom thẳng vào 1 bytearray và trả nguyên (không copy thêm sang bytes)
+# - Container MP4/M4A cần seek (moov thường nằm cuối file) -> ghi ra file tạm rồi cho ffmpeg đọc
+# - Không có ffmpeg -> pydub (chỉ đọc được WAV)
+from io import BytesIO
+from typing import BinaryIO, Optional, Union
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import wave
+
+import metrics
+
+RATE = 16000
+CHANNELS = 1
+SAMPLE_WIDTH = 2
+BYTES_PER_MS = RATE * CHANNELS * SAMPLE_WIDTH // 1000
+
+_BLOCK = 1 << 20
+_FFMPEG = os.getenv("FFMPEG_BINARY") or shutil.which("ffmpeg")
+
+# bytes / bytearray / memoryview, hoặc file object nhị phân seek được (vd: file upload)
+Source = Union[bytes, bytearray, memoryview, BinaryIO]
+
+
+def _is_buffer(src: Source) -> bool:
+    return isinstance(src, (bytes, bytearray, memoryview))
+
+
+def _peek(src: Source, n: int) -> bytes:
+    """n byte đầu của nguồn, không làm đổi vị trí đọc của file object."""
+    if _is_buffer(src):
+        return bytes(src[:n])
+    pos = src.tell()
+    head = src.read(n)
+    src.seek(pos)
+    return head
+
+
+def _open_target(src: Source) -> Optional[wave.Wave_read]:
+    """Reader nếu nguồn là WAV 16 kHz / mono / 16-bit (chỉ đọc header), ngược lại None (vị trí đọc giữ nguyên)."""
+    head = _peek(src, 12)
+    if head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+    pos = None if _is_buffer(src) else src.tell()
+    try:
+        w = wave.open(BytesIO(src) if pos is None else src)
+    except (wave.Error, EOFError):
+        w = None
+    if w is not None and (w.getnchannels(), w.getframerate(), w.getsampwidth(), w.getcomptype()) != \
+            (CHANNELS, RATE, SAMPLE_WIDTH, "NONE"):
+        w.close()
+        w = None
+    if w is None and pos is not None:
+        src.seek(pos)
+    return w
+
+
+def pcm_to_wav(pcm) -> bytes:
+    """Bọc PCM 16 kHz / mono / 16-bit thành file WAV (chỉ thêm header, không resample)."""
+    buf = BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(CHANNELS)
+        w.setsampwidth(SAMPLE_WIDTH)
+        w.setframerate(RATE)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+
+def _ffmpeg_pcm(src: Source) -> bytearray:
+    seekable = _peek(src, 8)[4:8] == b"ftyp"  # MP4 / M4A / MOV
+    tmp = None
+    if seekable:
+        fd, tmp = tempfile.mkstemp(suffix=".m4a")
+        with os.fdopen(fd, "wb") as f:
+            if _is_buffer(src):
+                f.write(src)
+            else:
+                shutil.copyfileobj(src, f, _BLOCK)
+    cmd = [_FFMPEG, "-hide_banner", "-loglevel", "error", "-i", tmp or "pipe:0", "-vn",
+           "-ac", str(CHANNELS), "-ar", str(RATE), "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"]
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL if tmp else subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        errors = []
+
+        def _feed():
+            try:
+                if _is_buffer(src):
+                    view = memoryview(src)
+                    for i in range(0, len(view), _BLOCK):
+                        proc.stdin.write(view[i:i + _BLOCK])
+                else:
+                    for block in iter(lambda: src.read(_BLOCK), b""):
+                        proc.stdin.write(block)
+            except (BrokenPipeError, OSError):
+                pass  # ffmpeg đã dừng (lỗi định dạng) -> lý do nằm ở stderr
+            finally:
+                proc.stdin.close()
+
+        def _drain_stderr():
+            errors.append(proc.stderr.read())
+
+        threads = [threading.Thread(target=_drain_stderr, daemon=True)]
+        if not tmp:
+            threads.append(threading.Thread(target=_feed, daemon=True))
+        for t in threads:
+            t.start()
+        out = bytearray()
+        for block in iter(lambda: proc.stdout.read(_BLOCK), b""):
+            out += block
+        rc = proc.wait()
+        for t in threads:
+            t.join()
+        if rc != 0:
+            msg = (errors[0] if errors else b"").decode("utf-8", "ignore").strip()
+            raise RuntimeError(f"ffmpeg không giải mã được âm thanh: {msg[-300:] or rc}")
+        return out
+    finally:
+        if tmp:
+            os.unlink(tmp)
+
+
+def decode_pcm(src: Source) -> Union[bytes, bytearray]:
+    """
+    Âm thanh bất kỳ (bytes hoặc file object) -> PCM thô s16le 16 kHz mono. Giải mã đúng 1 lần.
+    Đường ffmpeg trả bytearray (không copy sang bytes); file object được đọc dần, không nạp hết trước.
+    """
+    with metrics.span("speech.decode"):
+        w = _open_target(src)
+        if w is not None:
+            metrics.incr("speech_ingest_total", mode="passthrough")
+            with w:
+                return w.readframes(w.getnframes())
+        if _FFMPEG:
+            metrics.incr("speech_ingest_total", mode="ffmpeg")
+            return _ffmpeg_pcm(src)
+        from pydub import AudioSegment
+        metrics.incr("speech_ingest_total", mode="pydub")
+        seg = AudioSegment.from_file(BytesIO(src) if _is_buffer(src) else src)
+        return seg.set_channels(CHANNELS).set_frame_rate(RATE).set_sample_width(SAMPLE_WIDTH).raw_data
+
+
+def to_wav(src: Source) -> bytes:
+    """Âm thanh bất kỳ -> WAV 16 kHz mono 16-bit; đã đúng định dạng thì trả nguyên nội dung."""
+    pos = None if _is_buffer(src) else src.tell()
+    w = _open_target(src)
+    if w is not None:
+        w.close()
+        metrics.incr("speech_ingest_total", mode="passthrough")
+        if pos is None:
+            return bytes(src)
+        src.seek(pos)
+        return src.read()
+    return pcm_to_wav(decode_pcm(src))
@@ -0,0 +1,181 @@
+# batch_ocr.py — Chạy OCR hàng loạt không cần giao diện (không import Streamlit)
+#
+# Ví dụ:
+#   python batch_ocr.py ./scans --out results.jsonl --workers 8
+#   python batch_ocr.py "data/**/*.pdf" --engine gemini --workers 4
+#   python batch_ocr.py ./camera --image-mode scan --engine tesseract
+#
+# Mỗi file xong sẽ được ghi ngay 1 dòng JSON vào --out; chạy lại sẽ bỏ qua các file đã xong.
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Set
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp"}
+PDF_EXTS = {".pdf"}
+
+
+def _collect_inputs(patterns: Iterable[str], recursive: bool) -> List[str]:
+    files = []
+    for pat in patterns:
+        if os.path.isdir(pat):
+            if recursive:
+                for root, _, names in os.walk(pat):
+                    files += [os.path.join(root, n) for n in names]
+            else:
+                files += [os.path.join(pat, n) for n in os.listdir(pat)]
+        else:
+            files += glob.glob(pat, recursive=True)
+    exts = IMAGE_EXTS | PDF_EXTS
+    return sorted({os.path.abspath(f) for f in files
+                   if os.path.isfile(f) and os.path.splitext(f)[1].lower() in exts})
+
+
+def _fingerprint(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_size}:{int(st.st_mtime)}"
+
+
+def _load_done(out_path: str, retry_failed: bool) -> Set[tuple]:
+    """Đọc file kết quả cũ -> tập (path, fingerprint) đã xử lý xong."""
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # dòng ghi dở khi lần trước bị dừng giữa chừng
+            if retry_failed and not rec.get("success"):
+                continue
+            done.add((rec.get("path"), rec.get("fingerprint")))
+    return done
+
+
+def _init_worker(threads: int) -> None:
+    """
+    Chạy 1 lần trong mỗi worker process, trước khi import pipeline OCR: chia CPU giữa các process
+    (mặc định layout / tess_pool mỗi process dùng cpu_count thread -> ~cores² thread khi chạy nhiều process).
+    """
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")  # Tesseract không tự mở thêm thread OpenMP
+    for name in ("OCR_LAYOUT_WORKERS", "TESS_POOL_SIZE"):
+        current = int(os.environ.get(name) or threads)
+        os.environ[name] = str(max(1, min(current, threads)))
+
+
+def _process_file(path: str, engine: str, image_mode: str, lang: str, model: str) -> Dict:
+    """Chạy trong worker process: chọn pipeline theo loại file."""
+    t0 = time.perf_counter()
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext in PDF_EXTS:
+            from pdf_to_text import pdf_to_text
+            # Song song ở cấp file rồi -> mỗi PDF chạy tuần tự trong worker
+            result = pdf_to_text(path, engine=engine, model=model, workers=1)
+        elif image_mode == "scan":
+            from scan_to_text import scan_to_text
+            with open(path, "rb") as f:
+                result = scan_to_text(f.read(), lang=lang, engine=engine, gem_model=model)
+        else:
+            from image_to_text import image_to_text
+            result = image_to_text(path, engine=engine, model=model)
+    except Exception as e:
+        result = {"success": False, "message": f"Lỗi: {e}"}
+    result = dict(result)
+    result["seconds"] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+def _fmt_eta(seconds: float) -> str:
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h:d}:{m:02d}:{s:02d}"
+
+
+def run_batch(inputs: List[str], out_path: str, workers: int = 1, engine: str = "tesseract",
+              image_mode: str = "image", lang: str = "Tiếng Việt", model: str = "gemini-2.5-flash",
+              retry_failed: bool = False, quiet: bool = False) -> Dict:
+    done = _load_done(out_path, retry_failed)
+    # fingerprint lấy 1 lần trước khi chạy: file bị sửa / xoá giữa chừng không làm hỏng cả lượt
+    # và không ghi nhận fingerprint của nội dung chưa được OCR
+    prints = {}
+    for p in inputs:
+        try:
+            prints[p] = _fingerprint(p)
+        except OSError:
+            continue
+    todo = [p for p in prints if (p, prints[p]) not in done]
+    skipped = len(inputs) - len(todo)
+    if not quiet:
+        print(f"🗂️  {len(inputs)} file, bỏ qua {skipped} file đã xong, cần xử lý {len(todo)}.", file=sys.stderr)
+
+    stats = {"total": len(todo), "skipped": skipped, "ok": 0, "failed": 0, "pages": 0}
+    t0 = time.perf_counter()
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+    workers = max(1, workers)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with open(out_path, "a", encoding="utf-8") as out, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        futures = {pool.submit(_process_file, p, engine, image_mode, lang, model): p for p in todo}
+        for n, fut in enumerate(as_completed(futures), start=1):
+            path = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as e:  # worker chết (OOM, ...)
+                result = {"success": False, "message": f"Worker lỗi: {e}"}
+            rec = {"path": path, "fingerprint": prints[path], **result}
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+
+            stats["ok" if result.get("success") else "failed"] += 1
+            stats["pages"] += result.get("text", "").count("--- Trang ") or (1 if result.get("success") else 0)
+            if not quiet:
+                elapsed = time.perf_counter() - t0
+                rate = n / elapsed if elapsed else 0.0
+                eta = (len(todo) - n) / rate if rate else 0.0
+                status = "✅" if result.get("success") else "❌"
+                print(f"[{n}/{len(todo)}] {status} {os.path.basename(path)} "
+                      f"({result.get('seconds', 0):.1f}s) · {rate:.2f} file/s · ETA {_fmt_eta(eta)}",
+                      file=sys.stderr)
+
+    stats["seconds"] = round(time.perf_counter() - t0, 3)
+    stats["files_per_sec"] = round(stats["total"] / stats["seconds"], 3) if stats["seconds"] else 0.0
+    stats["pages_per_sec"] = round(stats["pages"] / stats["seconds"], 3) if stats["seconds"] else 0.0
+    return stats
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="OCR hàng loạt ảnh/PDF -> JSONL (không cần Streamlit).")
+    ap.add_argument("inputs", nargs="+", help="Thư mục hoặc glob (vd: 'scans/**/*.pdf').")
+    ap.add_argument("--out", default="ocr_results.jsonl", help="File JSONL kết quả (ghi nối tiếp).")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Số process chạy song song.")
+    ap.add_argument("--engine", choices=["tesseract", "gemini"], default="tesseract",
+                    help="Engine cho mọi loại file (PDF, ảnh, scan).")
+    ap.add_argument("--image-mode", choices=["image", "scan"], default="image",
+                    help="Ảnh: 'image' = image_to_text, 'scan' = scan_to_text.")
+    ap.add_argument("--lang", default="Tiếng Việt", help="Ngôn ngữ cho scan_to_text (English / Tiếng Việt).")
+    ap.add_argument("--model", default="gemini-2.5-flash", help="Model Gemini.")
+    ap.add_argument("--recursive", action="store_true", help="Duyệt thư mục con.")
+    ap.add_argument("--retry-failed", action="store_true", help="Chạy lại các file lỗi ở lần trước.")
+    ap.add_argument("--quiet", action="store_true", help="Không in tiến độ.")
+    args = ap.parse_args(argv)
+
+    inputs = _collect_inputs(args.inputs, args.recursive)
+    if not inputs:
+        print("⚠️ Không tìm thấy file ảnh/PDF nào.", file=sys.stderr)
+        return 1
+    stats = run_batch(inputs, args.out, workers=args.workers, engine=args.engine,
+                      image_mode=args.image_mode, lang=args.lang, model=args.model,
+                      retry_failed=args.retry_failed, quiet=args.quiet)
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0 if stats["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,414 @@
+# bench_ocr.py — Benchmark offline cho các pipeline OCR (không cần mạng, không cần Streamlit)
+#
+# Ví dụ:
+#   python bench_ocr.py --out bench_results.json
+#   python bench_ocr.py --only pdf --repeat 5 --baseline bench_results.json
+#
+# - Tài liệu thử được sinh bằng PIL: nhiều cỡ chữ, nghiêng, nhiễu, đảo màu, PDF nhiều trang.
+# - Đo throughput, p50/p95 latency, RSS đỉnh cho image_to_text, scan_to_text (tesseract),
+#   pdf_to_text, speech_to_text và các đường Gemini (client / recognizer giả lập chạy local, có độ trễ nhân tạo).
+# - Kết quả lưu JSON; truyền --baseline để so sánh với lần chạy trước.
+import os
+
+# Tắt cache để mỗi lần lặp đều chạy thật
+os.environ["OCR_CACHE"] = "0"
+
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+try:
+    import psutil
+    _proc = psutil.Process()
+except Exception:
+    psutil = None
+    _proc = None
+
+_SAMPLE_LINES = [
+    "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM",
+    "Độc lập - Tự do - Hạnh phúc",
+    "HỢP ĐỒNG MUA BÁN HÀNG HÓA Số: 2025/HĐMB",
+    "Invoice No. INV-000123   Date: 18/10/2025",
+    "Bên A: Công ty TNHH Thương mại Dịch vụ ABC",
+    "Total amount due: 12,500,000 VND (mười hai triệu năm trăm nghìn đồng)",
+    "The quick brown fox jumps over the lazy dog 0123456789",
+    "Điều 1. Nội dung hợp đồng và giá trị thanh toán",
+]
+
+
+# ============================ Sinh dữ liệu thử ============================
+def _font(size: int):
+    for name in ("DejaVuSans.ttf", "arial.ttf", "Arial.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except Exception:
+            continue
+    return ImageFont.load_default(size=size)
+
+
+def make_document(font_size: int = 28, skew: float = 0.0, noise: float = 0.0, invert: bool = False,
+                  size=(1654, 2339), seed: int = 0) -> Image.Image:
+    """Trang A4 (~200 DPI) với các dòng chữ Việt/Anh."""
+    rng = random.Random(seed)
+    img = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(img)
+    font = _font(font_size)
+    y = 120
+    while y < size[1] - 120:
+        draw.text((110, y), rng.choice(_SAMPLE_LINES), fill=0, font=font)
+        y += int(font_size * 1.8)
+    if skew:
+        img = img.rotate(skew, resample=Image.BICUBIC, expand=False, fillcolor=255)
+    if noise:
+        arr = np.asarray(img, dtype=np.int16)
+        arr = arr + np.random.default_rng(seed).normal(0, noise * 255, arr.shape).astype(np.int16)
+        img = Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).filter(ImageFilter.SMOOTH)
+    if invert:
+        img = Image.fromarray(255 - np.asarray(img))
+    return img.convert("RGB")
+
+
+def make_columns(font_size: int = 20, size=(1654, 2339), seed: int = 0) -> Image.Image:
+    """Trang 2 cột + tiêu đề + các đoạn cách nhau (form dày) — thử tách bố cục / thứ tự đọc."""
+    rng = random.Random(seed)
+    img = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(img)
+    font = _font(font_size)
+    draw.text((110, 80), _SAMPLE_LINES[2], fill=0, font=_font(font_size + 10))
+    col_w = (size[0] - 220 - 80) // 2
+    for x0 in (110, 110 + col_w + 80):
+        y = 200
+        while y < size[1] - 120:
+            for _ in range(rng.randint(3, 6)):  # 1 đoạn
+                line = rng.choice(_SAMPLE_LINES)
+                while line and draw.textlength(line, font=font) > col_w:
+                    line = line[:-1]
+                draw.text((x0, y), line, fill=0, font=font)
+                y += int(font_size * 1.5)
+            y += font_size * 2
+    return img.convert("RGB")
+
+
+def _png_bytes(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def make_pdf(pages: int = 5, font_size: int = 24) -> bytes:
+    imgs = [make_document(font_size=font_size, seed=i) for i in range(pages)]
+    buf = BytesIO()
+    imgs[0].save(buf, format="PDF", save_all=True, append_images=imgs[1:], resolution=200)
+    return buf.getvalue()
+
+
+IMAGE_VARIANTS = {
+    "clean_28px": dict(font_size=28),
+    "small_16px": dict(font_size=16),
+    "skew_4deg": dict(font_size=28, skew=4.0),
+    "noisy": dict(font_size=28, noise=0.12),
+    "inverted": dict(font_size=28, invert=True),
+}
+
+
+# ============================ Gemini giả lập ============================
+class StubGeminiClient:
+    """
+    Client giả có `models.generate_content(...)` với độ trễ nhân tạo — không gọi mạng.
+    Độ trễ = latency (mỗi request) + per_image (mỗi ảnh). Request gộp nhiều trang (có nhãn <<<PAGE k>>>)
+    được trả lời đúng định dạng nhãn; drop_marker_rate > 0 để thử đường tách lỗi -> gửi lại từng trang.
+    """
+
+    def __init__(self, latency: float = 0.3, text: str = "\n".join(_SAMPLE_LINES),
+                 per_image: float = 0.05, drop_marker_rate: float = 0.0):
+        self.latency, self.text, self.per_image = latency, text, per_image
+        self.drop_marker_rate = drop_marker_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self.models = self
+
+    def generate_content(self, *args, contents=None, **kwargs):
+        contents = contents if contents is not None else (args[0] if args else [])
+        labels = [c for c in contents if isinstance(c, str) and c.startswith("<<<PAGE ")]
+        n_images = len(labels) or 1
+        with self._lock:
+            self.calls += 1
+            drop = labels and self._rng.random() < self.drop_marker_rate
+        time.sleep(self.latency + self.per_image * n_images)
+        if not labels:
+            return SimpleNamespace(text=self.text, candidates=[])
+        parts = [f"{label}\n{self.text}" for label in labels]
+        if drop:
+            parts.pop(self._rng.randrange(len(parts)))
+        return SimpleNamespace(text="\n".join(parts), candidates=[])
+
+
+def install_gemini_stub(latency: float, **kwargs) -> StubGeminiClient:
+    """Gắn client giả vào gemini_transport (mọi module gọi Gemini qua đó)."""
+    stub = StubGeminiClient(latency, **kwargs)
+    import gemini_transport
+    gemini_transport.set_client(stub)
+    return stub
+
+
+# ============================ Âm thanh + recognizer giả lập ============================
+def make_speech(seconds: int = 60, burst_ms: int = 2500, pause_ms: int = 600) -> bytes:
+    """WAV thử: các đoạn 'nói' (tiếng beep 440Hz) xen quãng nghỉ, có lặng ở đầu và cuối."""
+    from pydub import AudioSegment
+    from pydub.generators import Sine
+
+    burst = Sine(440).to_audio_segment(duration=burst_ms, volume=-12)
+    seg = AudioSegment.silent(duration=1500, frame_rate=16000)
+    while len(seg) < seconds * 1000:
+        seg += burst + AudioSegment.silent(duration=pause_ms, frame_rate=16000)
+    seg += AudioSegment.silent(duration=1500, frame_rate=16000)
+    buf = BytesIO()
+    seg.set_channels(1).set_frame_rate(16000).export(buf, format="wav")
+    return buf.getvalue()
+
+
+class StubRecognizer:
+    """
+    Recognizer giả cho speech_to_text(recognizer=...): không gọi mạng.
+    Độ trễ = latency + per_second * số giây âm thanh; trả "đoạn k (x.xs)" để kiểm tra thứ tự khi ghép.
+    """
+
+    def __init__(self, latency: float = 0.3, per_second: float = 0.05):
+        self.latency, self.per_second = latency, per_second
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, wav_bytes: bytes, language: str) -> str:
+        import wave
+        with wave.open(BytesIO(wav_bytes)) as w:
+            dur = w.getnframes() / float(w.getframerate())
+        with self._lock:
+            self.calls += 1
+            k = self.calls
+        time.sleep(self.latency + self.per_second * dur)
+        return f"đoạn {k} ({dur:.1f}s)"
+
+
+# ============================ Đo đạc ============================
+def _rss() -> int:
+    if _proc is not None:
+        return _proc.memory_info().rss
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return 0
+
+
+class _PeakRSS:
+    """Lấy mẫu RSS trong nền để bắt giá trị đỉnh trong lúc chạy 1 case."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval, self.peak = interval, 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start = self.peak = _rss()
+        self._t = threading.Thread(target=self._run, daemon=True)
+        self._t.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss())
+            self._stop.wait(self.interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._t.join()
+        self.peak = max(self.peak, _rss())
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    vals = sorted(values)
+    k = (len(vals) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(vals) - 1)
+    return vals[lo] + (vals[hi] - vals[lo]) * (k - lo)
+
+
+def measure(fn: Callable[[], Dict], repeat: int, units: int = 1, warmup: int = 1) -> Dict:
+    for _ in range(warmup):
+        fn()
+    latencies, ok = [], 0
+    with _PeakRSS() as mem:
+        t_all = time.perf_counter()
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            res = fn()
+            latencies.append(time.perf_counter() - t0)
+            ok += bool(res and res.get("success", True))
+        total = time.perf_counter() - t_all
+    return {
+        "runs": repeat,
+        "success_rate": round(ok / repeat, 3) if repeat else 0.0,
+        "units_per_run": units,
+        "throughput_per_s": round(units * repeat / total, 3) if total else 0.0,
+        "p50_s": round(_percentile(latencies, 0.50), 4),
+        "p95_s": round(_percentile(latencies, 0.95), 4),
+        "mean_s": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        "peak_rss_mb": round(mem.peak / 2 ** 20, 1),
+        "rss_growth_mb": round((mem.peak - mem.start) / 2 ** 20, 1),
+    }
+
+
+# ============================ Các case ============================
+def build_cases(pages: int, pdf_workers: int) -> Dict[str, Callable[[], Dict]]:
+    from image_to_text import image_to_text
+    from scan_to_text import scan_to_text
+    from pdf_to_text import pdf_to_text
+    import ai_studio_ocr
+
+    cases = {}
+    images = {name: _png_bytes(make_document(**kw)) for name, kw in IMAGE_VARIANTS.items()}
+    for name, data in images.items():
+        cases[f"image_to_text/{name}"] = (lambda d=data: image_to_text(d), 1)
+        cases[f"scan_to_text.tesseract/{name}"] = (
+            lambda d=data: scan_to_text(d, lang="Tiếng Việt", engine="tesseract"), 1)
+    # Tách bố cục + OCR song song từng khối vs OCR cả trang 1 lượt (trang 2 cột)
+    import layout
+    cols = _png_bytes(make_columns())
+
+    def _cols(enabled):
+        layout.ENABLED = enabled
+        try:
+            return image_to_text(cols, engine="tesseract")
+        finally:
+            layout.ENABLED = True
+    cases["image_to_text.tesseract/two_column_layout"] = (lambda: _cols(True), 1)
+    cases["image_to_text.tesseract/two_column_whole_page"] = (lambda: _cols(False), 1)
+
+    # Chỉ gửi vùng Tesseract đọc kém vs gửi cả ảnh (so byte upload trong report "gemini_upload")
+    for name in ("noisy", "small_16px"):
+        cases[f"image_to_text.hybrid_stub/{name}"] = (lambda d=images[name]: image_to_text(d, engine="hybrid"), 1)
+        cases[f"image_to_text.gemini_stub/{name}"] = (lambda d=images[name]: image_to_text(d, engine="gemini"), 1)
+    cases["scan_to_text.gemini_stub/clean_28px"] = (
+        lambda d=images["clean_28px"]: scan_to_text(d, engine="gemini"), 1)
+
+    pdf = make_pdf(pages)
+    cases[f"pdf_to_text.tesseract/{pages}p_w1"] = (lambda: pdf_to_text(pdf, engine="tesseract", workers=1), pages)
+    if pdf_workers > 1:
+        cases[f"pdf_to_text.tesseract/{pages}p_w{pdf_workers}"] = (
+            lambda: pdf_to_text(pdf, engine="tesseract", workers=pdf_workers), pages)
+    cases[f"pdf_to_text.gemini_stub/{pages}p"] = (lambda: pdf_to_text(pdf, engine="gemini", pack_pages=1), pages)
+    cases[f"pdf_to_text.gemini_stub/{pages}p_pack4"] = (
+        lambda: pdf_to_text(pdf, engine="gemini", pack_pages=4), pages)
+
+    # Tiền xử lý riêng (không Tesseract), 1 thread và 4 thread cùng lúc -> thấy rõ chi phí cấp phát / tranh chấp
+    from concurrent.futures import ThreadPoolExecutor
+    import image_to_text as _img_mod
+    import scan_to_text as _scan_mod
+    gray_docs = [np.asarray(make_document(**kw).convert("L")) for kw in IMAGE_VARIANTS.values()]
+    for label, pipe in (("image", _img_mod._PIPELINE), ("scan", _scan_mod._PIPELINE)):
+        cases[f"preprocess.{label}/t1"] = (lambda p=pipe: [p.run(g) for g in gray_docs] and {"success": True},
+                                           len(gray_docs))
+
+        def _concurrent(p=pipe, threads=4):
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(lambda g: p.run(g).shape, gray_docs * threads))
+            return {"success": True}
+        cases[f"preprocess.{label}/t4"] = (_concurrent, len(gray_docs) * 4)
+
+    from speech_to_text import speech_to_text
+    audio = make_speech(60)
+    rec = StubRecognizer(latency=0.3)
+    for label, chunked in (("single", False), ("chunked", True)):
+        cases[f"speech_to_text.stub/60s_{label}"] = (
+            lambda c=chunked: speech_to_text(audio, chunked=c, recognizer=rec), 1)
+    # Engine offline thật (nếu đã cài): âm thanh thử chỉ là tiếng beep, chủ yếu để đo RTF
+    import offline_speech
+    for engine, ok in offline_speech.available().items():
+        if ok:
+            cases[f"speech_to_text.{engine}/60s_chunked"] = (
+                lambda e=engine: speech_to_text(audio, engine=e, chunked=True), 1)
+
+    page_imgs = [images["clean_28px"]] * pages
+    for k in (1, 4):
+        cases[f"gemini_ocr_images_stub/{pages}p_pack{k}"] = (
+            lambda k=k: {"success": bool(ai_studio_ocr.gemini_ocr_images(page_imgs, pack_pages=k))}, pages)
+    return cases
+
+
+def compare(current: Dict, baseline: Dict) -> List[str]:
+    rows = []
+    for name, cur in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            rows.append(f"{name:<50} (mới)")
+            continue
+
+        def _pct(key):
+            b = base.get(key) or 0.0
+            return (cur[key] - b) / b * 100 if b else 0.0
+        rows.append(f"{name:<50} p50 {_pct('p50_s'):+6.1f}%  p95 {_pct('p95_s'):+6.1f}%  "
+                    f"thr {_pct('throughput_per_s'):+6.1f}%  rss {_pct('peak_rss_mb'):+6.1f}%")
+    return rows
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark offline các pipeline OCR.")
+    ap.add_argument("--out", default="bench_results.json", help="File JSON kết quả.")
+    ap.add_argument("--baseline", help="File JSON của lần chạy trước để so sánh.")
+    ap.add_argument("--repeat", type=int, default=3, help="Số lần đo mỗi case.")
+    ap.add_argument("--pages", type=int, default=5, help="Số trang PDF thử.")
+    ap.add_argument("--pdf-workers", type=int, default=os.cpu_count() or 1, help="Số worker cho case PDF song song.")
+    ap.add_argument("--gemini-latency", type=float, default=0.3, help="Độ trễ giả lập mỗi request Gemini (giây).")
+    ap.add_argument("--gemini-drop-marker", type=float, default=0.0,
+                    help="Tỉ lệ request gộp trang bị thiếu nhãn (thử đường gửi lại từng trang).")
+    ap.add_argument("--only", default="", help="Chỉ chạy case có chứa chuỗi này.")
+    args = ap.parse_args(argv)
+
+    # Đọc baseline trước khi chạy: --out và --baseline có thể là cùng 1 file (so với lần chạy trước rồi ghi đè)
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    install_gemini_stub(args.gemini_latency, drop_marker_rate=args.gemini_drop_marker)
+    cases = build_cases(args.pages, args.pdf_workers)
+    results = {}
+    for name, (fn, units) in cases.items():
+        if args.only and args.only not in name:
+            continue
+        results[name] = measure(fn, args.repeat, units=units)
+        r = results[name]
+        print(f"{name:<50} p50={r['p50_s']:.3f}s p95={r['p95_s']:.3f}s "
+              f"thr={r['throughput_per_s']:.2f}/s rss={r['peak_rss_mb']:.0f}MB", file=sys.stderr)
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(), "repeat": args.repeat,
+                 "pages": args.pages, "gemini_latency_s": args.gemini_latency},
+        "results": results,
+    }
+    import upload_encoder
+    report["gemini_upload"] = upload_encoder.stats()
+    import offline_speech
+    report["offline_speech"] = offline_speech.stats()
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if baseline is not None:
+        print("\n".join(compare(report, baseline)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+# concurrent_pages.py — chạy song song theo trang, giữ đúng thứ tự, giới hạn số request đang bay
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+import os
+
+import metrics
+
+# Số request Gemini tối đa đang chờ cùng lúc (mỗi trang 1 request)
+DEFAULT_MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_INFLIGHT", "4"))
+
+
+def ordered_map(fn: Callable[[Any], Any],
+                items: Iterable[Any],
+                max_inflight: Optional[int] = None) -> Iterator[Tuple[Any, Optional[Exception]]]:
+    """
+    Gọi fn(item) trên thread pool (phù hợp việc chờ mạng), yield (kết quả, lỗi) theo đúng thứ tự items.
+    - Chỉ có tối đa `max_inflight` lời gọi chạy cùng lúc; items được lấy dần nên có thể là generator.
+    - Lỗi của 1 item được trả về trong tuple, không làm mất kết quả các item khác.
+    """
+    n = DEFAULT_MAX_INFLIGHT if max_inflight is None else max_inflight
+    n = max(1, n)
+    fn = metrics.bind_context(fn)
+    if n == 1:
+        for item in items:
+            try:
+                yield fn(item), None
+            except Exception as e:
+                yield None, e
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        try:
+            for item in items:
+                pending.append(pool.submit(fn, item))
+                del item
+                if len(pending) >= n:
+                    yield _result(pending.popleft())
+            while pending:
+                yield _result(pending.popleft())
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+
+def _result(fut) -> Tuple[Any, Optional[Exception]]:
+    try:
+        return fut.result(), None
+    except Exception as e:
+        return None, e
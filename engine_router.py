@@ -0,0 +1,240 @@
+# engine_router.py — Chọn engine OCR theo chi phí / độ trễ, leo thang khi kết quả không đạt
+# - Registry engine: tesseract (local, chi phí 0), hybrid (Tesseract + Gemini chỉ cho vùng đọc kém, xem
+#   region_fallback), các model Gemini cả trang (flash rẻ, pro đắt)
+# - Policy (có thể thêm bằng register_policy) sắp xếp thứ tự thử:
+#     fixed    : đúng thứ tự người dùng chọn (vd: engine/model ở sidebar)
+#     cascade  : rẻ nhất trước: tesseract -> hybrid -> gemini-2.5-flash
+#                (gemini-2.5-pro chỉ khi bật: OCR_ROUTER_CHAIN hoặc chọn model pro)
+#     adaptive : theo chi phí kỳ vọng từ thống kê gần đây (độ trễ p50, tỉ lệ thành công)
+# - route() chạy lần lượt, dừng ở engine đầu tiên qua kiểm tra chất lượng; engine Gemini bị bỏ qua khi
+#   transport đang tạm ngưng (circuit breaker). Gemini trả rỗng (ảnh không có chữ) -> dừng, không leo thang.
+#   Mỗi quyết định được log kèm lý do (logger "ocr.router").
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import logging
+import os
+import threading
+import time
+
+import gemini_transport
+from gemini_transport import GeminiUnavailable
+import metrics
+
+log = logging.getLogger("ocr.router")
+
+DEFAULT_POLICY = os.getenv("OCR_ROUTER_POLICY", "cascade")
+_GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+DEFAULT_CHAIN = [e for e in os.getenv("OCR_ROUTER_CHAIN", f"tesseract,hybrid,{_GEMINI_MODEL}").split(",") if e]
+MIN_TEXT_RATIO = float(os.getenv("OCR_ROUTER_MIN_TEXT_RATIO", "0.55"))
+
+# adaptive: chi phí kỳ vọng = (cost + LATENCY_WEIGHT * p50 giây) / tỉ lệ thành công
+_WINDOW = int(os.getenv("OCR_ROUTER_WINDOW", "50"))
+_LATENCY_WEIGHT = float(os.getenv("OCR_ROUTER_LATENCY_WEIGHT", "0.5"))
+_MIN_SAMPLES = 5
+
+
+class NoText(RuntimeError):
+    """Engine trả lời bình thường nhưng không thấy chữ nào -> kết quả cuối, model khác cũng không đọc thêm được."""
+
+
+def gemini_text(resp) -> str:
+    """
+    Text của response Gemini cho router. Rỗng mà model dừng bình thường (STOP) -> NoText (ảnh không có chữ);
+    rỗng vì bị chặn / cắt ngang (SAFETY, RECITATION, MAX_TOKENS...) -> lỗi thường để router leo thang / dự phòng.
+    """
+    text = gemini_transport.response_text(resp)
+    if text:
+        return text
+    reason = gemini_transport.finish_reason(resp)
+    if reason == "STOP":
+        raise NoText("Gemini trả rỗng (finish_reason=STOP).")
+    raise RuntimeError(f"Gemini không trả text: finish_reason={reason}")
+
+
+class Engine(NamedTuple):
+    name: str
+    kind: str               # "tesseract" | "hybrid" | "gemini"
+    cost: float             # chi phí tương đối cho 1 trang
+    model: Optional[str] = None
+
+
+ENGINES: Dict[str, Engine] = {}
+_NEEDS_GEMINI = {"gemini", "hybrid"}
+
+
+def register_engine(name: str, kind: str, cost: float, model: Optional[str] = None) -> None:
+    ENGINES[name] = Engine(name, kind, cost, model)
+
+
+register_engine("tesseract", "tesseract", 0.0)
+register_engine("hybrid", "hybrid", 0.3, _GEMINI_MODEL)
+register_engine("gemini-2.5-flash", "gemini", 1.0, "gemini-2.5-flash")
+register_engine("gemini-2.5-pro", "gemini", 10.0, "gemini-2.5-pro")
+
+
+def get_engine(name: str) -> Engine:
+    eng = ENGINES.get(name)
+    if eng is None:
+        if not name.startswith("gemini"):
+            raise ValueError(f"Engine không hỗ trợ: {name}")
+        # model Gemini chưa khai báo -> ước lượng chi phí theo tên
+        eng = Engine(name, "gemini", 10.0 if "pro" in name else 1.0, name)
+    return eng
+
+
+# ----------------- Thống kê trượt (độ trễ, thành công) -----------------
+_stats_lock = threading.Lock()
+_history: Dict[str, Deque[Tuple[float, bool]]] = {}
+_decisions: Deque[Dict[str, Any]] = deque(maxlen=200)
+
+
+def _observe(name: str, latency: float, ok: bool) -> None:
+    with _stats_lock:
+        _history.setdefault(name, deque(maxlen=_WINDOW)).append((latency, ok))
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    """Theo engine: n (số mẫu trong cửa sổ), success_rate, p50_s."""
+    with _stats_lock:
+        snap = {k: list(v) for k, v in _history.items()}
+    out = {}
+    for name, items in snap.items():
+        lat = sorted(t for t, _ in items)
+        out[name] = {"n": len(items), "success_rate": round(sum(ok for _, ok in items) / len(items), 3),
+                     "p50_s": round(lat[len(lat) // 2], 3)}
+    return out
+
+
+def recent_decisions() -> List[Dict[str, Any]]:
+    return list(_decisions)
+
+
+# ----------------- Policy: (engines, stats) -> [(engine, lý do)] theo thứ tự thử -----------------
+Policy = Callable[[List[Engine], Dict[str, Dict[str, float]]], List[Tuple[Engine, str]]]
+
+
+def _fixed(engines, _stats):
+    return [(e, "fixed: thứ tự chỉ định") for e in engines]
+
+
+def _cascade(engines, _stats):
+    return [(e, f"cascade: cost={e.cost:g}") for e in sorted(engines, key=lambda e: e.cost)]
+
+
+def _adaptive(engines, st):
+    def _expected(e):
+        s = st.get(e.name)
+        if not s or s["n"] < _MIN_SAMPLES:
+            return e.cost, f"adaptive: cost={e.cost:g}, chưa đủ mẫu"
+        score = (e.cost + _LATENCY_WEIGHT * s["p50_s"]) / max(0.05, s["success_rate"])
+        return score, (f"adaptive: expected={score:.2f} (cost={e.cost:g}, p50={s['p50_s']}s, "
+                       f"success={s['success_rate']:.0%}, n={s['n']})")
+    scored = [(e,) + _expected(e) for e in engines]
+    return [(e, reason) for e, _, reason in sorted(scored, key=lambda x: x[1])]
+
+
+POLICIES: Dict[str, Policy] = {"fixed": _fixed, "cascade": _cascade, "adaptive": _adaptive}
+
+
+def register_policy(name: str, policy: Policy) -> None:
+    POLICIES[name] = policy
+
+
+def _text_ratio(s: str) -> float:
+    if not s:
+        return 0.0
+    return sum(ch.isalnum() or ch.isspace() for ch in s) / max(1, len(s))
+
+
+def good_text(text: str, min_ratio: float = MIN_TEXT_RATIO) -> bool:
+    """Kiểm tra chất lượng mặc định: có chữ và đủ tỉ lệ ký tự hợp lệ."""
+    return bool(text and text.strip()) and _text_ratio(text) >= min_ratio
+
+
+def resolve(engine: str = "auto", model: Optional[str] = None,
+            policy: Optional[str] = None) -> Tuple[List[str], str]:
+    """
+    Lựa chọn kiểu giao diện -> (danh sách engine, policy):
+      auto      -> DEFAULT_CHAIN theo policy (mặc định OCR_ROUTER_POLICY); model ngoài chuỗi (vd: pro) được thêm vào
+      tesseract -> chỉ Tesseract
+      gemini    -> model đã chọn, Tesseract dự phòng khi Gemini lỗi / tạm ngưng
+    """
+    engine = (engine or "auto").lower()
+    if engine == "auto":
+        chain = list(DEFAULT_CHAIN)
+        if model and model not in chain:
+            chain.insert(1, model)
+        return chain, policy or DEFAULT_POLICY
+    if engine == "tesseract":
+        return ["tesseract"], "fixed"
+    if engine == "gemini":
+        return [model or _GEMINI_MODEL, "tesseract"], "fixed"
+    return [engine], "fixed"
+
+
+def _decide(pipeline: str, engine: str, outcome: str, reason: str, latency: float = 0.0) -> Dict[str, Any]:
+    step = {"engine": engine, "outcome": outcome, "reason": reason, "seconds": round(latency, 3)}
+    _decisions.append(dict(step, pipeline=pipeline, ts=time.time()))
+    metrics.incr("router_decisions_total", engine=engine, outcome=outcome)
+    log.info("%s: %s -> %s (%s, %.2fs)", pipeline, engine, outcome, reason, latency)
+    return step
+
+
+def route(run: Callable[[Engine], str], engines: Optional[Sequence[str]] = None, policy: Optional[str] = None,
+          accept: Callable[[str], bool] = good_text, pipeline: str = "ocr") -> Dict[str, Any]:
+    """
+    Thử engine theo thứ tự của policy; run(engine) -> text. Dừng ở kết quả đầu tiên qua accept(text).
+    Không engine nào đạt -> trả kết quả tốt nhất đã có ("low_quality"; thêm "degraded" nếu có engine bị
+    bỏ qua / lỗi do Gemini tạm ngưng). result["route"] ghi từng bước + lý do.
+    run ném NoText (Gemini dừng bình thường mà không thấy chữ, xem gemini_text) -> dừng luôn;
+    chưa có text nào thì trả lỗi kèm "no_text". Text rỗng thường (vd bị chặn) -> leo thang như mọi kết quả kém.
+    """
+    policy = policy or DEFAULT_POLICY
+    if policy not in POLICIES:
+        raise ValueError(f"Policy không hỗ trợ: {policy}")
+    candidates = [get_engine(n) for n in (engines or DEFAULT_CHAIN)]
+    plan = POLICIES[policy](candidates, stats())
+
+    steps, best, last_err, unavailable = [], None, None, False
+    for i, (eng, reason) in enumerate(plan):
+        if i:
+            reason = f"escalate sau {steps[-1]['engine']} ({steps[-1]['outcome']}); {reason}"
+        if eng.kind in _NEEDS_GEMINI and not gemini_transport.is_available():
+            unavailable = True
+            steps.append(_decide(pipeline, eng.name, "skipped", f"{reason}; Gemini đang tạm ngưng"))
+            continue
+        t0 = time.perf_counter()
+        empty = False
+        try:
+            text = run(eng) or ""
+            err = None
+        except NoText:
+            text, err, empty = "", None, True
+        except Exception as e:
+            text, err = "", e
+            last_err = e
+            unavailable |= isinstance(e, GeminiUnavailable)
+        latency = time.perf_counter() - t0
+        if empty:
+            _observe(eng.name, latency, True)
+            steps.append(_decide(pipeline, eng.name, "empty", f"{reason}; không có chữ -> dừng", latency))
+            break
+        ok = err is None and accept(text)
+        _observe(eng.name, latency, ok)
+        outcome = "accepted" if ok else ("error" if err is not None else "rejected")
+        steps.append(_decide(pipeline, eng.name, outcome, reason if err is None else f"{reason}; {err}", latency))
+        if ok:
+            return {"success": True, "text": text, "engine": eng.name, "route": steps}
+        if text.strip() and (best is None or _text_ratio(text) > _text_ratio(best[1])):
+            best = (eng.name, text)
+
+    if best is not None:
+        result = {"success": True, "text": best[1], "engine": best[0], "route": steps, "low_quality": True}
+        if unavailable:
+            result["degraded"] = True
+        return result
+    if steps and steps[-1]["outcome"] == "empty":
+        return {"success": False, "message": "Không nhận diện được văn bản trong ảnh.", "route": steps,
+                "no_text": True}
+    msg = f"{last_err}" if last_err is not None else "Không engine nào nhận diện được văn bản."
+    return {"success": False, "message": msg, "route": steps}
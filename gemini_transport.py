@@ -0,0 +1,229 @@
+# gemini_transport.py — Lớp gọi Gemini dùng chung cho mọi module
+# - 1 client (google-genai) cho cả process -> tái sử dụng kết nối HTTP
+# - Retry lỗi tạm thời (429/5xx/timeout) với exponential backoff + jitter
+# - Timeout cho từng request
+# - Circuit breaker: API đang lỗi liên tục -> báo GeminiUnavailable ngay để caller chuyển sang Tesseract
+# - GEMINI_BASE_URL trỏ tới server giả lập local để test; set_client() để gắn client giả
+from typing import Any, List, Optional
+import os
+import random
+import threading
+import time
+
+import metrics
+
+try:
+    from google import genai
+    from google.genai import types as gem_types
+    _sdk_available = True
+except Exception:
+    genai = None
+    gem_types = None
+    _sdk_available = False
+
+DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+TIMEOUT_S = float(os.getenv("GEMINI_TIMEOUT_S", "60"))
+MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+BACKOFF_BASE_S = float(os.getenv("GEMINI_BACKOFF_BASE_S", "0.5"))
+BACKOFF_MAX_S = float(os.getenv("GEMINI_BACKOFF_MAX_S", "8"))
+BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("GEMINI_BREAKER_COOLDOWN_S", "30"))
+
+_RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class GeminiUnavailable(RuntimeError):
+    """Gemini không dùng được lúc này (thiếu SDK, circuit breaker đang mở, lỗi tạm thời đã hết lượt retry)."""
+
+
+# ----------------- Client dùng chung -----------------
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            if not _sdk_available:
+                raise GeminiUnavailable("google-genai chưa được cài. Chạy: pip install -U google-genai")
+            opts = {"timeout": int(TIMEOUT_S * 1000)}
+            if os.getenv("GEMINI_BASE_URL"):
+                opts["base_url"] = os.getenv("GEMINI_BASE_URL")
+            _client = genai.Client(http_options=gem_types.HttpOptions(**opts))
+        return _client
+
+
+def set_client(client) -> None:
+    """Gắn client khác (vd: client giả có `models.generate_content`) cho cả process."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def is_available() -> bool:
+    return (_sdk_available or _client is not None) and _breaker.allow(peek=True)
+
+
+# ----------------- Circuit breaker -----------------
+class CircuitBreaker:
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN_S):
+        self.threshold, self.cooldown = threshold, cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self, peek: bool = False) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            # half-open: chỉ cho 1 request thăm dò
+            if self._probing:
+                return False
+            if not peek:
+                self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None or self._probing:
+                    metrics.incr("gemini_breaker_open_total")
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return "open"
+            return "half_open"
+
+
+_breaker = CircuitBreaker()
+
+
+def breaker_state() -> str:
+    return _breaker.state()
+
+
+# ----------------- Helpers -----------------
+def _status_code(err: Exception) -> Optional[int]:
+    for attr in ("code", "status_code"):
+        v = getattr(err, attr, None)
+        if isinstance(v, int):
+            return v
+    resp = getattr(err, "response", None)
+    v = getattr(resp, "status_code", None)
+    return v if isinstance(v, int) else None
+
+
+def _is_transient(err: Exception) -> bool:
+    code = _status_code(err)
+    if code is not None:
+        return code in _RETRYABLE_CODES
+    name = type(err).__name__.lower()
+    return isinstance(err, (TimeoutError, ConnectionError)) or "timeout" in name or "connect" in name
+
+
+def _backoff(attempt: int) -> float:
+    # full jitter: ngẫu nhiên trong [0, min(max, base * 2^attempt)]
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** attempt)))
+
+
+def bytes_part(data: bytes, mime_type: str = "image/jpeg"):
+    if gem_types is None:
+        # client giả không cần Part thật
+        return {"mime_type": mime_type, "data": data}
+    return gem_types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+def guess_mime(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:5] == b"%PDF-":
+        return "application/pdf"
+    return "image/png"
+
+
+def response_text(resp) -> str:
+    """Lấy text từ response (ưu tiên .text, không có thì ghép các part trong candidates)."""
+    try:
+        if getattr(resp, "text", None):
+            return resp.text.strip()
+        if getattr(resp, "candidates", None):
+            for c in resp.candidates:
+                if getattr(c, "content", None) and getattr(c.content, "parts", None):
+                    chunks = []
+                    for p in c.content.parts:
+                        t = getattr(p, "text", None)
+                        if t:
+                            chunks.append(t)
+                    if chunks:
+                        return "\n".join(chunks).strip()
+        return ""
+    except Exception:
+        return ""
+
+
+def finish_reason(resp) -> Optional[str]:
+    """Lý do dừng của candidate đầu tiên ("STOP", "SAFETY", "RECITATION", "MAX_TOKENS"...); không có -> None."""
+    try:
+        reason = getattr(resp.candidates[0], "finish_reason", None)
+    except (AttributeError, IndexError, TypeError):
+        return None
+    if reason is None:
+        return None
+    if isinstance(reason, int) and not hasattr(reason, "name"):
+        return "STOP" if reason == 1 else str(reason)  # SDK cũ trả số (1 = STOP)
+    return str(getattr(reason, "name", reason)).rsplit(".", 1)[-1].upper()
+
+
+# ----------------- Public API -----------------
+def generate_content(contents: List[Any], model: Optional[str] = None, client=None,
+                     max_retries: int = MAX_RETRIES):
+    """
+    Gọi models.generate_content qua client dùng chung, có retry + circuit breaker.
+    Lỗi không tạm thời (400, 403, safety...) được ném lại ngay, không retry.
+    """
+    # lấy client trước allow(): allow() ở trạng thái half-open giữ lượt thăm dò, lỗi ở đây sẽ khoá breaker mãi
+    cli = client or get_client()
+    if not _breaker.allow():
+        metrics.incr("gemini_requests_total", status="short_circuit")
+        raise GeminiUnavailable("Gemini đang tạm ngưng (circuit breaker mở) — dùng Tesseract.")
+    model = model or DEFAULT_MODEL
+    attempt = 0
+    while True:
+        try:
+            with metrics.span("gemini.request"):
+                resp = cli.models.generate_content(model=model, contents=contents)
+            _breaker.record_success()
+            metrics.incr("gemini_requests_total", status="ok", model=model)
+            return resp
+        except Exception as e:
+            if not _is_transient(e):
+                _breaker.record_success()  # API vẫn sống, lỗi do request
+                metrics.incr("gemini_requests_total", status="error", model=model)
+                raise
+            if attempt >= max_retries:
+                _breaker.record_failure()
+                metrics.incr("gemini_requests_total", status="transient_error", model=model)
+                raise GeminiUnavailable(f"Gemini lỗi tạm thời sau {attempt + 1} lần thử: {e}") from e
+            metrics.incr("gemini_retries_total", model=model)
+            time.sleep(_backoff(attempt))
+            attempt += 1
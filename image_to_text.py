@@ -1,28 +1,34 @@
-from PIL import Image
-import pytesseract
+from PIL import Image, ImageOps
+import tess_pool
+import preprocess
+import upload_encoder
 import cv2
 import numpy as np
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
 import os
 
 # ⚙️ Đặt API key Google AI Studio tại đây (đừng public)
 os.environ["GEMINI_API_KEY"] = "Your API Key Here"
 
+from ocr_cache import cached_result, prompt_hash
+import engine_router
+import layout
+import metrics
+import region_fallback
+
+# Tăng khi thay đổi tiền xử lý/pipeline để cache cũ không còn khớp
+PREPROCESS_VERSION = "5"
+
 # Kích hoạt cấu hình tesseract_cmd từ config.py (Windows)
 try:
     import config  # noqa
 except Exception:
     pass
 
-# ============ Gemini ============
-try:
-    from google import genai
-    from google.genai import types as gem_types
-    _gemini_available = True
-    _gem_client = genai.Client()
-except Exception:
-    _gemini_available = False
-    _gem_client = None
+# ============ Gemini (qua lớp transport dùng chung) ============
+import gemini_transport
 
 
 def _text_ratio(s: str) -> float:
@@ -32,109 +38,221 @@ def _text_ratio(s: str) -> float:
     return valid / max(1, len(s))
 
 
-def _preprocess_for_ocr(image_path: str) -> str:
-    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-    if img is None:
-        return image_path
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-    gray = cv2.medianBlur(gray, 3)
-    processed_path = "temp_processed.png"
-    cv2.imwrite(processed_path, gray)
-    return processed_path
+@metrics.timed("image.decode")
+def _decode_image(data: bytes) -> np.ndarray:
+    """Giải mã bytes ảnh đúng 1 lần -> ndarray BGR (hoặc gray nếu ảnh xám), đã xoay theo EXIF orientation."""
+    # ANYCOLOR | ANYDEPTH: giữ ảnh xám / 16-bit như UNCHANGED nhưng vẫn áp EXIF orientation (ảnh chụp điện thoại)
+    arr = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
+    if arr is None:
+        # Định dạng OpenCV không đọc được -> thử PIL
+        pil = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+        pil = pil.convert("L") if pil.mode in ("1", "L", "I;16") else pil.convert("RGB")
+        arr = np.asarray(pil)
+        if arr.ndim == 3:
+            arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+    if arr.dtype != np.uint8:
+        arr = cv2.convertScaleAbs(arr, alpha=255.0 / max(1, int(arr.max())))
+    return arr
+
+
+def _pil_view(arr: np.ndarray) -> Image.Image:
+    """PIL image dùng chung bộ nhớ với ndarray (không copy). arr: gray 2D hoặc RGB 3 kênh, uint8."""
+    arr = np.ascontiguousarray(arr)
+    h, w = arr.shape[:2]
+    mode = "L" if arr.ndim == 2 else "RGB"
+    return Image.frombuffer(mode, (w, h), arr, "raw", mode, 0, 1)
+
+
+# Otsu -> (median); median tự bỏ qua khi ảnh gốc ít nhiễu
+_PIPELINE = preprocess.Pipeline(["gray", "otsu", "median"])
+
+
+@metrics.timed("image.preprocess")
+def _preprocess_for_ocr(img: np.ndarray) -> np.ndarray:
+    """
+    Kết quả là buffer dùng lại của thread hiện tại (xem preprocess.py): chỉ dùng trong lượt _image_to_text
+    đang chạy trên thread này, không lưu lại / không trả ra ngoài.
+    """
+    return _PIPELINE.run(img)
+
+
+# Ngưỡng độ tin cậy trung bình (0-100, theo word conf của Tesseract) để dừng sớm
+_CONF_THRESHOLD = float(os.getenv("TESS_CONF_THRESHOLD", "80"))
+# Kết quả Tesseract có conf trung bình dưới mức này -> router leo thang (hybrid: chỉ gửi vùng kém)
+_ACCEPT_CONF = float(os.getenv("TESS_ACCEPT_CONF", "60"))
 
 
-def _tesseract_try_all(pil_img: Image.Image, lang: str = "vie+eng") -> str:
-    def _ocr(img, cfg):
+def _mean_conf(d: dict) -> float:
+    """Độ tin cậy trung bình có trọng số theo độ dài từ (bỏ các ô conf = -1)."""
+    total, weight = 0.0, 0
+    for word, conf in zip(d["text"], d["conf"]):
+        word = (word or "").strip()
         try:
-            return pytesseract.image_to_string(img, lang=lang, config=cfg).strip()
-        except Exception:
-            return ""
-    best_text, best_score = "", 0.0
+            c = float(conf)
+        except (TypeError, ValueError):
+            continue
+        if not word or c < 0:
+            continue
+        total += c * len(word)
+        weight += len(word)
+    return total / weight if weight else 0.0
+
+
+@metrics.timed("tesseract.pass")
+def _tesseract_pass(img: Image.Image, lang: str, cfg: str):
+    """1 lượt Tesseract -> (text, mean_conf, image_to_data). Lỗi -> ("", 0, None)."""
+    try:
+        d = tess_pool.image_to_data(img, lang=lang, config=cfg)
+    except Exception:
+        return "", 0.0, None
+    return layout.text_from_data(d), _mean_conf(d), d
+
+
+def _tesseract_layout(proc: np.ndarray, lang: str = "vie+eng"):
+    """
+    Trang nhiều khối / nhiều cột: OCR song song từng khối (PSM theo khối) theo thứ tự đọc.
+    Ít khối hơn OCR_LAYOUT_MIN_BLOCKS -> None (OCR cả trang như cũ). Trả (text, mean_conf, image_to_data).
+    """
+    if not layout.ENABLED:
+        return None
+    with metrics.span("layout.detect"):
+        blocks = layout.detect_blocks(proc)
+    if len(blocks) < layout.MIN_BLOCKS:
+        return None
+    d = layout.ocr_blocks(proc, lang, blocks)
+    text = layout.text_from_data(d)
+    return (text, _mean_conf(d), d) if text.strip() else None
+
+
+def _tesseract_try_all(pil_img: Image.Image, lang: str = "vie+eng",
+                       conf_threshold: float = _CONF_THRESHOLD, detail: bool = False):
+    """
+    Lịch chạy thích ứng: ảnh gốc + PSM 6 trước; đạt ngưỡng conf là dừng ngay.
+    Nếu chưa đạt -> chạy song song các biến thể còn lại (PSM 4, ảnh đảo màu) và chọn kết quả tốt nhất.
+    detail=True -> (text, mean_conf, image_to_data của lượt tốt nhất) thay vì chỉ text.
+    """
     cfgs = ["--oem 1 --psm 6", "--oem 1 --psm 4"]
-    variants = [pil_img]
+
+    def _good(text, conf):
+        return conf >= conf_threshold and _text_ratio(text) >= 0.55
+
+    best_text, best_conf, best_data = _tesseract_pass(pil_img, lang, cfgs[0])
+    if _good(best_text, best_conf):
+        return (best_text, best_conf, best_data) if detail else best_text
+
+    jobs = [(pil_img, cfgs[1])]
     # đảo màu
     try:
-        inv = Image.fromarray(255 - np.array(pil_img.convert("L"))).convert("RGB")
-        variants.append(inv)
+        gray = np.asarray(pil_img if pil_img.mode == "L" else pil_img.convert("L"))
+        inv = _pil_view(cv2.bitwise_not(gray))
+        jobs += [(inv, cfg) for cfg in cfgs]
     except Exception:
         pass
-    for v in variants:
-        for cfg in cfgs:
-            t = _ocr(v, cfg)
-            score = _text_ratio(t)
-            if score > best_score:
-                best_text, best_score = t, score
-    return best_text
-
-
-def _ensure_rgb_jpeg_bytes(pil_img: Image.Image, max_side: int = 2400, quality: int = 88) -> bytes:
-    img = pil_img.convert("RGB")
-    w, h = img.size
-    scale = min(1.0, max_side / max(w, h))
-    if scale < 1.0:
-        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    return buf.getvalue()
-
-
-def _extract_text_from_resp(resp) -> str:
-    try:
-        if getattr(resp, "text", None):
-            return resp.text.strip()
-        if getattr(resp, "candidates", None):
-            for c in resp.candidates:
-                if getattr(c, "content", None) and getattr(c.content, "parts", None):
-                    chunks = []
-                    for p in c.content.parts:
-                        t = getattr(p, "text", None)
-                        if t:
-                            chunks.append(t)
-                    if chunks:
-                        return "\n".join(chunks).strip()
-        return ""
-    except Exception:
-        return ""
 
+    # tesserocr nhả GIL khi nhận dạng (pytesseract thì chạy process riêng) -> thread là đủ để chạy song song
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        results = list(pool.map(metrics.bind_context(lambda job: _tesseract_pass(job[0], lang, job[1])), jobs))
+    for text, conf, d in results:
+        if (conf, _text_ratio(text)) > (best_conf, _text_ratio(best_text)):
+            best_text, best_conf, best_data = text, conf, d
+    return (best_text, best_conf, best_data) if detail else best_text
+
+
+_GEM_PROMPT = "Extract all readable text (Vietnamese + English). Keep line breaks. Plain text only."
 
-def _gemini_ocr_pil(pil_img: Image.Image, model: str = "gemini-2.5-flash") -> str:
-    if not _gemini_available or _gem_client is None:
-        raise RuntimeError("Gemini chưa sẵn (cài `google-genai` & cấu hình GEMINI_API_KEY).")
-    jpeg = _ensure_rgb_jpeg_bytes(pil_img)
+
+def _gemini_ocr_pil(image: Union[bytes, Image.Image], model: str = "gemini-2.5-flash") -> str:
+    """image: bytes file gốc (giữ được draft decode / gửi nguyên nếu đã nhỏ) hoặc PIL."""
+    data, mime = upload_encoder.encode_for_upload(image)
     contents = [
-        gem_types.Part.from_bytes(data=jpeg, mime_type="image/jpeg"),
-        "Extract all readable text (Vietnamese + English). Keep line breaks. Plain text only."
+        gemini_transport.bytes_part(data, mime),
+        _GEM_PROMPT
     ]
-    resp = _gem_client.models.generate_content(model=model, contents=contents)
-    text = _extract_text_from_resp(resp)
-    if text:
-        return text
-
-    # Nếu rỗng: đẩy lí do cho dev/debug
-    reason = getattr(resp, "candidates", [None])[0]
-    finish = getattr(reason, "finish_reason", None) if reason else None
-    safety = getattr(reason, "safety_ratings", None) if reason else None
-    raise RuntimeError(f"Gemini trả rỗng. finish_reason={finish}; safety={safety}")
+    resp = gemini_transport.generate_content(contents, model=model)
+    # rỗng + STOP -> NoText (không có chữ); bị chặn / cắt ngang -> lỗi để router dùng engine khác
+    return engine_router.gemini_text(resp)
 
 
-def image_to_text(image_path: str):
+def image_to_text(image: Union[str, bytes, np.ndarray], engine: str = "auto", model: Optional[str] = None,
+                  policy: Optional[str] = None):
     """
-    1) Tesseract trên ảnh đã tiền xử lý
-    2) Nếu yếu/rỗng -> gọi Gemini (Google AI Studio)
+    Chọn engine qua engine_router:
+      engine='auto' (mặc định): Tesseract trên ảnh đã tiền xử lý, yếu/rỗng -> hybrid -> Gemini flash
+        (thứ tự theo policy: cascade / adaptive / fixed, xem engine_router)
+      engine='tesseract' | 'gemini' (+ model): đúng engine người dùng chọn.
+    result["route"]: các engine đã thử + lý do.
+    image: đường dẫn file, bytes ảnh (upload) hoặc ndarray (BGR/gray như OpenCV).
+    Ảnh chỉ được giải mã 1 lần, xử lý hoàn toàn trong RAM (không ghi file tạm).
+    Kết quả thành công được cache theo nội dung ảnh (xem ocr_cache).
     """
     try:
-        processed_path = _preprocess_for_ocr(image_path)
-        pil_proc = Image.open(processed_path)
+        if isinstance(image, np.ndarray):
+            arr = np.ascontiguousarray(image)
+            data, extra = arr, {"shape": arr.shape, "dtype": str(arr.dtype)}
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            data, extra = bytes(image), {}
+        else:
+            with open(image, "rb") as f:
+                data, extra = f.read(), {}
+    except OSError as e:
+        return {"success": False, "message": f"Lỗi Image OCR: {e}"}
+    engines, policy = engine_router.resolve(engine, model, policy)
+    with metrics.trace("image_to_text") as tr:
+        result = cached_result(data, lambda: _image_to_text(data, engines, policy),
+                               fn="image_to_text", engine=",".join(engines), policy=policy,
+                               prompt=prompt_hash(_GEM_PROMPT), prep=PREPROCESS_VERSION,
+                               enc=upload_encoder.VERSION, **extra)
+        return metrics.attach(result, tr)
+
+
+def _image_to_text(data: Union[bytes, np.ndarray], engines, policy: str):
+    try:
+        img = data if isinstance(data, np.ndarray) else _decode_image(data)
+
+        def _original():
+            # Gemini: gửi bytes file gốc (encoder tự thu nhỏ), ndarray thì dùng lại ảnh đã có
+            if isinstance(data, bytes):
+                return data
+            if img.ndim == 2:
+                return _pil_view(img)
+            code = cv2.COLOR_BGRA2RGB if img.shape[2] == 4 else cv2.COLOR_BGR2RGB
+            return _pil_view(cv2.cvtColor(img, code))
+
+        state = {}
+
+        def _tesseract():
+            # Tesseract chạy 1 lần, dùng chung cho bước "tesseract" và "hybrid"
+            if "tess" not in state:
+                proc = _preprocess_for_ocr(img)
+                state["tess"] = (_tesseract_layout(proc, "vie+eng")
+                                 or _tesseract_try_all(_pil_view(proc), lang="vie+eng", detail=True))
+            return state["tess"]
+
+        def _run(eng):
+            state["conf"] = None
+            if eng.kind == "tesseract":
+                text, state["conf"], _ = _tesseract()
+                return text
+            if eng.kind == "hybrid":
+                _, _, d = _tesseract()
+                if d is None:
+                    raise RuntimeError("Tesseract không trả về image_to_data")
+                # ảnh tiền xử lý không đổi kích thước -> box của Tesseract khớp ảnh gốc
+                state["hybrid"] = region_fallback.hybrid_ocr(img, d, model=eng.model)
+                return state["hybrid"]["text"]
+            return _gemini_ocr_pil(_original(), model=eng.model)
 
-        tess_text = _tesseract_try_all(pil_proc, lang="vie+eng")
-        if _text_ratio(tess_text) >= 0.55 and tess_text.strip():
-            return {"success": True, "text": tess_text}
+        def _accept(text):
+            conf = state.get("conf")
+            return engine_router.good_text(text) and (conf is None or conf >= _ACCEPT_CONF)
 
-        # Fallback sang Gemini
-        pil_orig = Image.open(image_path) if os.path.exists(image_path) else pil_proc
-        gem_text = _gemini_ocr_pil(pil_orig, model=os.environ.get("GEMINI_MODEL", "gemini-2.5-flash"))
-        return {"success": True, "text": gem_text}
+        result = engine_router.route(_run, engines, policy, accept=_accept, pipeline="image_to_text")
+        if result.get("engine") == "hybrid":
+            h = state["hybrid"]
+            result.update(regions=h["regions"], region_upload_bytes=h["upload_bytes"])
+            if h["failed_regions"]:
+                result["degraded"] = True  # vài vùng giữ text Tesseract vì Gemini lỗi
+        return result
 
     except Exception as e:
         # Trả lỗi rõ ràng để bạn biết đúng điểm nghẽn (SDK/key/model/safety/…)
@@ -0,0 +1,196 @@
+# jobs.py — Chạy OCR nền (background job) + theo dõi tiến độ, dùng chung cho UI và service
+# - submit() trả job id ngay; hàm công việc chạy trên thread pool, báo tiến độ qua job.set_total()/add_page()
+# - Job sống trong executor của process (không phụ thuộc lượt rerun của Streamlit)
+# - Cùng `key` (vd: hash file + engine) -> trả lại job đang chạy / đã thành công, không chạy lại
+#   (job lỗi, bị huỷ hoặc xong với success False -> chạy lại: lỗi Gemini / ffmpeg thường chỉ tạm thời)
+# - max_queue: giới hạn số job chờ (ngoài số đang chạy); đầy -> QueueFull để caller báo "thử lại sau"
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import itertools
+import os
+import threading
+import time
+import uuid
+
+QUEUED, RUNNING, DONE, ERROR, CANCELLED = "queued", "running", "done", "error", "cancelled"
+
+
+class Job:
+    def __init__(self, kind: str, key: Optional[str] = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.status = QUEUED
+        self.total: Optional[int] = None
+        self.pages: Dict[int, str] = {}
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    # ----- gọi từ hàm công việc -----
+    def set_total(self, total: int) -> None:
+        self.total = total
+
+    def add_page(self, page: int, text: str) -> None:
+        with self._lock:
+            self.pages[page] = text
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    # ----- gọi từ UI / API -----
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, ERROR, CANCELLED)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == DONE and bool((self.result or {}).get("success"))
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Chờ job xong; True nếu đã xong trong `timeout` giây."""
+        return self._done.wait(timeout)
+
+    def progress(self) -> float:
+        if self.status == DONE:
+            return 1.0
+        if not self.total:
+            return 0.0
+        return min(1.0, len(self.pages) / self.total)
+
+    def partial_text(self) -> str:
+        with self._lock:
+            items = sorted(self.pages.items())
+        return "".join(f"\n\n--- Trang {i} ---\n{t}" for i, t in items)
+
+    def to_dict(self, include_partial: bool = False) -> Dict[str, Any]:
+        out = {"id": self.id, "kind": self.kind, "status": self.status,
+               "progress": round(self.progress(), 3), "pages_done": len(self.pages), "pages_total": self.total,
+               "created_at": self.created_at, "started_at": self.started_at, "finished_at": self.finished_at}
+        if self.result is not None:
+            out["result"] = self.result
+        if self.error:
+            out["error"] = self.error
+        if include_partial and not self.finished:
+            out["partial_text"] = self.partial_text()
+        return out
+
+
+class QueueFull(RuntimeError):
+    """Hàng đợi đã đầy — caller nên thử lại sau (HTTP 429)."""
+
+
+class JobExecutor:
+    def __init__(self, max_workers: int = int(os.getenv("OCR_JOB_WORKERS", "2")),
+                 max_jobs_kept: int = 200, max_queue: Optional[int] = None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ocr-job")
+        self._active = 0  # job chưa xong (đang chờ + đang chạy)
+        self._jobs: Dict[str, Job] = {}
+        self._by_key: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._max_kept = max_jobs_kept
+
+    def submit(self, kind: str, fn: Callable[..., Dict[str, Any]], *args,
+               key: Optional[str] = None, **kwargs) -> str:
+        """
+        Chạy fn(job, *args, **kwargs) nền, trả job id ngay.
+        fn trả dict kết quả dạng {"success": ..., ...}.
+        Cùng key: dùng lại job đang chạy hoặc đã thành công; job đã thất bại thì chạy lại.
+        Hàng đợi đầy (max_queue) -> QueueFull.
+        """
+        with self._lock:
+            if key is not None and key in self._by_key:
+                old = self._jobs.get(self._by_key[key])
+                if old is not None and (not old.finished or old.succeeded):
+                    return old.id
+            if self.max_queue is not None and self._active >= self.max_workers + self.max_queue:
+                raise QueueFull(f"Hàng đợi đầy ({self.max_queue} job đang chờ).")
+            self._active += 1
+            job = Job(kind, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._by_key[key] = job.id
+            self._gc()
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def queue_depth(self) -> int:
+        """Số job đang chờ worker (chưa chạy)."""
+        with self._lock:
+            return max(0, self._active - self.max_workers)
+
+    def active(self) -> int:
+        with self._lock:
+            return self._active
+
+    def _run(self, job: Job, fn, args, kwargs) -> None:
+        try:
+            if job.cancelled:
+                job.status = CANCELLED
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+            result = fn(job, *args, **kwargs)
+            job.result = result
+            job.status = CANCELLED if job.cancelled else DONE
+        except Exception as e:
+            job.error = str(e)
+            job.result = {"success": False, "message": f"Lỗi: {e}"}
+            job.status = ERROR
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._active -= 1
+            job._done.set()
+
+    def _gc(self) -> None:
+        """Giữ tối đa max_jobs_kept job đã xong (xoá job cũ nhất trước)."""
+        if len(self._jobs) <= self._max_kept:
+            return
+        done = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished_at or 0)
+        for job in itertools.islice(done, len(self._jobs) - self._max_kept):
+            self._jobs.pop(job.id, None)
+            if job.key is not None and self._by_key.get(job.key) == job.id:
+                self._by_key.pop(job.key, None)
+
+
+# ----------------- Các loại job dùng sẵn -----------------
+def run_callable(job: Job, fn: Callable[..., Dict[str, Any]], *args, **kwargs) -> Dict[str, Any]:
+    """Job 1 bước (ảnh, scan, speech, AI): không có tiến độ theo trang."""
+    return fn(*args, **kwargs)
+
+
+def run_pdf(job: Job, pdf_source, engine: str = "tesseract", model: str = "gemini-2.5-flash") -> Dict[str, Any]:
+    """
+    Job PDF: chạy qua pdf_to_text (cache, metrics, failed_pages / degraded như gọi trực tiếp),
+    cập nhật tiến độ + text từng phần ngay khi mỗi trang xong. Huỷ -> {"success": False, "cancelled": True}.
+    """
+    from pdf_to_text import pdf_page_count, pdf_to_text
+
+    try:
+        job.set_total(pdf_page_count(pdf_source))
+    except Exception:
+        pass
+    return pdf_to_text(pdf_source, engine=engine, model=model, on_page=job.add_page,
+                       should_stop=lambda: job.cancelled)
@@ -0,0 +1,192 @@
+# layout.py — Tách bố cục trang (khối chữ, cột) + OCR song song từng khối theo thứ tự đọc
+# - Phát hiện khối: dilate vùng mực theo cỡ chữ ước lượng (nối chữ -> dòng -> đoạn), lấy contour ngoài cùng
+#   (làm trên ảnh thu nhỏ cho nhanh, toạ độ quy về ảnh gốc)
+# - Thứ tự đọc: XY-cut đệ quy — ưu tiên cắt cột khi mọi cột trải gần hết chiều cao vùng, gộp các hàng liền nhau
+#   cùng nhiều cột (khe đoạn văn thẳng hàng giữa các cột không xé cột thành hàng), còn lại cắt theo khe rộng nhất
+# - Mỗi khối 1 PSM phù hợp: 1 dòng -> PSM 7, nhiều dòng -> PSM 6; các khối chạy song song trên tess_pool
+#   (1 ảnh lớn dùng hết các core thay vì 1)
+# - Kết quả gộp lại thành 1 dict kiểu image_to_data (toạ độ trên ảnh gốc, block_num theo thứ tự đọc)
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+import os
+
+import cv2
+import numpy as np
+
+import metrics
+import tess_pool
+
+ENABLED = os.getenv("OCR_LAYOUT", "1") != "0"
+MIN_BLOCKS = int(os.getenv("OCR_LAYOUT_MIN_BLOCKS", "2"))    # ít khối hơn -> OCR cả trang như cũ
+WORKERS = int(os.getenv("OCR_LAYOUT_WORKERS", str(os.cpu_count() or 2)))
+_DETECT_SIDE = 1600                                           # cạnh dài ảnh dùng để tìm khối
+_COLUMN_SPAN = 0.8                                            # cột "trải hết" vùng: cao >= 80% chiều cao vùng
+
+_DATA_KEYS = ["level", "page_num", "block_num", "par_num", "line_num", "word_num",
+              "left", "top", "width", "height", "conf", "text"]
+
+
+class Block(NamedTuple):
+    x: int
+    y: int
+    w: int
+    h: int
+    psm: int
+
+
+def _ink(gray: np.ndarray) -> np.ndarray:
+    """Mặt nạ mực (255 = chữ), tự nhận ra ảnh nền tối."""
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    if cv2.countNonZero(ink) > ink.size // 2:
+        ink = cv2.bitwise_not(ink)
+    return ink
+
+
+def _char_height(ink: np.ndarray) -> float:
+    n, _, st, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    hs = st[1:n, cv2.CC_STAT_HEIGHT]
+    hs = hs[(hs > 2) & (hs < ink.shape[0] * 0.1)]
+    return float(np.median(hs)) if len(hs) else 10.0
+
+
+def detect_blocks(gray: np.ndarray) -> List[Block]:
+    """Các khối chữ (toạ độ ảnh gốc), đã sắp theo thứ tự đọc."""
+    h, w = gray.shape[:2]
+    s = min(1.0, _DETECT_SIDE / max(h, w))
+    small = cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA) if s < 1.0 else gray
+    ink = _ink(small)
+    ch = _char_height(ink)
+    # ngang ~1.5 cỡ chữ: nối các từ trong dòng, chưa vượt khe cột; dọc ~0.8: nối các dòng của 1 đoạn
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, int(ch * 1.5)), max(1, int(ch * 0.8))))
+    merged = cv2.dilate(ink, kernel)
+    contours, _ = cv2.findContours(merged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    rects = []
+    for c in contours:
+        x, y, bw, bh = cv2.boundingRect(c)
+        if bw * bh < ch * ch or bh < ch * 0.5:
+            continue  # nhiễu / vệt nhỏ
+        rects.append((x, y, bw, bh))
+    pad, line_h = ch / 2, ch * 2.2
+    blocks = []
+    for x, y, bw, bh in reading_order(rects):
+        x0, y0 = max(0, int((x - pad) / s)), max(0, int((y - pad) / s))
+        x1, y1 = min(w, int((x + bw + pad) / s)), min(h, int((y + bh + pad) / s))
+        blocks.append(Block(x0, y0, x1 - x0, y1 - y0, 7 if bh <= line_h else 6))
+    return blocks
+
+
+def _split(rects, axis: int):
+    """Chia rects theo các khe trống trên trục (0 = x, 1 = y). Trả (các nhóm, khe rộng nhất)."""
+    order = sorted(rects, key=lambda r: r[axis])
+    groups, reach, widest = [[order[0]]], order[0][axis] + order[0][axis + 2], 0
+    for r in order[1:]:
+        if r[axis] > reach:
+            widest = max(widest, r[axis] - reach)
+            groups.append([r])
+        else:
+            groups[-1].append(r)
+        reach = max(reach, r[axis] + r[axis + 2])
+    return groups, widest
+
+
+def _extent(rects, axis: int) -> int:
+    return max(r[axis] + r[axis + 2] for r in rects) - min(r[axis] for r in rects)
+
+
+def _merge_column_rows(rows):
+    """Gộp các hàng liền nhau cùng chia được thành nhiều cột (khe đoạn văn thẳng hàng giữa các cột)."""
+    out, prev_multi = [], False
+    for g in rows:
+        multi = len(_split(g, 0)[0]) > 1
+        if multi and prev_multi:
+            out[-1] = out[-1] + g
+        else:
+            out.append(g)
+        prev_multi = multi
+    return out
+
+
+def reading_order(rects: List[tuple]) -> List[tuple]:
+    """
+    XY-cut (hàng trên -> dưới, cột trái -> phải), đệ quy từng phần:
+      - mọi cột đều trải gần hết chiều cao vùng -> cắt cột (trang nhiều cột)
+      - cắt hàng: các hàng liền nhau cùng nhiều cột được gộp lại, đệ quy sẽ cắt cột cho cả khối đó
+      - còn lại: cắt theo trục có khe rộng nhất
+    """
+    if len(rects) <= 1:
+        return list(rects)
+    rows, gap_y = _split(rects, 1)
+    cols, gap_x = _split(rects, 0)
+    if len(rows) == 1 and len(cols) == 1:
+        return sorted(rects, key=lambda r: (r[1], r[0]))  # chồng lấn cả 2 trục: trên -> dưới
+    height = _extent(rects, 1)
+    if len(cols) > 1 and (len(rows) == 1 or all(_extent(g, 1) >= _COLUMN_SPAN * height for g in cols)):
+        groups = cols
+    else:
+        merged = _merge_column_rows(rows) if len(rows) > 1 else rows
+        if len(merged) > 1:
+            groups = merged
+        else:
+            groups = rows if gap_y >= gap_x or len(cols) == 1 else cols
+    return [r for g in groups for r in reading_order(g)]
+
+
+def text_from_data(d: Dict[str, list]) -> str:
+    """Ghép lại text từ kết quả image_to_data (giữ xuống dòng theo line, dòng trống giữa các block)."""
+    lines, cur_key, cur_words, last_block = [], None, [], None
+    for i, word in enumerate(d["text"]):
+        word = (word or "").strip()
+        if not word:
+            continue
+        key = (d["block_num"][i], d["par_num"][i], d["line_num"][i])
+        if key != cur_key:
+            if cur_words:
+                lines.append(" ".join(cur_words))
+            if last_block is not None and key[0] != last_block:
+                lines.append("")
+            cur_key, cur_words, last_block = key, [], key[0]
+        cur_words.append(word)
+    if cur_words:
+        lines.append(" ".join(cur_words))
+    return "\n".join(lines).strip()
+
+
+def ocr_blocks(gray: np.ndarray, lang: str = "vie+eng", blocks: Optional[List[Block]] = None,
+               workers: int = WORKERS) -> Dict[str, list]:
+    """
+    OCR song song từng khối -> dict kiểu image_to_data gộp: toạ độ trên ảnh gốc,
+    block_num = thứ tự đọc của khối (par/line giữ nguyên trong khối).
+    """
+    if blocks is None:
+        with metrics.span("layout.detect"):
+            blocks = detect_blocks(gray)
+    if not blocks:
+        return {k: [] for k in _DATA_KEYS}
+    if float(gray[::8, ::8].mean()) < 127:
+        gray = cv2.bitwise_not(gray)  # nền tối, chữ sáng -> đảo trước khi cắt khối
+
+    def _one(b: Block):
+        crop = gray[b.y:b.y + b.h, b.x:b.x + b.w]
+        with metrics.span("tesseract.block"):
+            try:
+                return tess_pool.image_to_data(crop, lang=lang, config=f"--oem 1 --psm {b.psm}")
+            except Exception:
+                return None
+
+    # tess_pool giữ POOL_SIZE TessBaseAPI (nhả GIL khi nhận dạng) -> thread là đủ
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(blocks)))) as pool:
+        results = list(pool.map(metrics.bind_context(_one), blocks))
+
+    merged: Dict[str, list] = {k: [] for k in _DATA_KEYS}
+    for k, (b, d) in enumerate(zip(blocks, results), start=1):
+        if not d:
+            continue
+        for i in range(len(d["text"])):
+            for key in _DATA_KEYS:
+                merged[key].append(d[key][i])
+            merged["block_num"][-1] = k * 1000 + int(d["block_num"][i])
+            merged["left"][-1] = int(d["left"][i]) + b.x
+            merged["top"][-1] = int(d["top"][i]) + b.y
+    metrics.incr("layout_blocks_total", len(blocks))
+    return merged
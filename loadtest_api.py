@@ -0,0 +1,140 @@
+# loadtest_api.py — Tải thử ocr_api trên localhost (không cần mạng ngoài)
+#
+# Ví dụ:
+#   python loadtest_api.py --requests 200 --concurrency 16
+#   python loadtest_api.py --pipeline pdf --async --workers 4 --max-queue 8
+#   python loadtest_api.py --url http://127.0.0.1:8080   # bắn vào server đang chạy sẵn
+#
+# - Không truyền --url: tự dựng server trong process trên port trống, Gemini dùng client giả lập.
+# - Tài liệu thử sinh bằng bench_ocr (mỗi request 1 file khác nhau để không trúng cache / dedup).
+# - Báo cáo: throughput, p50/p95/p99 latency, số 200 / 202 / 429 / lỗi.
+import os
+
+os.environ.setdefault("OCR_CACHE", "0")
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+from bench_ocr import _percentile, _png_bytes, install_gemini_stub, make_document, make_pdf
+
+
+def _payloads(pipeline: str, n: int, pages: int) -> List[bytes]:
+    """Vài file khác nhau, dùng vòng tròn; thêm byte rác cuối file để mỗi request có hash riêng."""
+    if pipeline == "pdf":
+        base = [make_pdf(pages)]
+    else:
+        base = [_png_bytes(make_document(font_size=fs, seed=s)) for fs, s in ((28, 0), (20, 1), (16, 2))]
+    return [base[i % len(base)] + b"\n%" + str(i).encode() for i in range(n)]
+
+
+class _Client(threading.local):
+    """1 kết nối keep-alive cho mỗi thread."""
+
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.conn = None
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=600)
+            try:
+                headers = {"Content-Type": "application/octet-stream"} if body is not None else {}
+                self.conn.request(method, path, body=body, headers=headers)
+                resp = self.conn.getresponse()
+                return resp.status, resp.read()
+            except (ConnectionError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+def _one(client: _Client, path: str, body: bytes, use_async: bool, poll: float) -> Dict:
+    t0 = time.perf_counter()
+    status, raw = client.request("POST", path, body)
+    if use_async and status == 202:
+        job_id = json.loads(raw)["job_id"]
+        while True:
+            time.sleep(poll)
+            _, raw = client.request("GET", f"/v1/jobs/{job_id}")
+            job = json.loads(raw)
+            if job["status"] in ("done", "error", "cancelled"):
+                status = 200 if job["status"] == "done" else 500
+                break
+    return {"status": status, "latency": time.perf_counter() - t0}
+
+
+def run(url: str, pipeline: str, n: int, concurrency: int, use_async: bool, pages: int,
+        params: str = "", poll: float = 0.05) -> Dict:
+    u = urlparse(url)
+    client = _Client(u.hostname, u.port or 80)
+    query = "&".join(p for p in (params, "async=1" if use_async else "") if p)
+    path = f"/v1/{pipeline}" + (f"?{query}" if query else "")
+    bodies = _payloads(pipeline, n, pages)
+
+    t_all = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda b: _one(client, path, b, use_async, poll), bodies))
+    total = time.perf_counter() - t_all
+
+    ok = [r["latency"] for r in results if r["status"] == 200]
+    codes: Dict[str, int] = {}
+    for r in results:
+        codes[str(r["status"])] = codes.get(str(r["status"]), 0) + 1
+    return {
+        "pipeline": pipeline, "mode": "async" if use_async else "sync",
+        "requests": n, "concurrency": concurrency, "wall_s": round(total, 3),
+        "throughput_ok_per_s": round(len(ok) / total, 3) if total else 0.0,
+        "p50_s": round(_percentile(ok, 0.50), 4), "p95_s": round(_percentile(ok, 0.95), 4),
+        "p99_s": round(_percentile(ok, 0.99), 4), "status_counts": codes,
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Tải thử HTTP API OCR trên localhost.")
+    ap.add_argument("--url", help="Server đang chạy sẵn; bỏ trống -> tự dựng server trong process.")
+    ap.add_argument("--pipeline", default="image", choices=["image", "pdf", "scan", "ai"])
+    ap.add_argument("--params", default="", help="Query string thêm, vd: engine=tesseract")
+    ap.add_argument("--requests", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--async", dest="use_async", action="store_true", help="Submit rồi poll /v1/jobs/<id>.")
+    ap.add_argument("--pages", type=int, default=3, help="Số trang của PDF thử.")
+    ap.add_argument("--workers", type=int, default=2, help="(server nội bộ) số job chạy cùng lúc.")
+    ap.add_argument("--max-queue", type=int, default=16, help="(server nội bộ) độ sâu hàng đợi.")
+    ap.add_argument("--gemini-latency", type=float, default=0.3, help="(server nội bộ) độ trễ Gemini giả lập.")
+    ap.add_argument("--out", help="Ghi kết quả JSON ra file.")
+    args = ap.parse_args(argv)
+
+    server = None
+    url = args.url
+    if not url:
+        from ocr_api import make_server
+        install_gemini_stub(args.gemini_latency)
+        server = make_server("127.0.0.1", 0, workers=args.workers, max_queue=args.max_queue, quiet=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        report = run(url, args.pipeline, args.requests, args.concurrency, args.use_async, args.pages, args.params)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
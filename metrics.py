@@ -0,0 +1,212 @@
+# metrics.py — Đo thời gian theo từng bước (span) + histogram/counter trong process
+# - Bật bằng OCR_METRICS=1 (hoặc metrics.enable()). Khi tắt: span() trả về 1 object no-op dùng chung,
+#   chi phí chỉ là 1 lần kiểm tra biến toàn cục.
+# - Mỗi lời gọi pipeline (trong `trace(...)`) nhận bảng thời gian theo bước ở result["timings"].
+# - Xuất dạng Prometheus text (prometheus_text()) hoặc JSON (to_json()).
+from contextlib import contextmanager
+from typing import Dict, Optional
+import contextvars
+import functools
+import os
+import threading
+import time
+
+_enabled = os.getenv("OCR_METRICS", "0") == "1"
+
+# Bucket (giây) cho histogram — từ vài ms (resize) đến vài chục giây (PDF dài / Gemini pro)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_histograms: Dict[str, dict] = {}
+_counters: Dict[tuple, float] = {}
+_current: contextvars.ContextVar = contextvars.ContextVar("ocr_trace", default=None)
+
+
+def enable(flag: bool = True) -> None:
+    global _enabled
+    _enabled = flag
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+# ----------------- Ghi nhận -----------------
+def observe(stage: str, seconds: float) -> None:
+    with _lock:
+        h = _histograms.get(stage)
+        if h is None:
+            h = _histograms[stage] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, b in enumerate(BUCKETS):
+            if seconds <= b:
+                h["buckets"][i] += 1
+        h["sum"] += seconds
+        h["count"] += 1
+    tr = _current.get()
+    if tr is not None:
+        tr.add(stage, seconds)
+
+
+def incr(name: str, value: float = 1.0, **labels) -> None:
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        observe(self.stage, time.perf_counter() - self.t0)
+        if exc_type is not None:
+            incr("ocr_stage_errors_total", stage=self.stage)
+        return False
+
+
+def span(stage: str):
+    """`with span("scan.deskew"): ...` — đo 1 bước."""
+    if not _enabled:
+        return _NOOP
+    return _Span(stage)
+
+
+def timed(stage: str):
+    """Decorator đo toàn bộ hàm như 1 span."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+# ----------------- Bảng thời gian theo từng lời gọi -----------------
+class Trace:
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        self.stages: Dict[str, dict] = {}
+        self.t0 = time.perf_counter()
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            s = self.stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+            s["seconds"] += seconds
+            s["calls"] += 1
+
+    def breakdown(self) -> Dict:
+        with self._lock:
+            stages = {k: {"seconds": round(v["seconds"], 4), "calls": v["calls"]} for k, v in self.stages.items()}
+        return {"pipeline": self.pipeline, "total_seconds": round(self.total, 4), "stages": stages}
+
+
+@contextmanager
+def trace(pipeline: str):
+    """Gom mọi span trong khối (kể cả thread con dùng bind_context) thành 1 bảng thời gian. Tắt -> yield None."""
+    if not _enabled:
+        yield None
+        return
+    tr = Trace(pipeline)
+    token = _current.set(tr)
+    try:
+        yield tr
+    finally:
+        tr.total = time.perf_counter() - tr.t0
+        _current.reset(token)
+        observe(f"{pipeline}.total", tr.total)
+
+
+def attach(result: Optional[Dict], tr: Optional[Trace]) -> Optional[Dict]:
+    """Gắn bảng thời gian vào kết quả dạng dict (bản sao, không sửa object trong cache)."""
+    if tr is None or not isinstance(result, dict):
+        return result
+    tr.total = time.perf_counter() - tr.t0
+    incr("ocr_calls_total", pipeline=tr.pipeline, status="ok" if result.get("success") else "error")
+    out = dict(result)
+    out["timings"] = tr.breakdown()
+    return out
+
+
+def bind_context(fn):
+    """Bọc fn để chạy trong bản sao context hiện tại (giữ trace khi chuyển sang thread pool)."""
+    if not _enabled:
+        return fn
+    ctx = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+# ----------------- Xuất số liệu -----------------
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"'.replace("\n", " ") for k, v in pairs)
+    return "{" + body + "}"
+
+
+def prometheus_text() -> str:
+    lines = ["# HELP ocr_stage_seconds Thời gian từng bước trong pipeline OCR.",
+             "# TYPE ocr_stage_seconds histogram"]
+    with _lock:
+        hists = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]}
+                 for k, v in _histograms.items()}
+        counters = dict(_counters)
+    for stage in sorted(hists):
+        h = hists[stage]
+        for b, c in zip(BUCKETS, h["buckets"]):
+            lines.append(f'ocr_stage_seconds_bucket{{stage="{stage}",le="{b}"}} {c}')
+        lines.append(f'ocr_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h["count"]}')
+        lines.append(f'ocr_stage_seconds_sum{{stage="{stage}"}} {h["sum"]:.6f}')
+        lines.append(f'ocr_stage_seconds_count{{stage="{stage}"}} {h["count"]}')
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        lines.append(f"{name}{_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def to_json() -> Dict:
+    with _lock:
+        hists = {k: {"buckets": dict(zip([str(b) for b in BUCKETS], v["buckets"])),
+                     "sum": round(v["sum"], 6), "count": v["count"],
+                     "mean": round(v["sum"] / v["count"], 6) if v["count"] else 0.0}
+                 for k, v in _histograms.items()}
+        counters = [{"name": n, "labels": dict(l), "value": v} for (n, l), v in _counters.items()]
+    return {"enabled": _enabled, "histograms": hists, "counters": counters}
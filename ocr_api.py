@@ -0,0 +1,264 @@
+# ocr_api.py — HTTP API cho các pipeline OCR (không cần Streamlit, chỉ dùng thư viện chuẩn)
+#
+# Chạy:
+#   python ocr_api.py --host 127.0.0.1 --port 8080 --workers 4 --max-queue 16
+#
+# Gửi file dạng body thô (Content-Length hoặc Transfer-Encoding: chunked), tham số qua query string:
+#   POST   /v1/image                         -> đồng bộ: chờ xong rồi trả JSON kết quả
+#   POST   /v1/image?engine=auto&policy=adaptive (engine: auto | tesseract | gemini; model=...)
+#   POST   /v1/pdf?engine=gemini&async=1     -> bất đồng bộ: 202 + {"job_id": ...}
+#   POST   /v1/scan?engine=tesseract&lang=English
+#   POST   /v1/ai                            -> analyze_document_ai (tự nhận ảnh / PDF)
+#   POST   /v1/speech?lang=English&engine=vosk   (engine: google | vosk | whisper)
+#   GET    /v1/jobs/<id>                     -> trạng thái, tiến độ, text từng phần, kết quả
+#   DELETE /v1/jobs/<id>                     -> huỷ job
+#   GET    /health, GET /metrics (Prometheus text)
+#
+# - Mọi việc OCR chạy trên JobExecutor có giới hạn worker + độ sâu hàng đợi; đầy -> 429 + Retry-After.
+# - Request đồng bộ quá OCR_API_SYNC_TIMEOUT_S giây -> trả 202 + job_id để client poll tiếp.
+# - Cùng file + cùng tham số -> dùng lại job đang chạy / đã thành công (kết quả lỗi, vd 422 -> gửi lại sẽ chạy lại).
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import metrics
+from jobs import JobExecutor, QueueFull, run_callable, run_pdf
+
+MAX_UPLOAD_BYTES = int(float(os.getenv("OCR_API_MAX_UPLOAD_MB", "50")) * 2 ** 20)
+SYNC_TIMEOUT_S = float(os.getenv("OCR_API_SYNC_TIMEOUT_S", "300"))
+RETRY_AFTER_S = int(os.getenv("OCR_API_RETRY_AFTER_S", "2"))
+_CHUNK = 1 << 20
+
+
+# ----------------- Pipeline -> (hàm job, args) -----------------
+def _image(data: bytes, q: Dict[str, str]) -> Tuple[Callable, tuple, dict]:
+    from image_to_text import image_to_text
+    return run_callable, (image_to_text, data), {"engine": q.get("engine", "auto"), "model": q.get("model"),
+                                                 "policy": q.get("policy")}
+
+
+def _pdf(data: bytes, q: Dict[str, str]) -> Tuple[Callable, tuple, dict]:
+    return run_pdf, (data, q.get("engine", "tesseract"), q.get("model", "gemini-2.5-flash")), {}
+
+
+def _scan(data: bytes, q: Dict[str, str]) -> Tuple[Callable, tuple, dict]:
+    from scan_to_text import scan_to_text
+    return run_callable, (scan_to_text, data), {"lang": q.get("lang", "Tiếng Việt"),
+                                               "engine": q.get("engine", "auto"),
+                                               "gem_model": q.get("model"), "policy": q.get("policy")}
+
+
+def _ai(data: bytes, q: Dict[str, str]) -> Tuple[Callable, tuple, dict]:
+    from smart_ai_extract import analyze_document_ai
+    file_type = q.get("file_type") or ("pdf" if data[:5] == b"%PDF-" else "image")
+    return run_callable, (analyze_document_ai, data), {"file_type": file_type}
+
+
+def _speech(data: bytes, q: Dict[str, str]) -> Tuple[Callable, tuple, dict]:
+    from speech_to_text import speech_to_text
+    return run_callable, (speech_to_text,), {"audio_bytes": data, "lang": q.get("lang", "Tiếng Việt"),
+                                             "engine": q.get("engine")}
+
+
+PIPELINES: Dict[str, Callable[[bytes, Dict[str, str]], Tuple[Callable, tuple, dict]]] = {
+    "image": _image,
+    "pdf": _pdf,
+    "scan": _scan,
+    "ai": _ai,
+    "speech": _speech,
+}
+
+
+class UploadError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# ----------------- HTTP -----------------
+class OCRRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive cho client gửi nhiều request
+    server_version = "OCRService/1.0"
+
+    @property
+    def executor(self) -> JobExecutor:
+        return self.server.executor
+
+    def log_message(self, fmt, *args):
+        if not getattr(self.server, "quiet", False):
+            super().log_message(fmt, *args)
+
+    # ----- trả lời -----
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self._send(status, body, "application/json; charset=utf-8", headers)
+
+    def _error(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        self._json(status, {"success": False, "message": message}, headers)
+
+    # ----- đọc body theo từng khối (không đọc 1 lần cả file) -----
+    def _read_body(self) -> bytes:
+        buf = BytesIO()
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            while True:
+                line = self.rfile.readline(65537)
+                try:
+                    size = int(line.split(b";", 1)[0].strip() or b"0", 16)
+                except ValueError:
+                    raise UploadError(400, "Chunked encoding không hợp lệ.")
+                if size == 0:
+                    while self.rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                        pass  # bỏ trailer
+                    break
+                if buf.tell() + size > MAX_UPLOAD_BYTES:
+                    raise UploadError(413, f"File vượt quá {MAX_UPLOAD_BYTES // 2 ** 20} MB.")
+                self._copy(buf, size)
+                self.rfile.readline(3)  # CRLF sau mỗi chunk
+        else:
+            try:
+                length = int(self.headers.get("Content-Length", "0"))
+            except ValueError:
+                raise UploadError(400, "Content-Length không hợp lệ.")
+            if length > MAX_UPLOAD_BYTES:
+                raise UploadError(413, f"File vượt quá {MAX_UPLOAD_BYTES // 2 ** 20} MB.")
+            self._copy(buf, length)
+        return buf.getvalue()
+
+    def _copy(self, buf: BytesIO, n: int) -> None:
+        while n > 0:
+            chunk = self.rfile.read(min(_CHUNK, n))
+            if not chunk:
+                raise UploadError(400, "Kết nối bị ngắt khi đang tải file.")
+            buf.write(chunk)
+            n -= len(chunk)
+
+    # ----- định tuyến -----
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["health"]:
+            return self._json(200, self.server.health())
+        if parts == ["metrics"]:
+            return self._send(200, metrics.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4")
+        if len(parts) == 3 and parts[:2] == ["v1", "jobs"]:
+            job = self.executor.get(parts[2])
+            if job is None:
+                return self._error(404, "Không tìm thấy job.")
+            return self._json(200, job.to_dict(include_partial=True))
+        self._error(404, "Không có endpoint này.")
+
+    def do_DELETE(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        if len(parts) == 3 and parts[:2] == ["v1", "jobs"]:
+            job = self.executor.get(parts[2])
+            if job is None:
+                return self._error(404, "Không tìm thấy job.")
+            job.cancel()
+            return self._json(200, job.to_dict())
+        self._error(404, "Không có endpoint này.")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if len(parts) != 2 or parts[0] != "v1" or parts[1] not in PIPELINES:
+            return self._error(404, f"Pipeline hợp lệ: {', '.join(PIPELINES)}.")
+        pipeline = parts[1]
+
+        try:
+            data = self._read_body()
+        except UploadError as e:
+            self.close_connection = True  # body có thể chưa đọc hết
+            return self._error(e.status, str(e))
+        if not data:
+            return self._error(400, "Body rỗng — gửi nội dung file trong body.")
+
+        fn, args, kwargs = PIPELINES[pipeline](data, q)
+        params = json.dumps({k: v for k, v in sorted(q.items()) if k != "async"}, ensure_ascii=False)
+        key = f"{pipeline}:{hashlib.sha256(data).hexdigest()}:{params}"
+        del data
+        try:
+            job_id = self.executor.submit(pipeline, fn, *args, key=key, **kwargs)
+        except QueueFull as e:
+            metrics.incr("ocr_api_rejected_total", pipeline=pipeline)
+            return self._error(429, str(e), {"Retry-After": str(RETRY_AFTER_S)})
+        metrics.incr("ocr_api_requests_total", pipeline=pipeline, mode="async" if q.get("async") == "1" else "sync")
+
+        job = self.executor.get(job_id)
+        if q.get("async") == "1" or not job.wait(SYNC_TIMEOUT_S):
+            return self._json(202, {"job_id": job_id, "status": job.status},
+                              {"Location": f"/v1/jobs/{job_id}"})
+        result = dict(job.result or {})
+        result.setdefault("job_id", job_id)
+        self._json(200 if result.get("success") else 422, result)
+
+
+class OCRServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, executor: JobExecutor, quiet: bool = False):
+        super().__init__(addr, OCRRequestHandler)
+        self.executor = executor
+        self.quiet = quiet
+        self.started_at = time.time()
+
+    def health(self) -> Dict[str, Any]:
+        try:
+            from gemini_transport import breaker_state
+            import engine_router
+            gemini, router = breaker_state(), engine_router.stats()
+        except Exception:
+            gemini, router = "unavailable", {}
+        return {"status": "ok", "uptime_s": round(time.time() - self.started_at, 1),
+                "workers": self.executor.max_workers, "active": self.executor.active(),
+                "queue_depth": self.executor.queue_depth(), "max_queue": self.executor.max_queue,
+                "gemini": gemini, "router": router}
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8080, workers: int = 2, max_queue: int = 16,
+                quiet: bool = False) -> OCRServer:
+    """Tạo server (chưa chạy). port=0 -> hệ điều hành chọn port trống (dùng cho load test)."""
+    return OCRServer((host, port), JobExecutor(max_workers=workers, max_queue=max_queue), quiet=quiet)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="HTTP API cho các pipeline OCR.")
+    ap.add_argument("--host", default=os.getenv("OCR_API_HOST", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("OCR_API_PORT", "8080")))
+    ap.add_argument("--workers", type=int, default=int(os.getenv("OCR_JOB_WORKERS", "2")),
+                    help="Số job OCR chạy cùng lúc.")
+    ap.add_argument("--max-queue", type=int, default=int(os.getenv("OCR_API_MAX_QUEUE", "16")),
+                    help="Số job được chờ tối đa; vượt quá -> 429.")
+    ap.add_argument("--quiet", action="store_true", help="Không in access log.")
+    args = ap.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.workers, args.max_queue, args.quiet)
+    print(f"OCR API: http://{args.host}:{server.server_address[1]}  "
+          f"(workers={args.workers}, max_queue={args.max_queue})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
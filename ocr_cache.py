@@ -0,0 +1,279 @@
+# ocr_cache.py — Cache kết quả OCR theo nội dung (content-addressed), dùng chung cho mọi engine
+# - Key = sha256(bytes đầu vào) + engine/model/prompt/phiên bản tiền xử lý
+# - 2 tầng: RAM (LRU theo dung lượng) + đĩa (LRU theo dung lượng), đều có TTL
+# - Nhiều phiên hỏi cùng 1 key cùng lúc: chỉ 1 phiên chạy OCR, các phiên khác chờ kết quả
+#   (kết quả không cache được — lỗi, bị huỷ... — thì mỗi phiên chờ tự chạy lại, không nhận kết quả của người khác)
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+import hashlib
+import json
+import os
+import threading
+import time
+
+_ENABLED = os.getenv("OCR_CACHE", "1") != "0"
+_CACHE_DIR = os.getenv("OCR_CACHE_DIR", ".ocr_cache")
+_RAM_MB = float(os.getenv("OCR_CACHE_RAM_MB", "64"))
+_DISK_MB = float(os.getenv("OCR_CACHE_DISK_MB", "512"))
+_TTL = float(os.getenv("OCR_CACHE_TTL", str(7 * 24 * 3600)))
+# Kết quả "không có chữ" giữ ngắn hơn: có thể do model nhất thời, không nên khoá 1 ảnh cả tuần
+_NO_TEXT_TTL = float(os.getenv("OCR_CACHE_NO_TEXT_TTL", "3600"))
+
+
+def make_key(data: bytes, **params) -> str:
+    """Hash nội dung + tham số ảnh hưởng đến kết quả (engine, model, prompt, phiên bản tiền xử lý...)."""
+    h = hashlib.sha256()
+    h.update(data)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value: Any = None
+        self.cached = False  # value đã qua cacheable() (dùng chung được cho các phiên chờ)
+        self.error: Optional[BaseException] = None
+
+
+class OCRCache:
+    def __init__(self, cache_dir: Optional[str] = _CACHE_DIR, ram_bytes: int = int(_RAM_MB * 1024 * 1024),
+                 disk_bytes: int = int(_DISK_MB * 1024 * 1024), ttl: float = _TTL):
+        self.cache_dir = cache_dir
+        self.ram_bytes = ram_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ram: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, size, value)
+        self._ram_used = 0
+        self._disk_index: "OrderedDict[str, int]" = OrderedDict()  # key -> size, theo thứ tự truy cập
+        self._disk_used = 0
+        self._inflight: Dict[str, _Flight] = {}
+        self._stats = {"hits_ram": 0, "hits_disk": 0, "misses": 0, "coalesced": 0,
+                       "evictions_ram": 0, "evictions_disk": 0, "expired": 0}
+        if cache_dir and disk_bytes > 0:
+            self._load_disk_index()
+
+    # ----------------- Public API -----------------
+    def get_or_compute(self, key: str, compute: Callable[[], Any],
+                       cacheable: Callable[[Any], bool] = lambda v: True,
+                       ttl_for: Optional[Callable[[Any], float]] = None) -> Any:
+        """ttl_for(value): TTL riêng cho từng kết quả (None = self.ttl cho mọi kết quả)."""
+        with self._lock:
+            value = self._ram_get(key)
+            if value is not None:
+                self._stats["hits_ram"] += 1
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.cached:
+                return flight.value
+            # kết quả riêng của phiên dẫn (vd: job của họ bị huỷ, lỗi tạm thời) -> tự tính
+            return compute()
+
+        try:
+            value, expires_at = self._disk_get(key)
+            if value is not None:
+                with self._lock:
+                    self._stats["hits_disk"] += 1
+                    self._ram_put(key, value, expires_at - time.time())
+                flight.cached = True
+            else:
+                with self._lock:
+                    self._stats["misses"] += 1
+                value = compute()
+                if cacheable(value):
+                    ttl = self.ttl if ttl_for is None else min(self.ttl, ttl_for(value))
+                    with self._lock:
+                        self._ram_put(key, value, ttl)
+                    self._disk_put(key, value, ttl)
+                    flight.cached = True
+            flight.value = value
+            return value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out.update(ram_entries=len(self._ram), ram_bytes=self._ram_used,
+                       disk_entries=len(self._disk_index), disk_bytes=self._disk_used)
+        return out
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ram.clear()
+            self._ram_used = 0
+            keys = list(self._disk_index)
+            self._disk_index.clear()
+            self._disk_used = 0
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    # ----------------- RAM tier (gọi khi đã giữ lock) -----------------
+    def _ram_get(self, key: str):
+        entry = self._ram.get(key)
+        if entry is None:
+            return None
+        expires_at, size, value = entry
+        if expires_at < time.time():
+            del self._ram[key]
+            self._ram_used -= size
+            self._stats["expired"] += 1
+            return None
+        self._ram.move_to_end(key)
+        return value
+
+    def _ram_put(self, key: str, value: Any, ttl: float) -> None:
+        if self.ram_bytes <= 0 or ttl <= 0:
+            return
+        size = len(json.dumps(value, default=str))
+        if size > self.ram_bytes:
+            return
+        old = self._ram.pop(key, None)
+        if old is not None:
+            self._ram_used -= old[1]
+        self._ram[key] = (time.time() + ttl, size, value)
+        self._ram_used += size
+        while self._ram_used > self.ram_bytes and self._ram:
+            _, (_, s, _) = self._ram.popitem(last=False)
+            self._ram_used -= s
+            self._stats["evictions_ram"] += 1
+
+    # ----------------- Disk tier -----------------
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _load_disk_index(self) -> None:
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk_index[key] = size
+            self._disk_used += size
+
+    def _disk_get(self, key: str):
+        """-> (value, expires_at); không có / hết hạn -> (None, 0)."""
+        if not self.cache_dir or key not in self._disk_index:
+            return None, 0.0
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self._disk_drop(key)
+            return None, 0.0
+        expires_at = payload.get("expires_at", 0)
+        if expires_at < time.time():
+            with self._lock:
+                self._stats["expired"] += 1
+                self._disk_drop(key)
+            return None, 0.0
+        try:
+            os.utime(path)  # cập nhật thời điểm truy cập cho LRU khi nạp lại index
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._disk_index:
+                self._disk_index.move_to_end(key)
+        return payload.get("value"), expires_at
+
+    def _disk_put(self, key: str, value: Any, ttl: float) -> None:
+        if not self.cache_dir or self.disk_bytes <= 0 or ttl <= 0:
+            return
+        data = json.dumps({"expires_at": time.time() + ttl, "value": value},
+                          ensure_ascii=False, default=str).encode("utf-8")
+        if len(data) > self.disk_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_used -= self._disk_index.pop(key, 0)
+            self._disk_index[key] = len(data)
+            self._disk_used += len(data)
+            while self._disk_used > self.disk_bytes and self._disk_index:
+                old_key = next(iter(self._disk_index))
+                self._disk_drop(old_key)
+                self._stats["evictions_disk"] += 1
+
+    def _disk_drop(self, key: str) -> None:
+        self._disk_used -= self._disk_index.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+_default_cache: Optional[OCRCache] = None
+_default_lock = threading.Lock()
+
+
+def get_cache() -> OCRCache:
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = OCRCache()
+        return _default_cache
+
+
+def _cacheable(r) -> bool:
+    if r and r.get("no_text"):
+        return True  # engine đã trả lời "không có chữ" -> gọi lại cũng vậy, không trả phí lần nữa (TTL ngắn)
+    return bool(r and r.get("success") and not r.get("failed_pages") and not r.get("degraded"))
+
+
+def _ttl_for(r) -> float:
+    return _NO_TEXT_TTL if r and r.get("no_text") else _TTL
+
+
+def cached_result(data: bytes, compute: Callable[[], Dict[str, Any]], **params) -> Dict[str, Any]:
+    """
+    Bọc 1 hàm OCR trả về {"success": ..., ...}: chỉ cache kết quả thành công trọn vẹn
+    (không cache khi còn trang lỗi - "failed_pages", hoặc kết quả tạm khi Gemini lỗi - "degraded");
+    riêng kết quả "no_text" (ảnh không có chữ) cũng được cache, nhưng chỉ OCR_CACHE_NO_TEXT_TTL giây.
+    Tắt toàn bộ bằng OCR_CACHE=0.
+    """
+    if not _ENABLED:
+        return compute()
+    key = make_key(data, **params)
+    return get_cache().get_or_compute(key, compute, cacheable=_cacheable, ttl_for=_ttl_for)
+
+
+def cache_stats() -> Dict[str, Any]:
+    return get_cache().stats()
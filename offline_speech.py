@@ -0,0 +1,174 @@
+# offline_speech.py — Nhận diện giọng nói chạy hoàn toàn trên CPU, không cần mạng
+# - "vosk":    Kaldi (vosk), model nhỏ cho vi / en; giải mã streaming theo khối 0.25s
+# - "whisper": faster-whisper (CTranslate2) int8 trên CPU; segment được sinh dần (generator)
+# - Model nạp 1 lần / process (theo engine + ngôn ngữ), dùng chung giữa các thread
+# - Thư viện (vosk, faster-whisper / ctranslate2) chỉ được import khi dùng engine tương ứng lần đầu
+# - Không bao giờ tải model qua mạng: vosk cần thư mục model có sẵn (VOSK_MODEL_VI / VOSK_MODEL_EN)
+# - Ghi nhận real-time factor (RTF = thời gian giải mã / độ dài âm thanh) qua metrics + stats()
+#
+# Cấu hình:
+#   VOSK_MODEL_VI / VOSK_MODEL_EN   đường dẫn thư mục model vosk (bắt buộc cho ngôn ngữ tương ứng)
+#   WHISPER_MODEL                   đường dẫn model faster-whisper (CTranslate2) hoặc tên model đã có trong cache
+#                                   của huggingface (mặc định "small"; chỉ đọc cache, không tải)
+#   SPEECH_OFFLINE_WORKERS          số đoạn giải mã song song (mặc định: nửa số core)
+from io import BytesIO
+from typing import Callable, Dict, Tuple
+import importlib.util
+import json
+import os
+import threading
+import time
+import wave
+
+import metrics
+
+ENGINES = ("vosk", "whisper")
+WORKERS = int(os.getenv("SPEECH_OFFLINE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+_VOSK_PATHS = {"vi": os.getenv("VOSK_MODEL_VI"), "en": os.getenv("VOSK_MODEL_EN")}
+_VOSK_ENV = {"vi": "VOSK_MODEL_VI", "en": "VOSK_MODEL_EN"}
+_VOSK_BLOCK = 8000  # byte PCM mỗi lần AcceptWaveform (0.25s ở 16 kHz mono 16-bit)
+_WHISPER_MODEL = os.getenv("WHISPER_MODEL", "small")
+
+_models: Dict[Tuple[str, str], object] = {}
+_models_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _installed(module: str) -> bool:
+    """Có thư viện hay không, không import (vosk / ctranslate2 nạp chậm và tốn RAM)."""
+    try:
+        return importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def available() -> Dict[str, bool]:
+    """Engine dùng được ngay: đã cài thư viện (vosk: có thêm ít nhất 1 thư mục model)."""
+    return {"vosk": _installed("vosk") and any(_VOSK_PATHS.values()),
+            "whisper": _installed("faster_whisper")}
+
+
+def _new_vosk(lang: str):
+    try:
+        import vosk
+    except ImportError:
+        raise RuntimeError("Chưa cài vosk (pip install vosk).")
+    path = _VOSK_PATHS[lang]
+    if not path:
+        # vosk.Model(lang=...) sẽ tải model qua mạng -> không dùng, bắt buộc model có sẵn trên máy
+        raise RuntimeError(f"Chưa có model vosk cho '{lang}': đặt {_VOSK_ENV[lang]} = thư mục model đã tải sẵn.")
+    if not os.path.isdir(path):
+        raise RuntimeError(f"{_VOSK_ENV[lang]}={path} không phải thư mục model vosk.")
+    vosk.SetLogLevel(-1)
+    return vosk.Model(path)
+
+
+def _new_whisper():
+    try:
+        from faster_whisper import WhisperModel
+    except ImportError:
+        raise RuntimeError("Chưa cài faster-whisper (pip install faster-whisper).")
+    cores = os.cpu_count() or 2
+    # local_files_only: chỉ dùng model đã có (đường dẫn / cache), không tải từ huggingface
+    return WhisperModel(_WHISPER_MODEL, device="cpu", compute_type="int8", cpu_threads=max(1, cores // WORKERS),
+                        num_workers=WORKERS, local_files_only=True)
+
+
+def _lang(bcp47: str) -> str:
+    return "en" if bcp47.lower().startswith("en") else "vi"
+
+
+def _load(engine: str, lang: str):
+    """Model dùng chung cho cả process; nạp lần đầu dưới lock (các thread khác chờ, không nạp trùng)."""
+    # Whisper đa ngôn ngữ -> 1 model cho mọi ngôn ngữ
+    key = (engine, lang if engine == "vosk" else "*")
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            with metrics.span(f"speech.{engine}.load"):
+                if engine == "vosk":
+                    model = _new_vosk(lang)
+                elif engine == "whisper":
+                    model = _new_whisper()
+                else:
+                    raise ValueError(f"Engine không hỗ trợ: {engine}")
+            _models[key] = model
+    return model
+
+
+def warmup(engine: str, languages=("vi-VN", "en-US")) -> None:
+    """Nạp sẵn model (gọi lúc khởi động, chạy nền); vosk bỏ qua ngôn ngữ chưa cấu hình model."""
+    for lang in languages:
+        if engine == "vosk" and not _VOSK_PATHS[_lang(lang)]:
+            continue
+        _load(engine, _lang(lang))
+
+
+def _pcm(wav_bytes: bytes) -> bytes:
+    with wave.open(BytesIO(wav_bytes)) as w:
+        return w.readframes(w.getnframes())
+
+
+def _vosk_decode(pcm: bytes, lang: str) -> str:
+    import vosk
+    rec = vosk.KaldiRecognizer(_load("vosk", lang), 16000)
+    parts = []
+    for i in range(0, len(pcm), _VOSK_BLOCK):
+        if rec.AcceptWaveform(pcm[i:i + _VOSK_BLOCK]):
+            parts.append(json.loads(rec.Result()).get("text", ""))
+    parts.append(json.loads(rec.FinalResult()).get("text", ""))
+    return " ".join(p for p in parts if p)
+
+
+def _whisper_decode(pcm: bytes, lang: str) -> str:
+    import numpy as np
+    audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    segments, _ = _load("whisper", lang).transcribe(audio, language=lang, beam_size=1,
+                                                   condition_on_previous_text=False)
+    return " ".join(s.text.strip() for s in segments if s.text.strip())
+
+
+_DECODERS = {"vosk": _vosk_decode, "whisper": _whisper_decode}
+
+
+def _record(engine: str, audio_s: float, decode_s: float) -> None:
+    with _stats_lock:
+        st = _stats.setdefault(engine, {"calls": 0, "audio_s": 0.0, "decode_s": 0.0})
+        st["calls"] += 1
+        st["audio_s"] += audio_s
+        st["decode_s"] += decode_s
+    metrics.incr("speech_audio_seconds_total", audio_s, engine=engine)
+    metrics.incr("speech_decode_seconds_total", decode_s, engine=engine)
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    """Số liệu cộng dồn theo engine; rtf < 1 = nhanh hơn thời gian thực."""
+    with _stats_lock:
+        out = {k: dict(v) for k, v in _stats.items()}
+    for st in out.values():
+        st["rtf"] = round(st["decode_s"] / st["audio_s"], 4) if st["audio_s"] else 0.0
+    return out
+
+
+def recognizer(engine: str) -> Callable[[bytes, str], str]:
+    """Recognizer (wav_bytes 16 kHz mono, ngôn ngữ BCP-47) -> text, dùng được cho speech_to_text(recognizer=...)."""
+    if engine not in _DECODERS:
+        raise ValueError(f"Engine không hỗ trợ: {engine}")
+    decode = _DECODERS[engine]
+
+    def _recognize(wav_bytes: bytes, language: str) -> str:
+        lang = _lang(language)
+        _load(engine, lang)  # thời gian nạp model không tính vào RTF
+        pcm = _pcm(wav_bytes)
+        t0 = time.perf_counter()
+        with metrics.span(f"speech.{engine}.decode"):
+            text = decode(pcm, lang)
+        _record(engine, len(pcm) / 32000.0, time.perf_counter() - t0)
+        return text
+
+    return _recognize
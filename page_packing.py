@@ -0,0 +1,164 @@
+# page_packing.py — Gửi nhiều trang trong 1 request Gemini để giảm số round trip
+# - Gom K trang liên tiếp vào 1 request; K bị giới hạn bởi số trang tối đa, ngân sách byte ảnh và ngân sách token
+# - Mỗi ảnh đi kèm nhãn <<<PAGE i>>>, prompt yêu cầu trả lời đúng theo nhãn đó
+# - Tách câu trả lời theo nhãn + kiểm tra (đủ trang, đúng thứ tự, không trùng);
+#   trang nào không tách được thì gửi lại riêng từng trang
+from io import BytesIO
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+import math
+import os
+import re
+
+from PIL import Image
+
+from concurrent_pages import ordered_map
+import gemini_transport
+import metrics
+
+# Số trang tối đa mỗi request; 1 = tắt (mỗi trang 1 request như cũ)
+DEFAULT_PACK_PAGES = int(os.getenv("GEMINI_PACK_PAGES", "1"))
+# Tổng dung lượng ảnh mỗi request (inline request của Gemini giới hạn ~20MB)
+PACK_BYTE_BUDGET = int(float(os.getenv("GEMINI_PACK_BUDGET_KB", "4000")) * 1024)
+# Token ước lượng mỗi request (ảnh vào + text ra), giữ phần trả lời không bị cắt ở giới hạn output
+PACK_TOKEN_BUDGET = int(os.getenv("GEMINI_PACK_TOKEN_BUDGET", "12000"))
+# Ước lượng số token text trả về cho 1 trang tài liệu dày
+OUT_TOKENS_PER_PAGE = int(os.getenv("GEMINI_PACK_OUT_TOKENS_PER_PAGE", "1500"))
+
+_MARKER = "<<<PAGE {}>>>"
+_MARKER_RE = re.compile(r"^[ \t]*<<<PAGE[ \t]+(\d+)>>>[ \t]*$", re.MULTILINE)
+
+_PACK_PROMPT = (
+    "You will receive {n} page images, each preceded by a label of the form <<<PAGE k>>>.\n"
+    "Task for every page: {task}\n"
+    "Output format (strict): for k = 1..{n} in order, write the label <<<PAGE k>>> on its own line, "
+    "then that page's result. Write every label exactly once, even if the page is blank. "
+    "Do not add anything before the first label or any other commentary."
+)
+
+
+def image_tokens(data: bytes) -> int:
+    """Ước lượng token Gemini cho 1 ảnh: 258 token cho mỗi ô 768x768 (ảnh nhỏ <= 384px: 258)."""
+    try:
+        w, h = Image.open(BytesIO(data)).size
+    except Exception:
+        return 258 * 4
+    if max(w, h) <= 384:
+        return 258
+    return 258 * math.ceil(w / 768) * math.ceil(h / 768)
+
+
+def _groups(encoded: Iterable[Tuple[Any, Tuple[bytes, str]]], max_pages: int, byte_budget: int,
+            token_budget: int) -> Iterator[list]:
+    """
+    Gom (item, (bytes, mime)) liên tiếp thành nhóm không vượt các ngân sách (nhóm có ít nhất 1 trang).
+    Trang mã hoá lỗi (enc = None) đứng riêng 1 nhóm.
+    """
+    group, n_bytes, n_tokens = [], 0, 0
+    for item, enc in encoded:
+        if enc is None:
+            if group:
+                yield group
+                group, n_bytes, n_tokens = [], 0, 0
+            yield [(item, None)]
+            continue
+        data, mime = enc
+        tokens = image_tokens(data) + OUT_TOKENS_PER_PAGE
+        if group and (len(group) >= max_pages or n_bytes + len(data) > byte_budget
+                      or n_tokens + tokens > token_budget):
+            yield group
+            group, n_bytes, n_tokens = [], 0, 0
+        group.append((item, (data, mime)))
+        n_bytes += len(data)
+        n_tokens += tokens
+    if group:
+        yield group
+
+
+def split_pages(text: str, n: int) -> List[Optional[str]]:
+    """
+    Tách câu trả lời theo nhãn <<<PAGE k>>>. Trả list n phần tử; trang thiếu nhãn -> None.
+    Nhãn trùng, ngoài khoảng 1..n hoặc sai thứ tự -> toàn bộ None (không tin được cách chia).
+    Trang đứng ngay trước 1 trang thiếu nhãn cũng bị bỏ (có thể đã lẫn nội dung của trang thiếu).
+    """
+    marks = [(int(m.group(1)), m.start(), m.end()) for m in _MARKER_RE.finditer(text or "")]
+    nums = [k for k, _, _ in marks]
+    if not marks or nums != sorted(set(nums)) or nums[0] < 1 or nums[-1] > n:
+        return [None] * n
+    out: List[Optional[str]] = [None] * n
+    for i, (k, _, end) in enumerate(marks):
+        stop = marks[i + 1][1] if i + 1 < len(marks) else len(text)
+        out[k - 1] = text[end:stop].strip()
+    missing = [k for k in range(1, n) if out[k] is None]
+    for k in missing:
+        out[k - 1] = None
+    return out
+
+
+def request_group(encoded: List[Tuple[bytes, str]], task: str, model: Optional[str] = None,
+                  client=None) -> List[Optional[str]]:
+    """Gửi 1 request gồm nhiều trang; trả text từng trang (None = trang không tách được)."""
+    contents: List[Any] = [_PACK_PROMPT.format(n=len(encoded), task=task)]
+    for k, (data, mime) in enumerate(encoded, start=1):
+        contents.append(_MARKER.format(k))
+        contents.append(gemini_transport.bytes_part(data, mime))
+    with metrics.span("gemini.packed_request"):
+        resp = gemini_transport.generate_content(contents, model=model, client=client)
+    pages = split_pages(gemini_transport.response_text(resp), len(encoded))
+    missing = sum(p is None for p in pages)
+    metrics.incr("gemini_packed_pages_total", len(encoded) - missing, status="ok")
+    if missing:
+        metrics.incr("gemini_packed_pages_total", missing, status="split_failed")
+    return pages
+
+
+def packed_ordered_map(items: Iterable[Any],
+                       encode: Callable[[Any], Tuple[bytes, str]],
+                       single: Callable[[Any], Any],
+                       task: str,
+                       wrap: Callable[[str], Any] = lambda text: text,
+                       model: Optional[str] = None,
+                       client=None,
+                       max_pages: Optional[int] = None,
+                       byte_budget: int = PACK_BYTE_BUDGET,
+                       token_budget: int = PACK_TOKEN_BUDGET,
+                       max_inflight: Optional[int] = None) -> Iterator[Tuple[Any, Optional[Exception]]]:
+    """
+    Như ordered_map(single, items) nhưng gom nhiều trang vào 1 request.
+    encode(item) -> (bytes, mime) để gửi; wrap(text) -> kết quả 1 trang khi đọc được từ request gộp;
+    single(item) -> kết quả khi gửi riêng (trang không tách được, Gemini lỗi, hoặc nhóm chỉ có 1 trang).
+    Yield (kết quả, lỗi) theo đúng thứ tự items; tối đa `max_inflight` request chạy song song.
+    """
+    k = DEFAULT_PACK_PAGES if max_pages is None else max_pages
+    if k <= 1:
+        yield from ordered_map(single, items, max_inflight=max_inflight)
+        return
+
+    def _safe_single(item):
+        try:
+            return single(item), None
+        except Exception as e:
+            return None, e
+
+    def _run(group):
+        if len(group) == 1:
+            return [_safe_single(group[0][0])]
+        try:
+            texts = request_group([enc for _, enc in group], task, model=model, client=client)
+        except Exception:
+            # GeminiUnavailable hoặc lỗi request -> để single() tự xử lý (retry riêng / Tesseract)
+            texts = [None] * len(group)
+        return [(wrap(t), None) if t is not None else _safe_single(item)
+                for (item, _), t in zip(group, texts)]
+
+    def _encoded():
+        for item in items:
+            try:
+                enc = encode(item)
+            except Exception:
+                enc = None
+            yield item, enc
+
+    # _run không ném lỗi ra ngoài -> lỗi từng trang nằm trong res
+    for res, _ in ordered_map(_run, _groups(_encoded(), k, byte_budget, token_budget),
+                              max_inflight=max_inflight):
+        yield from res
@@ -1,9 +1,25 @@
-from pdf2image import convert_from_path
-import pytesseract
+from pdf2image import convert_from_path, convert_from_bytes, pdfinfo_from_path, pdfinfo_from_bytes
+import tess_pool
 from PIL import Image
-from io import BytesIO
+import page_packing
+from ocr_cache import cached_result, prompt_hash
+import metrics
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, List, Optional, Tuple, Union
+import itertools
+import numpy as np
 import os
 import math
+import threading
+
+# Lớp chữ có sẵn trong PDF số (xuất từ Word, phần mềm kế toán...) -> lấy thẳng, không cần OCR
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+except Exception:
+    pdfium = None
 
 # ⚙️ Đặt API key của bạn ở đây (đừng commit public)
 os.environ["GEMINI_API_KEY"] = "Your API Key Here"
@@ -14,82 +30,425 @@ try:
 except Exception:
     pass
 
-# ============ Tích hợp Gemini ============
-try:
-    from google import genai
-    from google.genai import types as gem_types
-    _gemini_available = True
-except Exception:
-    _gemini_available = False
+# ============ Tích hợp Gemini (qua lớp transport dùng chung) ============
+import gemini_transport
+from gemini_transport import GeminiUnavailable
+import upload_encoder
+
 
+# Trang lỗi được ghi chú tại chỗ với tiền tố này
+_PAGE_ERROR_PREFIX = "[Lỗi OCR trang"
 
-def _ensure_rgb_jpeg(pil_img: Image.Image, max_side: int = 1800, jpeg_quality: int = 85) -> bytes:
-    img = pil_img.convert("RGB")
-    w, h = img.size
-    scale = min(1.0, max_side / max(w, h))
-    if scale < 1.0:
-        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=jpeg_quality, optimize=True)
-    return buf.getvalue()
+_GEM_PROMPT = "Extract readable text (Vietnamese + English). Keep line breaks. Plain text only."
 
 
-def _gemini_ocr_page(pil_img: Image.Image, model: str = "gemini-2.5-flash") -> str:
-    if not _gemini_available:
-        raise RuntimeError("google-genai chưa được cài. Chạy: pip install -U google-genai")
-    client = genai.Client()
-    jpeg_bytes = _ensure_rgb_jpeg(pil_img)
+def _gemini_ocr_page(pil_img: Image.Image, model: str = "gemini-2.5-flash", client=None) -> str:
+    data, mime = upload_encoder.encode_for_upload(pil_img)
     parts = [
-        gem_types.Part.from_bytes(data=jpeg_bytes, mime_type="image/jpeg"),
-        "Extract readable text (Vietnamese + English). Keep line breaks. Plain text only."
+        gemini_transport.bytes_part(data, mime),
+        _GEM_PROMPT
     ]
-    resp = client.models.generate_content(model=model, contents=parts)
-    return (getattr(resp, "text", "") or "").strip()
+    resp = gemini_transport.generate_content(parts, model=model, client=client)
+    return gemini_transport.response_text(resp)
+
+
+def _gemini_or_tesseract_page(pil_img: Image.Image, model: str, client=None):
+    """OCR 1 trang bằng Gemini; API đang lỗi/tạm ngưng -> Tesseract. Trả (text, đường đã dùng)."""
+    try:
+        return _gemini_ocr_page(pil_img, model, client=client), "gemini"
+    except GeminiUnavailable:
+        return _tesseract_page(pil_img), "tesseract_fallback"
+
+
+# ============ Tesseract song song (process pool + shared memory) ============
+# Số worker mặc định: 1 = chạy tuần tự như cũ. Đặt PDF_OCR_WORKERS=0 để dùng toàn bộ CPU.
+_DEFAULT_WORKERS = int(os.getenv("PDF_OCR_WORKERS", "1"))
 
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
 
-def pdf_to_text(pdf_path: str, engine: str = "tesseract", model: str = "gemini-2.5-flash"):
+
+def _resolve_workers(workers: Optional[int]) -> int:
+    n = _DEFAULT_WORKERS if workers is None else workers
+    if n <= 0:
+        n = os.cpu_count() or 1
+    return max(1, n)
+
+
+def _init_worker():
+    # Mỗi process chạy 1 trang -> tắt OpenMP nội bộ của tesseract để không tranh CPU
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
     """
-    engine: 'tesseract' (local) | 'gemini' (Google AI Studio)
+    1 pool dùng chung giữa các lần gọi / các job chạy song song (tránh spawn lại process cho mỗi PDF),
+    cỡ = số worker lớn nhất từng yêu cầu; caller tự giới hạn số trang đang chạy của mình.
+    Cần pool lớn hơn -> tạo pool mới, pool cũ làm nốt việc đã nhận rồi tự đóng (không huỷ việc của job khác).
+    Gọi khi đã giữ _pool_lock.
     """
+    global _pool, _pool_workers
+    if _pool is None or workers > _pool_workers:
+        old = _pool
+        _pool_workers = max(workers, _pool_workers)
+        _pool = ProcessPoolExecutor(max_workers=_pool_workers, initializer=_init_worker)
+        if old is not None:
+            old.shutdown(wait=False)
+    return _pool
+
+
+def _submit(workers: int, fn, *args):
+    # giữ lock tới khi submit xong: pool không bị thay / đóng giữa lúc lấy pool và lúc gửi việc
+    with _pool_lock:
+        return _get_pool(workers).submit(fn, *args)
+
+
+def _ocr_shm_page(shm_name: str, shape, lang: str) -> str:
+    """Chạy trong worker: đọc ảnh trang trực tiếp từ shared memory (không PNG, không pickle pixel)."""
+    shm = shared_memory.SharedMemory(name=shm_name)
     try:
-        # Poppler path (sửa đúng nếu bạn không thêm vào PATH)
-        poppler_path = r"C:\Program Files\poppler-25.07.0\Library\bin"
+        arr = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        img = Image.frombuffer("L", (shape[1], shape[0]), arr, "raw", "L", 0, 1)
+        text = tess_pool.image_to_string(img, lang=lang, config="--oem 1")
+        del img, arr
+        return text
+    finally:
+        shm.close()
 
-        temp_dir = "temp_pdf_images"
-        os.makedirs(temp_dir, exist_ok=True)
 
-        pages = convert_from_path(
-            pdf_path,
-            dpi=300 if engine == "tesseract" else 200,
-            fmt="png",
-            poppler_path=poppler_path
-        )
+def _page_to_shm(page: Image.Image) -> tuple:
+    gray = page.convert("L")
+    w, h = gray.size
+    shm = shared_memory.SharedMemory(create=True, size=w * h)
+    dst = np.ndarray((h, w), dtype=np.uint8, buffer=shm.buf)
+    dst[:] = np.asarray(gray)
+    del dst
+    return shm, (h, w)
 
-        all_text = ""
-        if engine == "tesseract":
-            for i, page in enumerate(pages):
-                image_path = os.path.join(temp_dir, f"page_{i+1}.png")
-                page.save(image_path, "PNG")
-                text = pytesseract.image_to_string(Image.open(image_path), lang="vie+eng")
-                all_text += f"\n\n--- Trang {i+1} ---\n{text}"
-        elif engine == "gemini":
-            for i, page in enumerate(pages, start=1):
-                text = _gemini_ocr_page(page, model)
-                all_text += f"\n\n--- Trang {i} ---\n{text}"
-        else:
-            return {"success": False, "message": f"Engine không hợp lệ: {engine}"}
 
-        # Dọn dẹp
+def _tesseract_pages_parallel(pages, workers: int, lang: str = "vie+eng"):
+    """
+    OCR các trang trên process pool, yield text theo đúng thứ tự trang.
+    Chỉ giữ tối đa 2*workers trang trong shared memory cùng lúc -> bộ nhớ không phụ thuộc số trang.
+    """
+    pending = deque()
+    max_inflight = workers * 2
+    try:
+        for page in pages:
+            shm, shape = _page_to_shm(page)
+            # lấy pool mỗi lần submit: job khác có thể đã thay pool lớn hơn (pool cũ không nhận việc mới)
+            pending.append((shm, _submit(workers, _ocr_shm_page, shm.name, shape, lang)))
+            del page
+            if len(pending) >= max_inflight:
+                yield _pop_result(pending)
+        while pending:
+            yield _pop_result(pending)
+    finally:
+        while pending:
+            shm, fut = pending.popleft()
+            fut.cancel()
+            _release_shm(shm)
+
+
+def _pop_result(pending: deque) -> str:
+    shm, fut = pending.popleft()
+    try:
+        with metrics.span("tesseract.pool_wait"):
+            return fut.result()
+    finally:
+        _release_shm(shm)
+
+
+def _release_shm(shm):
+    try:
+        shm.close()
+        shm.unlink()
+    except Exception:
+        pass
+
+
+# ============ Render PDF theo cửa sổ trang (streaming) ============
+# Poppler path (sửa đúng nếu bạn không thêm vào PATH)
+POPPLER_PATH = r"C:\Program Files\poppler-25.07.0\Library\bin"
+# Số trang render mỗi lần; 0 = render cả file một lần như cũ
+_STREAM_WINDOW = int(os.getenv("PDF_STREAM_WINDOW", "2"))
+
+
+def pdf_page_count(pdf_source: Union[str, bytes]) -> int:
+    if pdfium is not None:
         try:
-            for f in os.listdir(temp_dir):
-                os.remove(os.path.join(temp_dir, f))
-            os.rmdir(temp_dir)
+            pdf = pdfium.PdfDocument(pdf_source)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
         except Exception:
             pass
+    if isinstance(pdf_source, (bytes, bytearray)):
+        info = pdfinfo_from_bytes(pdf_source, poppler_path=POPPLER_PATH)
+    else:
+        info = pdfinfo_from_path(pdf_source, poppler_path=POPPLER_PATH)
+    return int(info.get("Pages", 0))
+
+
+def _page_ranges(page_numbers: List[int], window: int) -> List[Tuple[int, int]]:
+    """Gom các số trang (tăng dần) thành các đoạn liên tiếp, mỗi đoạn tối đa `window` trang (0 = không giới hạn)."""
+    ranges = []
+    for p in page_numbers:
+        if ranges and p == ranges[-1][1] + 1 and (window <= 0 or p - ranges[-1][0] < window):
+            ranges[-1] = (ranges[-1][0], p)
+        else:
+            ranges.append((p, p))
+    return ranges
+
+
+def _iter_pdf_pages(pdf_source: Union[str, bytes], dpi: int, window: int = _STREAM_WINDOW,
+                    page_numbers: Optional[List[int]] = None):
+    """
+    Yield từng trang (PIL) ngay khi render xong.
+    pdf_source: đường dẫn file hoặc bytes PDF (upload) — không cần ghi file tạm.
+    Mỗi lần chỉ render `window` trang bằng first_page/last_page nên RAM đỉnh gần như cố định.
+    page_numbers: chỉ render các trang này (đánh số từ 1, tăng dần); None = cả file.
+    """
+    from_bytes = isinstance(pdf_source, (bytes, bytearray))
+    opts = {"dpi": dpi, "fmt": "png", "poppler_path": POPPLER_PATH}
+
+    def _render(**kw):
+        with metrics.span("pdf.render"):
+            if from_bytes:
+                return convert_from_bytes(pdf_source, **opts, **kw)
+            return convert_from_path(pdf_source, **opts, **kw)
+
+    if page_numbers is not None:
+        ranges = _page_ranges(page_numbers, window)
+    elif window <= 0:
+        batch = _render()
+        while batch:
+            yield batch.pop(0)
+        return
+    else:
+        n_pages = pdf_page_count(pdf_source)
+        ranges = [(first, min(n_pages, first + window - 1)) for first in range(1, n_pages + 1, window)]
+
+    for first, last in ranges:
+        batch = _render(first_page=first, last_page=last)
+        while batch:
+            # pop để trang đã OCR xong được giải phóng ngay
+            yield batch.pop(0)
+
+
+# ============ Fast path: lớp chữ có sẵn ============
+_TEXT_LAYER = os.getenv("PDF_TEXT_LAYER", "1") != "0"
+# Trang có ít hơn số ký tự này (không tính khoảng trắng) coi như trang ảnh (vd: scan chỉ có số trang)
+_TEXT_MIN_CHARS = int(os.getenv("PDF_TEXT_MIN_CHARS", "25"))
+# Trang scan có lớp chữ nhỏ (dấu mộc, header đóng thêm, số trang...): ảnh phủ >= IMAGE_COVER diện tích trang
+# mà chữ chỉ phủ < TEXT_COVER -> vẫn OCR. Trang số có hình minh hoạ lớn kèm đoạn văn vẫn dùng lớp chữ.
+_SCAN_IMAGE_COVER = float(os.getenv("PDF_SCAN_IMAGE_COVER", "0.5"))
+_TEXT_MIN_COVER = float(os.getenv("PDF_TEXT_MIN_COVER", "0.03"))
+
+
+def _usable_text(text: str, text_cover: float = 1.0, image_cover: float = 0.0) -> bool:
+    """
+    Lớp chữ dùng được: đủ dài, không phải rác (font không có bảng Unicode -> ký tự thay thế / điều khiển)
+    và không phải trang scan chỉ có vài dòng chữ đóng thêm.
+    text_cover / image_cover: tỉ lệ diện tích trang phủ bởi chữ / ảnh (xem _page_cover).
+    """
+    chars = [c for c in text if not c.isspace()]
+    if len(chars) < _TEXT_MIN_CHARS:
+        return False
+    if image_cover >= _SCAN_IMAGE_COVER and text_cover < _TEXT_MIN_COVER:
+        return False
+    bad = sum(1 for c in chars if c == "\ufffd" or not c.isprintable())
+    return bad / len(chars) < 0.05
+
+
+def _clipped_area(bounds, width: float, height: float) -> float:
+    left, bottom, right, top = bounds
+    return max(0.0, min(right, width) - max(left, 0.0)) * max(0.0, min(top, height) - max(bottom, 0.0))
+
+
+def _page_cover(page, textpage) -> Tuple[float, float]:
+    """(tỉ lệ diện tích trang phủ bởi các dòng chữ, tỉ lệ phủ bởi ảnh), mỗi giá trị tối đa 1."""
+    width, height = page.get_size()
+    area = max(1.0, width * height)
+    text = sum(_clipped_area(textpage.get_rect(i), width, height) for i in range(textpage.count_rects()))
+    images = sum(_clipped_area(obj.get_bounds(), width, height)
+                 for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)))
+    return min(1.0, text / area), min(1.0, images / area)
+
+
+@metrics.timed("pdf.text_layer")
+def _text_layer_pages(pdf_source: Union[str, bytes]) -> Optional[List[Optional[str]]]:
+    """
+    Đọc lớp chữ của từng trang bằng pdfium (vài ms/trang).
+    Trả list theo trang: text nếu dùng được, None nếu trang cần OCR. Không đọc được -> None (OCR cả file).
+    """
+    if pdfium is None:
+        return None
+    try:
+        pdf = pdfium.PdfDocument(pdf_source)
+    except Exception:
+        return None
+    out = []
+    try:
+        for i in range(len(pdf)):
+            page = pdf[i]
+            try:
+                textpage = page.get_textpage()
+                text = textpage.get_text_bounded().replace("\r\n", "\n").strip()
+                # chỉ đo diện tích khi đã đủ ký tự (trang ảnh thuần không tốn thêm gì)
+                cover = _page_cover(page, textpage) if _usable_text(text) else (1.0, 0.0)
+                textpage.close()
+            except Exception:
+                text, cover = "", (1.0, 0.0)
+            finally:
+                page.close()
+            out.append(text if _usable_text(text, *cover) else None)
+    finally:
+        pdf.close()
+    return out
+
+
+@metrics.timed("tesseract.page")
+def _tesseract_page(page: Image.Image, lang: str = "vie+eng") -> str:
+    return tess_pool.image_to_string(page, lang=lang, config="--oem 1")
+
+
+def iter_pdf_text(pdf_source: Union[str, bytes], engine: str = "tesseract", model: str = "gemini-2.5-flash",
+                  workers: Optional[int] = None, window: int = _STREAM_WINDOW,
+                  max_inflight: Optional[int] = None, client=None, report: Optional[list] = None,
+                  text_layer: Optional[bool] = None, pack_pages: Optional[int] = None):
+    """
+    Streaming OCR: yield (số trang, text) theo thứ tự, trang đầu có kết quả trước khi render xong trang cuối.
+    Engine 'gemini' gửi song song tối đa `max_inflight` trang; trang lỗi được ghi chú, các trang khác giữ nguyên.
+    report: nếu truyền list vào, mỗi trang được thêm 1 dict {"page", "path"} cho biết đường xử lý đã dùng
+            ('text_layer' | 'tesseract' | 'gemini' | 'tesseract_fallback' | 'error').
+    text_layer: trang có lớp chữ dùng được thì lấy thẳng, chỉ render + OCR trang ảnh (None = PDF_TEXT_LAYER).
+    pack_pages: engine 'gemini' gộp tối đa bấy nhiêu trang vào 1 request (None = GEMINI_PACK_PAGES).
+    """
+    if engine not in ("tesseract", "gemini"):
+        raise ValueError(f"Engine không hợp lệ: {engine}")
+    layer = _text_layer_pages(pdf_source) if (_TEXT_LAYER if text_layer is None else text_layer) else None
+    ocr_pages = None if layer is None else [i for i, t in enumerate(layer, start=1) if t is None]
+    if ocr_pages == []:
+        texts = iter(())  # PDF số hoàn toàn: không render trang nào
+    else:
+        texts = _ocr_texts(pdf_source, engine, model, workers, window, max_inflight, client, ocr_pages,
+                           pack_pages)
+
+    for i in range(1, len(layer) + 1) if layer is not None else itertools.count(1):
+        if layer is not None and layer[i - 1] is not None:
+            text, path = layer[i - 1], "text_layer"
+        else:
+            try:
+                text, path = next(texts)
+            except StopIteration:
+                return
+        if report is not None:
+            report.append({"page": i, "path": path})
+        yield i, text
+
+
+def _ocr_texts(pdf_source, engine, model, workers, window, max_inflight, client, page_numbers, pack_pages):
+    """Render + OCR các trang cần OCR; trả generator (text, đường xử lý) theo thứ tự trang."""
+    pages = _iter_pdf_pages(pdf_source, dpi=300 if engine == "tesseract" else 200, window=window,
+                            page_numbers=page_numbers)
+
+    if engine == "tesseract":
+        n_workers = _resolve_workers(workers)
+        if n_workers > 1:
+            texts = ((t, "tesseract") for t in _tesseract_pages_parallel(pages, n_workers))
+        else:
+            texts = ((_tesseract_page(page), "tesseract") for page in pages)
+    else:
+        results = page_packing.packed_ordered_map(
+            pages,
+            encode=upload_encoder.encode_for_upload,
+            single=lambda page: _gemini_or_tesseract_page(page, model, client=client),
+            task=_GEM_PROMPT,
+            wrap=lambda text: (text, "gemini"),
+            model=model,
+            client=client,
+            max_pages=pack_pages,
+            max_inflight=max_inflight,
+        )
+        texts = (res if err is None else (f"{_PAGE_ERROR_PREFIX}: {err}]", "error") for res, err in results)
+    return texts
+
+
+def pdf_to_text(pdf_path: Union[str, bytes], engine: str = "tesseract", model: str = "gemini-2.5-flash",
+                workers: Optional[int] = None, window: int = _STREAM_WINDOW,
+                max_inflight: Optional[int] = None, text_layer: Optional[bool] = None,
+                pack_pages: Optional[int] = None, on_page: Optional[Callable[[int, str], None]] = None,
+                should_stop: Optional[Callable[[], bool]] = None):
+    """
+    engine: 'tesseract' (local) | 'gemini' (Google AI Studio)
+    pdf_path: đường dẫn file hoặc bytes PDF
+    workers: số process OCR song song cho engine 'tesseract' (None = PDF_OCR_WORKERS, <=0 = số CPU)
+    window: số trang render mỗi lần (0 = render cả file một lần)
+    max_inflight: số request Gemini song song (None = GEMINI_MAX_INFLIGHT)
+    text_layer: trang có lớp chữ sẵn thì lấy thẳng, không OCR (None = PDF_TEXT_LAYER, mặc định bật)
+    pack_pages: engine 'gemini' gộp tối đa bấy nhiêu trang vào 1 request (None = GEMINI_PACK_PAGES, 1 = tắt)
+    on_page(i, text): gọi ngay khi mỗi trang xong (tiến độ job); không gọi khi lấy kết quả từ cache
+    should_stop(): True -> dừng sau trang hiện tại, trả {"success": False, "cancelled": True, "text": phần đã có}
+    Kết quả thành công được cache theo nội dung PDF (xem ocr_cache). result["pages"] ghi đường xử lý từng trang.
+    """
+    if engine not in ("tesseract", "gemini"):
+        return {"success": False, "message": f"Engine không hợp lệ: {engine}"}
+    try:
+        if isinstance(pdf_path, (bytes, bytearray)):
+            data = bytes(pdf_path)
+        else:
+            with open(pdf_path, "rb") as f:
+                data = f.read()
+    except OSError as e:
+        return {"success": False, "message": f"Lỗi xử lý PDF: {e}"}
+
+    if engine == "gemini":
+        params = {"model": model, "prompt": prompt_hash(_GEM_PROMPT), "dpi": 200,
+                  "enc": upload_encoder.VERSION,
+                  "pack": page_packing.DEFAULT_PACK_PAGES if pack_pages is None else pack_pages}
+    else:
+        params = {"lang": "vie+eng", "dpi": 300}
+    use_layer = (_TEXT_LAYER if text_layer is None else text_layer) and pdfium is not None
+    with metrics.trace("pdf_to_text") as tr:
+        result = cached_result(data, lambda: _pdf_to_text(pdf_path, engine, model, workers, window, max_inflight,
+                                                          use_layer, pack_pages, on_page, should_stop),
+                               fn="pdf_to_text", engine=engine, text_layer=use_layer, **params)
+        return metrics.attach(result, tr)
+
+
+def _pdf_to_text(pdf_path, engine, model, workers, window, max_inflight, text_layer, pack_pages,
+                 on_page=None, should_stop=None):
+    try:
+        all_text, first_error = "", None
+        report = []
+        for i, text in iter_pdf_text(pdf_path, engine=engine, model=model, workers=workers,
+                                     window=window, max_inflight=max_inflight, report=report,
+                                     text_layer=text_layer, pack_pages=pack_pages):
+            all_text += f"\n\n--- Trang {i} ---\n{text}"
+            if first_error is None and report[-1]["path"] == "error":
+                first_error = text
+            if on_page is not None:
+                on_page(i, text)
+            if should_stop is not None and should_stop():
+                return {"success": False, "cancelled": True, "message": f"Đã huỷ sau {i} trang.",
+                        "text": all_text, "pages": report}
 
         if not all_text.strip():
             return {"success": False, "message": "Không phát hiện được chữ trong PDF."}
-        return {"success": True, "text": all_text}
+        failed_pages = [r["page"] for r in report if r["path"] == "error"]
+        if len(failed_pages) == len(report):
+            # mọi trang đều lỗi (vd: sai API key) -> text chỉ toàn ghi chú lỗi, không coi là thành công
+            return {"success": False, "message": f"Không xử lý được trang nào của PDF. {first_error}",
+                    "failed_pages": failed_pages, "pages": report}
+        result = {"success": True, "text": all_text, "pages": report}
+        if failed_pages:
+            result["failed_pages"] = failed_pages
+        if any(r["path"] == "tesseract_fallback" for r in report):
+            result["degraded"] = True
+        return result
 
     except Exception as e:
         return {"success": False, "message": f"Lỗi xử lý PDF: {e}"}
@@ -0,0 +1,249 @@
+# preprocess.py — Pipeline tiền xử lý ảnh dùng chung cho image_to_text và scan_to_text
+# - Pipeline = danh sách bước (stage) có tên, vd: Pipeline(["gray", "resize", "deskew", "clahe", ...])
+# - Buffer đầu ra được cấp theo từng thread, khoá theo (slot, shape) và dùng lại giữa các ảnh cùng kích thước
+#   (OpenCV dst=...); giữ tối đa PREP_MAX_BUFFERS buffer / thread (bỏ buffer ít dùng gần đây nhất).
+#   Bước theo từng điểm ảnh (threshold) ghi đè tại chỗ -> gần như không cấp phát mới cho mỗi ảnh
+# - CLAHE / kernel morphology tạo 1 lần rồi cache
+# - Bước không cần thiết được bỏ qua dựa trên thống kê rẻ của ảnh (ảnh thu nhỏ + 1 vùng cắt giữa ảnh)
+#
+# Lưu ý: kết quả run() là buffer của thread hiện tại, sẽ bị ghi đè ở lần run() kế tiếp trên cùng thread.
+#        Cần giữ lâu hơn thì .copy() (hoặc run(img, copy=True)).
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence
+import os
+import threading
+
+import cv2
+import numpy as np
+
+import metrics
+
+# Ngưỡng bỏ qua bước
+_NOISE_LEVEL = float(os.getenv("PREP_NOISE_LEVEL", "3"))        # p90 |ảnh - median| dưới mức này -> bỏ median
+_MIDTONE_MIN = float(os.getenv("PREP_MIDTONE_MIN", "0.08"))     # tỉ lệ điểm xám trung gian dưới mức này -> bỏ CLAHE
+
+# Deskew: ước lượng góc trên ảnh thu nhỏ (projection profile), chỉ warp 1 lần ở độ phân giải gốc
+_DESKEW_SIDE = int(os.getenv("SCAN_DESKEW_SIDE", "600"))            # cạnh dài ảnh dùng để ước lượng
+_DESKEW_MAX_ANGLE = float(os.getenv("SCAN_DESKEW_MAX_ANGLE", "15"))  # chỉ tìm góc trong [-max, max] độ
+_DESKEW_MIN_ANGLE = float(os.getenv("SCAN_DESKEW_MIN_ANGLE", "0.2"))  # nhỏ hơn -> bỏ qua, không warp
+
+# Số buffer giữ lại mỗi thread (vd: scan dùng 2 slot x 2 kích thước: trước / sau resize)
+_MAX_BUFFERS = int(os.getenv("PREP_MAX_BUFFERS", "6"))
+
+_local = threading.local()
+
+
+# ----------------- Buffer + object dùng lại (theo thread) -----------------
+def _buffer(slot: str, shape) -> np.ndarray:
+    bufs = getattr(_local, "bufs", None)
+    if bufs is None:
+        bufs = _local.bufs = OrderedDict()
+    key = (slot, tuple(shape))
+    buf = bufs.get(key)
+    if buf is None:
+        buf = bufs[key] = np.empty(shape, dtype=np.uint8)
+        metrics.incr("preprocess_buffer_alloc_total")
+        while len(bufs) > _MAX_BUFFERS:
+            bufs.popitem(last=False)
+    else:
+        bufs.move_to_end(key)
+        metrics.incr("preprocess_buffer_reuse_total")
+    return buf
+
+
+def _clahe(clip: float = 3.0, tile: int = 8):
+    # Object CLAHE có trạng thái bên trong -> mỗi thread 1 object
+    cache = getattr(_local, "clahe", None)
+    if cache is None:
+        cache = _local.clahe = {}
+    obj = cache.get((clip, tile))
+    if obj is None:
+        obj = cache[(clip, tile)] = cv2.createCLAHE(clipLimit=clip, tileGridSize=(tile, tile))
+    return obj
+
+
+@lru_cache(maxsize=16)
+def _kernel(size: int) -> np.ndarray:
+    k = np.ones((size, size), np.uint8)
+    k.setflags(write=False)
+    return k
+
+
+# ----------------- Thống kê rẻ của ảnh -----------------
+def image_stats(gray: np.ndarray) -> Dict[str, float]:
+    """
+    midtones: tỉ lệ điểm ảnh xám trung gian (48..207) trên ảnh thu nhỏ — thấp = ảnh gần như đen/trắng sẵn.
+    noise: p90 của |ảnh - median 3x3| trên vùng cắt 256x256 ở giữa (giữ nguyên độ phân giải để thấy nhiễu).
+    """
+    h, w = gray.shape[:2]
+    s = min(1.0, 256 / max(h, w))
+    small = cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA) if s < 1.0 else gray
+    hist = cv2.calcHist([small], [0], None, [256], [0, 256]).ravel()
+    midtones = float(hist[48:208].sum() / max(1, small.size))
+
+    cy, cx = h // 2, w // 2
+    crop = np.ascontiguousarray(gray[max(0, cy - 128):cy + 128, max(0, cx - 128):cx + 128])
+    noise = float(np.percentile(cv2.absdiff(crop, cv2.medianBlur(crop, 3)), 90)) if crop.size else 0.0
+    return {"midtones": midtones, "noise": noise, "mean": float(small.mean())}
+
+
+class _Ctx:
+    def __init__(self, params: Dict):
+        self.params = params
+        self.stats: Optional[Dict[str, float]] = None
+        self.skipped: List[str] = []
+        self._owned = set()
+
+    def out(self, src: np.ndarray, shape=None, inplace: bool = False) -> np.ndarray:
+        """Buffer đích cho 1 bước: ghi đè src nếu được phép và src là buffer của pipeline, không thì buffer còn lại."""
+        shape = src.shape if shape is None else tuple(shape)
+        if inplace and id(src) in self._owned and src.shape == shape:
+            return src
+        for slot in ("a", "b"):
+            buf = _buffer(slot, shape)
+            if buf is not src:
+                self._owned.add(id(buf))
+                return buf
+        raise RuntimeError("unreachable")
+
+
+# ----------------- Các bước -----------------
+def _gray(src, ctx):
+    if src.ndim == 2:
+        return src
+    code = cv2.COLOR_BGRA2GRAY if src.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+    return cv2.cvtColor(src, code, dst=ctx.out(src, src.shape[:2]))
+
+
+def _resize(src, ctx):
+    h, w = src.shape[:2]
+    max_side = max(h, w)
+    hi, lo, target = ctx.params.get("max_side", 2200), ctx.params.get("min_side", 900), ctx.params.get("upscale_to", 1300)
+    if max_side > hi:
+        s, interp = hi / max_side, cv2.INTER_AREA
+    elif max_side < lo:
+        s, interp = target / max(1, max_side), cv2.INTER_CUBIC
+    else:
+        return src
+    shape = (max(1, int(round(h * s))), max(1, int(round(w * s))))
+    return cv2.resize(src, (shape[1], shape[0]), dst=ctx.out(src, shape), interpolation=interp)
+
+
+def estimate_skew(gray: np.ndarray) -> float:
+    """
+    Góc nghiêng (độ) của dòng chữ. Chiếu các điểm mực lên trục dọc đã xoay; góc đúng cho histogram
+    "nhọn" nhất (tổng bình phương chênh lệch giữa các hàng lớn nhất). Tìm thô 1°, rồi mịn 0.1°.
+    """
+    h, w = gray.shape[:2]
+    s = min(1.0, _DESKEW_SIDE / max(h, w))
+    small = cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA) if s < 1.0 else gray
+    _, ink = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    if cv2.countNonZero(ink) > ink.size // 2:
+        ink = cv2.bitwise_not(ink)  # nền tối, chữ sáng
+    ys, xs = np.nonzero(ink)
+    if len(xs) < 100:
+        return 0.0
+    sh, sw = small.shape[:2]
+    xs = xs.astype(np.float32) - sw / 2
+    ys = ys.astype(np.float32) - sh / 2
+    n_bins = int(np.hypot(sh, sw)) + 2
+
+    def _score(deg: float) -> float:
+        r = np.deg2rad(deg)
+        proj = ys * np.float32(np.cos(r)) - xs * np.float32(np.sin(r))
+        hist = np.bincount((proj + n_bins / 2).astype(np.int32), minlength=n_bins).astype(np.float32)
+        d = np.diff(hist)
+        return float(np.dot(d, d))
+
+    best = max(np.arange(-_DESKEW_MAX_ANGLE, _DESKEW_MAX_ANGLE + 1e-6, 1.0), key=_score)
+    lo, hi = max(-_DESKEW_MAX_ANGLE, best - 1.0), min(_DESKEW_MAX_ANGLE, best + 1.0)
+    return float(max(np.arange(lo, hi + 1e-6, 0.1), key=_score))
+
+
+def _deskew(src, ctx):
+    angle = estimate_skew(src)
+    if abs(angle) < _DESKEW_MIN_ANGLE:
+        ctx.skipped.append("deskew")
+        return src
+    h, w = src.shape[:2]
+    # dòng chữ dốc xuống bên phải (góc dương, trục y hướng xuống) -> xoay ngược chiều kim đồng hồ
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(src, M, (w, h), dst=ctx.out(src), flags=cv2.INTER_CUBIC,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def _median(src, ctx):
+    # medianBlur không an toàn khi src == dst -> luôn ghi sang buffer khác
+    return cv2.medianBlur(src, 3, dst=ctx.out(src))
+
+
+def _clahe_stage(src, ctx):
+    return _clahe().apply(src, dst=ctx.out(src))
+
+
+def _otsu(src, ctx):
+    dst = ctx.out(src, inplace=True)
+    cv2.threshold(src, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=dst)
+    return dst
+
+
+def _adaptive_threshold(src, ctx):
+    return cv2.adaptiveThreshold(src, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                 ctx.params.get("block", 31), ctx.params.get("c", 10), dst=ctx.out(src))
+
+
+def _close(src, ctx):
+    return cv2.morphologyEx(src, cv2.MORPH_CLOSE, _kernel(2), dst=ctx.out(src), iterations=1)
+
+
+# name -> (hàm, điều kiện chạy theo thống kê ảnh; None = luôn chạy)
+STAGES: Dict[str, tuple] = {
+    "gray": (_gray, None),
+    "resize": (_resize, None),
+    "deskew": (_deskew, None),
+    "median": (_median, lambda st: st["noise"] >= _NOISE_LEVEL),
+    "clahe": (_clahe_stage, lambda st: st["midtones"] >= _MIDTONE_MIN),
+    "otsu": (_otsu, None),
+    "adaptive_threshold": (_adaptive_threshold, None),
+    "close": (_close, None),
+}
+
+
+def register(name: str, fn: Callable, when: Optional[Callable[[Dict[str, float]], bool]] = None) -> None:
+    """Thêm bước mới: fn(src, ctx) -> ndarray; ghi kết quả vào ctx.out(src) để dùng lại buffer."""
+    STAGES[name] = (fn, when)
+
+
+class Pipeline:
+    def __init__(self, stages: Sequence[str], skip: bool = True, **params):
+        unknown = [s for s in stages if s not in STAGES]
+        if unknown:
+            raise ValueError(f"Bước tiền xử lý không tồn tại: {unknown}")
+        self.stages = list(stages)
+        self.skip = skip
+        self.params = params
+
+    def run(self, img: np.ndarray, copy: bool = False) -> np.ndarray:
+        """
+        Ảnh BGR/BGRA/gray uint8 -> ảnh đã xử lý. Không sửa `img`.
+        Mặc định trả buffer của thread (bị ghi đè ở lần run() kế tiếp trên cùng thread, xem lưu ý đầu file);
+        copy=True -> trả bản sao riêng, giữ được lâu / chuyển sang thread khác.
+        """
+        ctx = _Ctx(self.params)
+        needs_stats = self.skip and any(STAGES[s][1] is not None for s in self.stages)
+        arr = img
+        for name in self.stages:
+            fn, when = STAGES[name]
+            if needs_stats and ctx.stats is None and arr.ndim == 2:
+                ctx.stats = image_stats(arr)  # 1 lần, trên ảnh xám đầu tiên (trước khi nhị phân hoá)
+            if when is not None and ctx.stats is not None:
+                if not when(ctx.stats):
+                    ctx.skipped.append(name)
+                    metrics.incr("preprocess_stage_skipped_total", stage=name)
+                    continue
+            with metrics.span(f"preprocess.{name}"):
+                arr = fn(arr, ctx)
+        if copy and arr is not img:
+            arr = arr.copy()
+        return arr
@@ -0,0 +1,161 @@
+# region_fallback.py — Chỉ gửi Gemini những vùng Tesseract đọc kém, thay vì cả ảnh
+# - Gom từ của image_to_data thành dòng (block, par, line); độ tin cậy dòng = conf trung bình theo độ dài từ
+# - Các dòng kém liền nhau trong cùng block -> 1 vùng; cắt vùng từ ảnh gốc (có lề)
+# - Các vùng gộp vào ít request Gemini nhất có thể (page_packing: nhãn <<<PAGE k>>>, tách lỗi -> gửi riêng)
+# - Ghép lại: dòng tốt giữ text Tesseract, vùng kém thay bằng text Gemini, đúng thứ tự đọc của Tesseract
+# - Quá nhiều chữ kém (REGION_MAX_FRACTION) -> bỏ, để router gửi cả trang
+from typing import Any, Dict, List, Optional
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import gemini_transport
+import metrics
+import page_packing
+import upload_encoder
+
+CONF_THRESHOLD = float(os.getenv("REGION_CONF_THRESHOLD", "60"))
+MAX_FRACTION = float(os.getenv("REGION_MAX_FRACTION", "0.5"))
+MAX_PER_REQUEST = int(os.getenv("REGION_MAX_PER_REQUEST", "16"))
+_PAD = int(os.getenv("REGION_PAD_PX", "6"))
+# Vùng cắt nhỏ: ngân sách byte riêng cho từng vùng
+_CROP_BUDGET = int(float(os.getenv("REGION_CROP_BUDGET_KB", "60")) * 1024)
+
+_TASK = ("Transcribe the text in this cropped region of a document exactly as written "
+         "(Vietnamese + English). Keep line breaks. Plain text only, no commentary.")
+
+
+class TooManyRegions(ValueError):
+    """Phần lớn trang đọc kém -> gửi cả trang rẻ hơn / tốt hơn gửi từng vùng."""
+
+
+def lines_from_data(d: Dict[str, list]) -> List[Dict[str, Any]]:
+    """Dòng theo thứ tự đọc của Tesseract: text, conf, số ký tự, block, bbox (x0, y0, x1, y1)."""
+    lines: List[Dict[str, Any]] = []
+    index: Dict[tuple, Dict[str, Any]] = {}
+    for i, word in enumerate(d["text"]):
+        word = (word or "").strip()
+        if not word:
+            continue
+        try:
+            conf = float(d["conf"][i])
+        except (TypeError, ValueError):
+            conf = -1.0
+        key = (d["block_num"][i], d["par_num"][i], d["line_num"][i])
+        x0, y0 = int(d["left"][i]), int(d["top"][i])
+        x1, y1 = x0 + int(d["width"][i]), y0 + int(d["height"][i])
+        line = index.get(key)
+        if line is None:
+            line = index[key] = {"words": [], "block": key[0], "box": [x0, y0, x1, y1], "wconf": 0.0, "chars": 0}
+            lines.append(line)
+        line["words"].append(word)
+        b = line["box"]
+        b[0], b[1], b[2], b[3] = min(b[0], x0), min(b[1], y0), max(b[2], x1), max(b[3], y1)
+        if conf >= 0:
+            line["wconf"] += conf * len(word)
+        line["chars"] += len(word)
+    for line in lines:
+        line["text"] = " ".join(line.pop("words"))
+        line["conf"] = line.pop("wconf") / max(1, line["chars"])
+    return lines
+
+
+def low_conf_regions(lines: List[Dict[str, Any]], threshold: float = CONF_THRESHOLD) -> List[List[int]]:
+    """Nhóm chỉ số các dòng kém liền nhau (cùng block, khoảng cách dọc <= 1 chiều cao dòng)."""
+    regions: List[List[int]] = []
+    for i, line in enumerate(lines):
+        if line["conf"] >= threshold:
+            continue
+        if regions and regions[-1][-1] == i - 1:
+            prev = lines[i - 1]
+            gap = line["box"][1] - prev["box"][3]
+            if prev["block"] == line["block"] and gap <= prev["box"][3] - prev["box"][1]:
+                regions[-1].append(i)
+                continue
+        regions.append([i])
+    return regions
+
+
+def _region_box(lines, idx, shape):
+    h, w = shape[:2]
+    x0 = min(lines[i]["box"][0] for i in idx) - _PAD
+    y0 = min(lines[i]["box"][1] for i in idx) - _PAD
+    x1 = max(lines[i]["box"][2] for i in idx) + _PAD
+    y1 = max(lines[i]["box"][3] for i in idx) + _PAD
+    return max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+
+
+def _crop(img: np.ndarray, box) -> Image.Image:
+    x0, y0, x1, y1 = box
+    crop = img[y0:y1, x0:x1]
+    if crop.ndim == 2:
+        return Image.fromarray(crop)
+    code = cv2.COLOR_BGRA2RGB if crop.shape[2] == 4 else cv2.COLOR_BGR2RGB
+    return Image.fromarray(cv2.cvtColor(crop, code))
+
+
+def _join(lines: List[Dict[str, Any]], replaced: Dict[int, Optional[str]], regions: List[List[int]]) -> str:
+    """Ghép text theo thứ tự dòng; dòng trống giữa các block như layout.text_from_data."""
+    region_of = {i: r for r, idx in enumerate(regions) for i in idx}
+    out, last_block = [], None
+    for i, line in enumerate(lines):
+        r = region_of.get(i)
+        gem = replaced.get(r) if r is not None else None
+        if gem is not None and i != regions[r][0]:
+            continue  # dòng đã nằm trong text Gemini của vùng
+        if last_block is not None and line["block"] != last_block:
+            out.append("")
+        last_block = line["block"]
+        out.append(gem.strip() if gem is not None else line["text"])
+    return "\n".join(out).strip()
+
+
+def hybrid_ocr(img: np.ndarray, data: Dict[str, list], model: Optional[str] = None,
+               threshold: float = CONF_THRESHOLD) -> Dict[str, Any]:
+    """
+    img: ảnh gốc (BGR/BGRA/gray) cùng hệ toạ độ với `data` (image_to_data của Tesseract).
+    Trả {"text", "regions", "upload_bytes", "failed_regions"}; ném TooManyRegions khi nên gửi cả trang.
+    """
+    lines = lines_from_data(data)
+    regions = low_conf_regions(lines, threshold)
+    total = sum(line["chars"] for line in lines)
+    bad = sum(lines[i]["chars"] for idx in regions for i in idx)
+    if not regions:
+        return {"text": _join(lines, {}, []), "regions": 0, "upload_bytes": 0, "failed_regions": 0}
+    if total and bad / total > MAX_FRACTION:
+        raise TooManyRegions(f"{bad}/{total} ký tự có conf < {threshold:g}")
+
+    crops = [_crop(img, _region_box(lines, idx, img.shape)) for idx in regions]
+    encoded: Dict[int, tuple] = {}
+
+    def _encode(r):
+        if r not in encoded:
+            encoded[r] = upload_encoder.encode_for_upload(crops[r], budget=_CROP_BUDGET)
+        return encoded[r]
+
+    def _single(r):
+        data_, mime = _encode(r)
+        resp = gemini_transport.generate_content([gemini_transport.bytes_part(data_, mime), _TASK], model=model)
+        return gemini_transport.response_text(resp)
+
+    replaced: Dict[int, Optional[str]] = {}
+    failed, first_err = 0, None
+    with metrics.span("image.region_fallback"):
+        results = page_packing.packed_ordered_map(range(len(regions)), _encode, _single, _TASK, model=model,
+                                                  max_pages=MAX_PER_REQUEST, token_budget=10 ** 9)
+        for r, (text, err) in enumerate(results):
+            if err is not None or not (text or "").strip():
+                failed += 1
+                first_err = first_err or err
+                replaced[r] = None  # giữ text Tesseract của vùng
+            else:
+                replaced[r] = text
+    if failed == len(regions) and first_err is not None:
+        raise first_err  # Gemini lỗi hết (vd: tạm ngưng) -> router ghi nhận và xử lý như engine Gemini lỗi
+    sent = sum(len(data_) for data_, _ in encoded.values())
+    metrics.incr("region_fallback_regions_total", len(regions))
+    metrics.incr("region_fallback_upload_bytes_total", sent)
+    return {"text": _join(lines, replaced, regions), "regions": len(regions), "upload_bytes": sent,
+            "failed_regions": failed}
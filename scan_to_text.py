@@ -1,9 +1,9 @@
-# scan_to_text.py — Scan OCR: Gemini AI (mặc định) + Tesseract (tuỳ chọn)
-from typing import Dict, Any
-from io import BytesIO
+# scan_to_text.py — Scan OCR: chọn engine qua engine_router (Tesseract / Gemini flash; pro khi chọn)
+from typing import Dict, Any, Optional
 import numpy as np
 import cv2
-import pytesseract
+import tess_pool
+import preprocess
 
 # ===== Optional: tesseract path trên Windows =====
 try:
@@ -11,51 +11,27 @@ try:
 except:
     pass
 
-# ===== Gemini SDK (google.generativeai) =====
+# ===== Gemini (qua lớp transport dùng chung, API key lấy từ GEMINI_API_KEY) =====
 import os
-from PIL import Image
-import google.generativeai as genai
+import gemini_transport
+from gemini_transport import GeminiUnavailable
+import upload_encoder
 
-# Lấy API key từ ENV (ưu tiên .env nếu bạn dùng dotenv ở smart_ai_extract)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "Your API Key Here")
-genai.configure(api_key=GEMINI_API_KEY)
 _GEM_MODEL_DEFAULT = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
+from ocr_cache import cached_result, prompt_hash
+import engine_router
+import layout
+import metrics
+
+# Tăng khi thay đổi tiền xử lý/pipeline để cache cũ không còn khớp
+PREPROCESS_VERSION = "4"
+
 
 # ----------------- Helpers (Tesseract pipeline) -----------------
-def _resize(gray):
-    h, w = gray.shape[:2]
-    max_side = max(h, w)
-    if max_side > 2200:
-        s = 2200 / max_side
-        return cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
-    if max_side < 900:
-        s = 1300 / max(1, max_side)
-        return cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_CUBIC)
-    return gray
-
-def _deskew(gray):
-    coords = np.column_stack(np.where(gray < 200))
-    if len(coords) < 100:
-        return gray
-    angle = cv2.minAreaRect(coords)[-1]
-    if angle < -45:
-        angle = -(90 + angle)
-    else:
-        angle = -angle
-    (h, w) = gray.shape[:2]
-    M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
-    return cv2.warpAffine(gray, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-
-def _preprocess(gray):
-    gray = cv2.medianBlur(gray, 3)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    gray = clahe.apply(gray)
-    thr = cv2.adaptiveThreshold(gray, 255,
-                                cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
-                                31, 10)
-    thr = cv2.morphologyEx(thr, cv2.MORPH_CLOSE, np.ones((2, 2), np.uint8), 1)
-    return thr
+# resize -> deskew -> (median) -> (CLAHE) -> adaptive threshold -> close; bước trong ngoặc tự bỏ qua nếu không cần
+_PIPELINE = preprocess.Pipeline(["gray", "resize", "deskew", "median", "clahe", "adaptive_threshold", "close"],
+                                max_side=2200, min_side=900, upscale_to=1300)
 
 def _text_ratio(s):
     if not s:
@@ -67,9 +43,20 @@ def _ocr_tesseract(proc, lang_ui):
     tess_lang = "eng" if "eng" in lang_ui.lower() else "vie+eng"
     def _try(img, psm):
         cfg = f"--oem 1 --psm {psm}"
-        return pytesseract.image_to_string(img, lang=tess_lang, config=cfg).strip()
-
-    text = _try(proc, 6)
+        with metrics.span("tesseract.pass"):
+            return tess_pool.image_to_string(img, lang=tess_lang, config=cfg).strip()
+
+    # Trang nhiều khối / nhiều cột: OCR song song từng khối theo thứ tự đọc (PSM riêng cho từng khối)
+    text = ""
+    if layout.ENABLED:
+        with metrics.span("layout.detect"):
+            blocks = layout.detect_blocks(proc)
+        if len(blocks) >= layout.MIN_BLOCKS:
+            text = layout.text_from_data(layout.ocr_blocks(proc, tess_lang, blocks))
+    if _text_ratio(text) < 0.6:
+        t1 = _try(proc, 6)
+        if _text_ratio(t1) > _text_ratio(text):
+            text = t1
     if _text_ratio(text) < 0.6:
         inv = cv2.bitwise_not(proc)
         t2 = _try(inv, 6)
@@ -90,38 +77,66 @@ _GEM_PROMPT = (
 
 def _ocr_gemini_image(image_bytes: bytes, model_name: str = _GEM_MODEL_DEFAULT) -> str:
     try:
-        model = genai.GenerativeModel(model_name)
-        img = Image.open(BytesIO(image_bytes))
-        resp = model.generate_content([_GEM_PROMPT, img])
-        text = getattr(resp, "text", "") or ""
-        return text.strip()
+        data, mime = upload_encoder.encode_for_upload(image_bytes)
+        part = gemini_transport.bytes_part(data, mime)
+        resp = gemini_transport.generate_content([_GEM_PROMPT, part], model=model_name)
+        return engine_router.gemini_text(resp)
+    except (GeminiUnavailable, engine_router.NoText):
+        raise
     except Exception as e:
         raise RuntimeError(f"Gemini OCR error: {e}")
 
 # ----------------- Public API -----------------
-def scan_to_text(image_bytes: bytes, lang="Tiếng Việt", engine: str = "gemini", gem_model: str = None) -> Dict[str, Any]:
+def scan_to_text(image_bytes: bytes, lang="Tiếng Việt", engine: str = "auto", gem_model: str = None,
+                 policy: Optional[str] = None) -> Dict[str, Any]:
     """
-    Scan OCR:
-      - engine='gemini' (mặc định): dùng Google Gemini AI để nhận dạng chữ, không dịch/không tóm tắt.
-      - engine='tesseract': pipeline tiền xử lý + Tesseract fallback.
+    Scan OCR, engine chọn qua engine_router:
+      - engine='auto' (mặc định): rẻ trước — Tesseract (pipeline tiền xử lý), chưa đạt -> Gemini flash (pro chỉ khi chọn gem_model)
+        (thứ tự theo policy: cascade / adaptive, xem engine_router).
+      - engine='gemini': model gem_model, không dịch/không tóm tắt; Gemini lỗi/tạm ngưng -> Tesseract.
+      - engine='tesseract': chỉ pipeline tiền xử lý + Tesseract.
+    Kết quả thành công được cache theo nội dung ảnh (xem ocr_cache).
     """
+    engines, policy = engine_router.resolve(engine, gem_model or (_GEM_MODEL_DEFAULT if engine == "gemini" else None),
+                                            policy)
+    # hybrid cần image_to_data (chỉ image_to_text có) -> bỏ khỏi chuỗi của scan
+    engines = [e for e in engines if engine_router.get_engine(e).kind != "hybrid"]
+    params = {"lang": lang, "prep": PREPROCESS_VERSION}
+    if any(e != "tesseract" for e in engines):
+        params.update(prompt=prompt_hash(_GEM_PROMPT), enc=upload_encoder.VERSION)
+    with metrics.trace("scan_to_text") as tr:
+        result = cached_result(image_bytes or b"", lambda: _scan_to_text(image_bytes, lang, engines, policy),
+                               fn="scan_to_text", engine=",".join(engines), policy=policy, **params)
+        return metrics.attach(result, tr)
+
+
+def _scan_to_text(image_bytes: bytes, lang: str, engines, policy: str) -> Dict[str, Any]:
+    def _run(eng):
+        if eng.kind == "gemini":
+            return _ocr_gemini_image(image_bytes, model_name=eng.model)
+        result = _scan_tesseract(image_bytes, lang)
+        if not result.get("success"):
+            raise RuntimeError(result.get("message"))
+        return result["text"]
+
+    try:
+        return engine_router.route(_run, engines, policy, pipeline="scan_to_text",
+                                   accept=lambda t: engine_router.good_text(t, 0.6))
+    except Exception as e:
+        return {"success": False, "message": f"Lỗi Scan OCR: {e}"}
+
+
+def _scan_tesseract(image_bytes: bytes, lang: str) -> Dict[str, Any]:
+    # ---- Tesseract branch (giữ nguyên để bạn có thể so sánh) ----
     try:
-        if engine.lower() == "gemini":
-            model = gem_model or _GEM_MODEL_DEFAULT
-            text = _ocr_gemini_image(image_bytes, model_name=model)
-            if not text.strip():
-                return {"success": False, "message": "Gemini không trả về nội dung văn bản."}
-            return {"success": True, "text": text}
-
-        # ---- Tesseract branch (giữ nguyên để bạn có thể so sánh) ----
-        np_img = np.frombuffer(image_bytes, np.uint8)
-        bgr = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
+        with metrics.span("scan.decode"):
+            np_img = np.frombuffer(image_bytes, np.uint8)
+            bgr = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
         if bgr is None:
             return {"success": False, "message": "Không đọc được ảnh camera"}
-        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-        gray = _resize(gray)
-        gray = _deskew(gray)
-        proc = _preprocess(gray)
+        with metrics.span("scan.preprocess"):
+            # buffer của thread (preprocess.py): chỉ dùng trong hàm này, lần run() sau trên thread sẽ ghi đè
+            proc = _PIPELINE.run(bgr)
 
         text = _ocr_tesseract(proc, lang)
         # tuỳ bạn có muốn giữ quality gate 80% nữa hay không
@@ -6,73 +6,136 @@ Trích xuất văn bản, nhận dạng các trường thông tin nếu có, và
 Kết quả được phản hồi cùng ngôn ngữ của tài liệu.
 """
 
-import tempfile
-from PIL import Image
-import google.generativeai as genai
 from dotenv import load_dotenv
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
 import os
+import re
 
-# ⚙️ Load API key từ .env hoặc biến môi trường
+from concurrent_pages import ordered_map
+from ocr_cache import cached_result, prompt_hash
+import gemini_transport
+from gemini_transport import GeminiUnavailable
+import metrics
+import upload_encoder
+
+# ⚙️ Load API key từ .env hoặc biến môi trường (gemini_transport đọc GEMINI_API_KEY)
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY", "Your API Key Here"))
+os.environ.setdefault("GEMINI_API_KEY", "Your API Key Here")
+
+# ==================== PROMPT TỰ ĐỘNG NHẬN DIỆN NGÔN NGỮ ====================
+_PROMPT = """
+You are an intelligent OCR and document analysis assistant.
+Read this image or PDF carefully.
+
+1️⃣ Automatically detect the document's language (English, Vietnamese, or others).
+2️⃣ Extract all readable text accurately.
+3️⃣ If the document is structured (e.g., ID, certificate, contract, invoice):
+    - Identify and clearly label the following information if found:
+      • Document Type
+      • Full Name / Organization
+      • Date of Birth / Date Issued
+      • Place of Birth / Issued by
+      • Reference Number / Serial Number
+    - Write a short summary explaining what the document represents.
+4️⃣ If the document is unstructured (like an article, paragraph, or note):
+    - Return the readable text as-is and provide a short summary.
+
+⚙️ Response Rules:
+- Respond entirely in the **same language as the document**.
+- Keep it clean, human-readable (no JSON, no numbered lists).
+- Preserve natural line breaks and formatting.
+- If the text mixes English and Vietnamese, respond in the **dominant language**.
+"""
+
+_MODEL_NAME = "gemini-2.5-flash"  # Dùng model mạnh để OCR chính xác hơn
+
+# ==================== PDF LỚN: CHIA KHỐI TRANG ====================
+# PDF nhiều trang / dung lượng lớn được tách thành các khối trang (trong RAM), phân tích song song,
+# rồi gộp text + các trường và chạy 1 lượt tóm tắt trên kết quả đã gộp.
+try:
+    from PyPDF2 import PdfReader, PdfWriter
+except Exception:
+    PdfReader = PdfWriter = None
+
+_CHUNK_PAGES = int(os.getenv("AI_PDF_CHUNK_PAGES", "10"))
+_INLINE_LIMIT = int(float(os.getenv("AI_PDF_INLINE_MB", "15")) * 2 ** 20)
+_CHUNK_RETRIES = int(os.getenv("AI_PDF_CHUNK_RETRIES", "2"))
+# Giới hạn số ký tự text gửi cho lượt tóm tắt (phần còn lại vẫn nằm trong kết quả)
+_SUMMARY_CHARS = int(os.getenv("AI_PDF_SUMMARY_CHARS", "60000"))
+
+_CHUNK_PROMPT = """
+You are an OCR and document analysis assistant. These are pages {first}-{last} of a longer document.
+1. Extract all readable text accurately, preserving natural line breaks.
+2. List any identifying fields you find (e.g. Document Type, Full Name / Organization, Date of Birth / Date Issued,
+   Place of Birth / Issued by, Reference Number / Serial Number), one per line as "Field: value".
+Keep the document's own language. Do not summarize.
+Answer in exactly this format:
+===TEXT===
+<extracted text>
+===FIELDS===
+<Field: value lines, or nothing>
+"""
+
+_SUMMARY_PROMPT = """
+You are an intelligent document analysis assistant. Below is the text extracted from all pages of one document,
+followed by the fields found on its pages.
+1. Detect the document's language and respond entirely in that language (dominant language if mixed).
+2. State the document type.
+3. List the key identifying information clearly labeled, one item per line, resolving duplicates.
+4. Write a short summary explaining what the document represents.
+Keep it clean and human-readable (no JSON, no numbered lists). Do not repeat the full text.
+
+--- FIELDS ---
+{fields}
+
+--- TEXT ---
+{text}
+"""
+
+_SECTION_RE = re.compile(r"^===(TEXT|FIELDS)===\s*$", re.MULTILINE)
+
 
 # 🧠 Hàm chính
 def analyze_document_ai(file_data: bytes, file_type: str = "image"):
     """
     Phân tích tài liệu bằng Google Gemini AI (tự động phát hiện ngôn ngữ).
     - file_type: "image" hoặc "pdf"
+    Kết quả thành công được cache theo nội dung file (xem ocr_cache).
     """
+    with metrics.trace("analyze_document_ai") as tr:
+        params = {"chunk": _CHUNK_PAGES, "chunk_prompt": prompt_hash(_CHUNK_PROMPT + _SUMMARY_PROMPT)} \
+            if file_type == "pdf" else {}
+        result = cached_result(file_data or b"", lambda: _analyze_document_ai(file_data, file_type),
+                               fn="analyze_document_ai", file_type=file_type, engine="gemini",
+                               model=_MODEL_NAME, prompt=prompt_hash(_PROMPT), enc=upload_encoder.VERSION,
+                               **params)
+        return metrics.attach(result, tr)
+
+
+def _analyze_document_ai(file_data: bytes, file_type: str):
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")  # Dùng model mạnh để OCR chính xác hơn
-
-        # ==================== PROMPT TỰ ĐỘNG NHẬN DIỆN NGÔN NGỮ ====================
-        prompt = """
-        You are an intelligent OCR and document analysis assistant.
-        Read this image or PDF carefully.
-
-        1️⃣ Automatically detect the document's language (English, Vietnamese, or others).
-        2️⃣ Extract all readable text accurately.
-        3️⃣ If the document is structured (e.g., ID, certificate, contract, invoice):
-            - Identify and clearly label the following information if found:
-              • Document Type
-              • Full Name / Organization
-              • Date of Birth / Date Issued
-              • Place of Birth / Issued by
-              • Reference Number / Serial Number
-            - Write a short summary explaining what the document represents.
-        4️⃣ If the document is unstructured (like an article, paragraph, or note):
-            - Return the readable text as-is and provide a short summary.
-
-        ⚙️ Response Rules:
-        - Respond entirely in the **same language as the document**.
-        - Keep it clean, human-readable (no JSON, no numbered lists).
-        - Preserve natural line breaks and formatting.
-        - If the text mixes English and Vietnamese, respond in the **dominant language**.
-        """
+        prompt = _PROMPT
 
         # ==================== XỬ LÝ FILE THEO LOẠI ====================
         if file_type == "image":
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                tmp.write(file_data)
-                tmp_path = tmp.name
-            img = Image.open(tmp_path)
-            response = model.generate_content([prompt, img])
-
+            data, mime = upload_encoder.encode_for_upload(file_data)
+            part = gemini_transport.bytes_part(data, mime)
         elif file_type == "pdf":
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(file_data)
-                tmp_path = tmp.name
-            pdf_data = open(tmp_path, "rb").read()
-            response = model.generate_content([
-                prompt,
-                {"mime_type": "application/pdf", "data": pdf_data}
-            ])
-
+            chunks = _split_pdf(file_data)
+            if chunks is not None:
+                return _analyze_pdf_chunks(chunks)
+            part = gemini_transport.bytes_part(file_data, "application/pdf")
         else:
             return {"success": False, "message": f"❌ Không hỗ trợ loại file: {file_type}"}
 
+        try:
+            response = gemini_transport.generate_content([prompt, part], model=_MODEL_NAME)
+        except GeminiUnavailable:
+            return _tesseract_fallback(file_data, file_type)
+
         # ==================== TRÍCH XUẤT KẾT QUẢ ====================
-        result_text = getattr(response, "text", "").strip()
+        result_text = gemini_transport.response_text(response)
         if not result_text:
             return {"success": False, "message": "⚠️ Không nhận được phản hồi từ Gemini AI."}
 
@@ -82,6 +145,156 @@ def analyze_document_ai(file_data: bytes, file_type: str = "image"):
         return {"success": False, "message": f"⚠️ Lỗi khi xử lý AI: {e}"}
 
 
+def _split_pdf(pdf_bytes: bytes) -> Optional[List[Tuple[int, int, bytes]]]:
+    """
+    PDF lớn -> [(trang đầu, trang cuối, bytes PDF của khối)], tách hoàn toàn trong RAM.
+    PDF nhỏ (ít trang và dưới ngưỡng inline) hoặc không có PyPDF2 -> None (gửi nguyên file như cũ).
+    """
+    if PdfReader is None:
+        return None
+    try:
+        reader = PdfReader(BytesIO(pdf_bytes))
+        n_pages = len(reader.pages)
+    except Exception:
+        return None
+    if n_pages <= _CHUNK_PAGES and len(pdf_bytes) <= _INLINE_LIMIT:
+        return None
+    # Khối nhỏ lại nếu trung bình mỗi khối vẫn vượt ngưỡng inline
+    per_chunk = max(1, min(_CHUNK_PAGES, int(n_pages * _INLINE_LIMIT / max(1, len(pdf_bytes)))))
+    chunks = []
+    with metrics.span("ai.pdf_split"):
+        for first in range(0, n_pages, per_chunk):
+            last = min(n_pages, first + per_chunk)
+            writer = PdfWriter()
+            for i in range(first, last):
+                writer.add_page(reader.pages[i])
+            buf = BytesIO()
+            writer.write(buf)
+            chunks.append((first + 1, last, buf.getvalue()))
+    return chunks
+
+
+def _parse_chunk(text: str) -> Tuple[str, Dict[str, List[str]]]:
+    """Tách câu trả lời của 1 khối thành (text, {trường: [giá trị]}). Không đúng định dạng -> cả câu trả lời là text."""
+    marks = list(_SECTION_RE.finditer(text))
+    sections = {}
+    for i, m in enumerate(marks):
+        end = marks[i + 1].start() if i + 1 < len(marks) else len(text)
+        sections[m.group(1)] = text[m.end():end].strip()
+    body = sections.get("TEXT", text.strip() if not marks else "")
+    fields: Dict[str, List[str]] = {}
+    for line in sections.get("FIELDS", "").splitlines():
+        key, sep, value = line.strip().lstrip("-•* ").partition(":")
+        if sep and key.strip() and value.strip():
+            fields.setdefault(key.strip(), []).append(value.strip())
+    return body, fields
+
+
+def _analyze_chunk(chunk: Tuple[int, int, bytes]) -> Tuple[str, Dict[str, List[str]]]:
+    first, last, data = chunk
+    prompt = _CHUNK_PROMPT.format(first=first, last=last)
+    with metrics.span("ai.pdf_chunk"):
+        resp = gemini_transport.generate_content([prompt, gemini_transport.bytes_part(data, "application/pdf")],
+                                                 model=_MODEL_NAME)
+    text = gemini_transport.response_text(resp)
+    if not text:
+        raise RuntimeError("Gemini không trả về nội dung.")
+    return _parse_chunk(text)
+
+
+def _analyze_pdf_chunks(chunks: List[Tuple[int, int, bytes]]):
+    """Phân tích các khối song song; khối lỗi được thử lại riêng (tối đa AI_PDF_CHUNK_RETRIES lượt)."""
+    results: Dict[int, Tuple[str, Dict[str, List[str]]]] = {}
+    errors: Dict[int, Exception] = {}
+    attempts = {i: 0 for i in range(len(chunks))}
+    pending = list(range(len(chunks)))
+    for _ in range(1 + _CHUNK_RETRIES):
+        for i, (res, err) in zip(pending, ordered_map(lambda i: _analyze_chunk(chunks[i]), pending)):
+            attempts[i] += 1
+            if err is None:
+                results[i] = res
+                errors.pop(i, None)
+            else:
+                errors[i] = err
+        # API đang tạm ngưng thì thử lại cũng vô ích
+        pending = [i for i in errors if not isinstance(errors[i], GeminiUnavailable)]
+        if not pending:
+            break
+        metrics.incr("ai_pdf_chunk_retries_total", len(pending))
+
+    degraded = False
+    texts, fields, report, failed_pages = [], {}, [], []
+    for i, (first, last, data) in enumerate(chunks):
+        label = f"{first}-{last}" if first != last else str(first)
+        entry = {"pages": label, "attempts": attempts[i]}
+        if i in results:
+            body, chunk_fields = results[i]
+            for key, values in chunk_fields.items():
+                merged = fields.setdefault(key, [])
+                merged += [v for v in values if v not in merged]
+            entry["status"] = "ok"
+        elif isinstance(errors[i], GeminiUnavailable):
+            body = _tesseract_chunk(data)
+            entry["status"] = "tesseract_fallback" if body else "error"
+            degraded = degraded or bool(body)
+        else:
+            body = ""
+            entry["status"] = "error"
+        if not body:
+            body = f"[Lỗi phân tích trang {label}: {errors.get(i)}]"
+            failed_pages += list(range(first, last + 1))
+        texts.append(f"--- Trang {label} ---\n{body}")
+        report.append(entry)
+
+    if not results and all(entry["status"] == "error" for entry in report):
+        # không khối nào phân tích được (vd: sai API key) -> text chỉ toàn ghi chú lỗi
+        first_err = next(iter(errors.values()), None)
+        return {"success": False, "message": f"⚠️ Lỗi khi xử lý AI: {first_err}", "chunks": report,
+                "failed_pages": failed_pages}
+
+    merged_text = "\n\n".join(texts)
+    summary = _summarize(merged_text, fields) if results else ""
+    if not summary and fields:
+        summary = "\n".join(f"{k}: {'; '.join(v)}" for k, v in fields.items())
+    result = {"success": True, "text": f"{summary}\n\n{merged_text}".strip(), "fields": fields, "chunks": report}
+    if failed_pages:
+        result["failed_pages"] = failed_pages
+    if degraded:
+        result["degraded"] = True
+    return result
+
+
+def _summarize(merged_text: str, fields: Dict[str, List[str]]) -> str:
+    """Lượt tóm tắt cuối trên text + trường đã gộp. Lỗi -> "" (vẫn trả text đã gộp)."""
+    field_lines = "\n".join(f"{k}: {'; '.join(v)}" for k, v in fields.items()) or "(none)"
+    prompt = _SUMMARY_PROMPT.format(fields=field_lines, text=merged_text[:_SUMMARY_CHARS])
+    try:
+        with metrics.span("ai.pdf_summary"):
+            resp = gemini_transport.generate_content([prompt], model=_MODEL_NAME)
+        return gemini_transport.response_text(resp)
+    except Exception:
+        return ""
+
+
+def _tesseract_chunk(chunk_bytes: bytes) -> str:
+    from pdf_to_text import pdf_to_text
+    res = pdf_to_text(chunk_bytes, engine="tesseract")
+    return res["text"].strip() if res.get("success") else ""
+
+
+def _tesseract_fallback(file_data: bytes, file_type: str):
+    """Gemini đang lỗi/tạm ngưng -> trả văn bản OCR bằng Tesseract (không có trường/tóm tắt)."""
+    if file_type == "pdf":
+        from pdf_to_text import pdf_to_text
+        res = pdf_to_text(file_data, engine="tesseract")
+    else:
+        from image_to_text import image_to_text
+        res = image_to_text(file_data)
+    if not res.get("success"):
+        return {"success": False, "message": f"⚠️ Gemini AI tạm không khả dụng và Tesseract lỗi: {res.get('message')}"}
+    return {"success": True, "text": res["text"], "degraded": True}
+
+
 # ==================== TEST LOCAL ====================
 if __name__ == "__main__":
     print("🧠 Test Gemini Auto Language OCR")
@@ -1,42 +1,191 @@
 # speech_to_text.py
 from io import BytesIO
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Callable, Dict, List, Tuple
 from pydub import AudioSegment
+from pydub.silence import detect_nonsilent
 import speech_recognition as sr
+import os
+import time
 
-# Nếu bạn có config.py set tesseract/ffmpeg path thì không cần dùng ở đây.
-# Chỉ cần chắc chắn ffmpeg đã ở PATH để pydub đọc định dạng.
+from concurrent_pages import ordered_map
+import audio_ingest
+import metrics
 
-def _to_wav_bytes(data: bytes) -> bytes:
-    seg = AudioSegment.from_file(BytesIO(data))  # auto-detect
-    buf = BytesIO()
-    seg.export(buf, format="wav")  # normalize to WAV
-    return buf.getvalue()
+# ---- Chế độ chia đoạn: cắt khoảng lặng đầu/cuối, chia tại các quãng nghỉ, nhận diện song song ----
+_CHUNKED = os.getenv("SPEECH_CHUNKED", "1") != "0"
+_CHUNK_MAX_MS = int(float(os.getenv("SPEECH_CHUNK_MAX_S", "30")) * 1000)   # độ dài tối đa 1 đoạn gửi đi
+_MIN_SILENCE_MS = int(os.getenv("SPEECH_MIN_SILENCE_MS", "400"))            # quãng nghỉ tối thiểu để cắt
+_SILENCE_DB = float(os.getenv("SPEECH_SILENCE_DB", "16"))                   # thấp hơn mức trung bình bấy nhiêu dB = lặng
+_PAD_MS = 200                                                               # giữ thêm 2 đầu mỗi đoạn để không mất âm đầu/cuối
+_MAX_INFLIGHT = int(os.getenv("SPEECH_MAX_INFLIGHT", "4"))
+# "google" (Web Speech, cần mạng) | "vosk" | "whisper" (offline, CPU — xem offline_speech.py)
+DEFAULT_ENGINE = os.getenv("SPEECH_ENGINE", "google")
+
+# recognizer(wav_bytes, language_bcp47) -> text ("" nếu không nghe được gì); lỗi mạng/API -> ném exception
+Recognizer = Callable[[bytes, str], str]
+
+# Giải mã qua audio_ingest: đúng 1 lần, ra thẳng 16 kHz mono (ffmpeg ở PATH hoặc FFMPEG_BINARY).
+
+def _to_wav_bytes(data) -> bytes:
+    return audio_ingest.to_wav(data)
 
 def _lang_to_bcp47(lang_ui: str) -> str:
     return "en-US" if lang_ui.strip().lower().startswith("english") else "vi-VN"
 
+
+def google_recognizer(wav_bytes: bytes, language: str) -> str:
+    """Recognizer mặc định: Google Web Speech (qua SpeechRecognition)."""
+    r = sr.Recognizer()
+    with sr.AudioFile(BytesIO(wav_bytes)) as source:
+        audio_data = r.record(source)
+    try:
+        return r.recognize_google(audio_data, language=language)
+    except sr.UnknownValueError:
+        return ""
+
+
+def _recognizer_for(engine: str) -> Tuple[Recognizer, int]:
+    """(recognizer, số đoạn chạy song song) theo engine."""
+    if engine == "google":
+        return google_recognizer, _MAX_INFLIGHT
+    import offline_speech  # chỉ nạp vosk / faster-whisper khi thật sự dùng engine offline
+    return offline_speech.recognizer(engine), offline_speech.WORKERS
+
+
+def _speech_ranges(seg: AudioSegment) -> List[Tuple[int, int]]:
+    """Các đoạn có tiếng (ms) theo năng lượng, đã bỏ lặng đầu/cuối."""
+    with metrics.span("speech.vad"):
+        thresh = (seg.dBFS if seg.dBFS != float("-inf") else -60.0) - _SILENCE_DB
+        return detect_nonsilent(seg, min_silence_len=_MIN_SILENCE_MS, silence_thresh=thresh, seek_step=10)
+
+
+def _plan_chunks(ranges: List[Tuple[int, int]], total_ms: int, max_ms: int = _CHUNK_MAX_MS) -> List[Tuple[int, int]]:
+    """
+    Gom các đoạn có tiếng liền nhau thành đoạn <= max_ms, chỉ cắt tại quãng nghỉ.
+    Đoạn nói liền dài hơn max_ms thì bị cắt cứng thành các phần max_ms.
+    """
+    chunks: List[Tuple[int, int]] = []
+    for start, end in ranges:
+        start, end = max(0, start - _PAD_MS), min(total_ms, end + _PAD_MS)
+        if chunks and end - chunks[-1][0] <= max_ms:
+            chunks[-1] = (chunks[-1][0], end)
+            continue
+        while end - start > max_ms:
+            chunks.append((start, start + max_ms))
+            start += max_ms
+        chunks.append((start, end))
+    return chunks
+
+
+def _fmt_ts(ms: int) -> str:
+    s = ms // 1000
+    return f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}.{ms % 1000 // 100}"
+
+
+def _transcribe_chunked(data, language: str, recognizer: Recognizer,
+                        max_inflight: int = _MAX_INFLIGHT) -> Dict[str, Any]:
+    pcm = audio_ingest.decode_pcm(data)
+    view = memoryview(pcm)  # cắt đoạn không copy PCM
+    t0 = time.perf_counter()
+    seg = AudioSegment(data=pcm, sample_width=audio_ingest.SAMPLE_WIDTH,
+                       frame_rate=audio_ingest.RATE, channels=audio_ingest.CHANNELS)
+    ranges = _speech_ranges(seg)
+    if not ranges:
+        return {"success": False, "message": "Không phát hiện giọng nói trong âm thanh."}
+    chunks = _plan_chunks(ranges, len(seg))
+
+    def _one(chunk):
+        start, end = chunk
+        with metrics.span("speech.recognize"):
+            bpm = audio_ingest.BYTES_PER_MS
+            return recognizer(audio_ingest.pcm_to_wav(view[start * bpm:end * bpm]), language)
+
+    segments, texts, failed = [], [], 0
+    for (start, end), (text, err) in zip(chunks, ordered_map(_one, chunks, max_inflight=max_inflight)):
+        entry = {"start": round(start / 1000, 2), "end": round(end / 1000, 2),
+                 "timestamp": f"{_fmt_ts(start)} - {_fmt_ts(end)}"}
+        if err is not None:
+            failed += 1
+            entry.update(status="error", text="", error=str(err))
+        else:
+            entry.update(status="ok" if text else "no_speech", text=(text or "").strip())
+            if entry["text"]:
+                texts.append(entry["text"])
+        segments.append(entry)
+
+    if not texts:
+        if failed:
+            return {"success": False, "message": f"Lỗi nhận diện giọng nói: {segments[0].get('error')}",
+                    "segments": segments}
+        return {"success": False, "message": "Không hiểu được âm thanh (UnknownValueError).",
+                "segments": segments}
+    audio_s = len(pcm) / (audio_ingest.BYTES_PER_MS * 1000)
+    result = {"success": True, "text": "\n".join(texts), "segments": segments, "audio_seconds": round(audio_s, 2),
+              "rtf": round((time.perf_counter() - t0) / audio_s, 4) if audio_s else 0.0}
+    if failed:
+        result["failed_segments"] = [i for i, s in enumerate(segments) if s["status"] == "error"]
+    return result
+
+
 def speech_to_text(
     audio_bytes: Optional[bytes] = None,
     uploaded_file: Optional[Any] = None,
-    lang: str = "Tiếng Việt"
+    lang: str = "Tiếng Việt",
+    chunked: Optional[bool] = None,
+    recognizer: Optional[Recognizer] = None,
+    engine: Optional[str] = None,
 ) -> Dict[str, Any]:
+    """
+    audio_bytes: âm thanh dạng bytes; hoặc uploaded_file: file object (seek được thì đọc dần khi giải mã).
+    engine: "google" | "vosk" | "whisper" (None = SPEECH_ENGINE); vosk / whisper chạy offline trên CPU,
+            kết quả có "rtf" (thời gian nhận diện / độ dài âm thanh).
+    chunked: cắt lặng đầu/cuối, chia tại quãng nghỉ (<= SPEECH_CHUNK_MAX_S giây/đoạn), nhận diện song song,
+             ghép lại theo thứ tự; result["segments"] có mốc thời gian từng đoạn (None = SPEECH_CHUNKED, mặc định bật).
+    recognizer: hàm (wav_bytes, ngôn ngữ BCP-47) -> text, mặc định google_recognizer (thay bằng bản giả để thử offline).
+    """
+    with metrics.trace("speech_to_text") as tr:
+        return metrics.attach(_speech_to_text(audio_bytes, uploaded_file, lang, chunked, recognizer, engine), tr)
+
+
+def _speech_to_text(audio_bytes: Optional[bytes], uploaded_file: Optional[Any], lang: str,
+                    chunked: Optional[bool] = None, recognizer: Optional[Recognizer] = None,
+                    engine: Optional[str] = None) -> Dict[str, Any]:
     try:
-        if audio_bytes:
-            wav_bytes = _to_wav_bytes(audio_bytes)
-        elif uploaded_file is not None:
-            file_bytes = uploaded_file.read()
-            if not file_bytes:
-                return {"success": False, "message": "File rỗng hoặc không đọc được."}
-            wav_bytes = _to_wav_bytes(file_bytes)
-        else:
+        source = audio_bytes
+        if not source and uploaded_file is not None:
+            if getattr(uploaded_file, "seekable", lambda: False)():
+                # đọc dần từ file upload khi giải mã (ffmpeg nhận từng khối), không nạp thêm 1 bản bytes
+                uploaded_file.seek(0)
+                if not uploaded_file.read(1):
+                    return {"success": False, "message": "File rỗng hoặc không đọc được."}
+                uploaded_file.seek(0)
+                source = uploaded_file
+            else:
+                source = uploaded_file.read()
+                if not source:
+                    return {"success": False, "message": "File rỗng hoặc không đọc được."}
+        if not source:
             return {"success": False, "message": "Chưa có nguồn âm thanh."}
 
         recog_lang = _lang_to_bcp47(lang)
+        engine = engine or DEFAULT_ENGINE
+        max_inflight = _MAX_INFLIGHT
+        if recognizer is None:
+            recognizer, max_inflight = _recognizer_for(engine)
+        if _CHUNKED if chunked is None else chunked:
+            return _transcribe_chunked(source, recog_lang, recognizer, max_inflight)
+        if recognizer is not google_recognizer:
+            text = recognizer(_to_wav_bytes(source), recog_lang)
+            if not text:
+                return {"success": False, "message": "Không hiểu được âm thanh (UnknownValueError)."}
+            return {"success": True, "text": text}
+
+        wav_bytes = _to_wav_bytes(source)
         r = sr.Recognizer()
-        with sr.AudioFile(BytesIO(wav_bytes)) as source:
-            audio_data = r.record(source)
-        text = r.recognize_google(audio_data, language=recog_lang)
+        with sr.AudioFile(BytesIO(wav_bytes)) as audio_file:
+            audio_data = r.record(audio_file)
+        with metrics.span("speech.recognize"):
+            text = r.recognize_google(audio_data, language=recog_lang)
         return {"success": True, "text": text}
 
     except sr.UnknownValueError:
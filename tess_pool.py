@@ -0,0 +1,162 @@
+# tess_pool.py — Pool Tesseract dùng lại (giữ model ngôn ngữ đã nạp) thay vì spawn process mỗi lần gọi
+# - Có `tesserocr` (binding C API): mỗi worker là 1 TessBaseAPI sống lâu, ảnh truyền thẳng trong RAM.
+# - Không có `tesserocr`: tự động quay về pytesseract (CLI) để app vẫn chạy như cũ.
+from typing import Dict, Iterable, Optional, Union
+import os
+import queue
+import re
+import threading
+
+import numpy as np
+from PIL import Image
+import pytesseract
+
+# Kích hoạt cấu hình tesseract_cmd từ config.py (Windows)
+try:
+    import config  # noqa: F401
+except Exception:
+    pass
+
+try:
+    import tesserocr
+    _tesserocr_available = True
+except Exception:
+    tesserocr = None
+    _tesserocr_available = False
+
+# Số TessBaseAPI tối đa mỗi ngôn ngữ (mỗi cái giữ 1 bản model trong RAM, tạo dần khi có tải song song)
+POOL_SIZE = int(os.getenv("TESS_POOL_SIZE", str(os.cpu_count() or 2)))
+
+_DATA_KEYS = ["level", "page_num", "block_num", "par_num", "line_num", "word_num",
+              "left", "top", "width", "height", "conf", "text"]
+
+
+def _tessdata_path() -> Optional[str]:
+    if os.getenv("TESSDATA_PREFIX"):
+        return os.getenv("TESSDATA_PREFIX")
+    cmd = getattr(pytesseract.pytesseract, "tesseract_cmd", "") or ""
+    guess = os.path.join(os.path.dirname(cmd), "tessdata") if os.path.dirname(cmd) else ""
+    return guess if guess and os.path.isdir(guess) else None
+
+
+def _parse_config(config: str):
+    """Tách --oem / --psm khỏi chuỗi config kiểu pytesseract."""
+    oem = re.search(r"--oem\s+(\d+)", config or "")
+    psm = re.search(r"--psm\s+(\d+)", config or "")
+    return (int(oem.group(1)) if oem else 3), (int(psm.group(1)) if psm else 3)
+
+
+def _to_pil(img: Union[Image.Image, np.ndarray]) -> Image.Image:
+    if isinstance(img, Image.Image):
+        return img
+    return Image.fromarray(np.ascontiguousarray(img))
+
+
+class _ApiPool:
+    """Các TessBaseAPI cho 1 cặp (lang, oem); mượn/trả theo kiểu hàng đợi, thread-safe."""
+
+    def __init__(self, lang: str, oem: int, size: int):
+        self.lang, self.oem, self.size = lang, oem, max(1, size)
+        self._idle: "queue.Queue" = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_api(self):
+        kwargs = {"lang": self.lang, "oem": tesserocr.OEM(self.oem)}
+        path = _tessdata_path()
+        if path:
+            kwargs["path"] = path
+        return tesserocr.PyTessBaseAPI(**kwargs)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._new_api()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, api) -> None:
+        api.Clear()
+        self._idle.put(api)
+
+    def warm(self, n: int) -> None:
+        apis = [self.acquire() for _ in range(min(n, self.size))]
+        for api in apis:
+            self.release(api)
+
+
+_pools: Dict[tuple, _ApiPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(lang: str, oem: int) -> _ApiPool:
+    with _pools_lock:
+        pool = _pools.get((lang, oem))
+        if pool is None:
+            pool = _pools[(lang, oem)] = _ApiPool(lang, oem, POOL_SIZE)
+        return pool
+
+
+def _run(img, lang: str, config: str, fn):
+    oem, psm = _parse_config(config)
+    pool = _get_pool(lang, oem)
+    api = pool.acquire()
+    try:
+        api.SetPageSegMode(tesserocr.PSM(psm))
+        api.SetImage(_to_pil(img))
+        return fn(api)
+    finally:
+        pool.release(api)
+
+
+def _parse_tsv(tsv: str) -> Dict[str, list]:
+    out = {k: [] for k in _DATA_KEYS}
+    for row in tsv.splitlines():
+        cols = row.split("\t")
+        if len(cols) < 12 or not cols[0].isdigit():
+            continue
+        for k, v in zip(_DATA_KEYS[:-1], cols[:11]):
+            out[k].append(float(v) if k == "conf" else int(v))
+        out["text"].append("\t".join(cols[11:]))
+    return out
+
+
+# ----------------- Public API (tương thích pytesseract) -----------------
+def image_to_string(img, lang: str = "vie+eng", config: str = "") -> str:
+    if not _tesserocr_available:
+        return pytesseract.image_to_string(img, lang=lang, config=config)
+    return _run(img, lang, config, lambda api: api.GetUTF8Text())
+
+
+def image_to_data(img, lang: str = "vie+eng", config: str = "") -> Dict[str, list]:
+    """Giống pytesseract.image_to_data(..., output_type=Output.DICT)."""
+    if not _tesserocr_available:
+        return pytesseract.image_to_data(img, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+
+    def _data(api):
+        api.Recognize()
+        return _parse_tsv(api.GetTSVText(0))
+    return _run(img, lang, config, _data)
+
+
+def warm_up(langs: Iterable[str] = ("vie+eng", "eng"), oem: int = 1, workers: Optional[int] = None) -> bool:
+    """
+    Nạp sẵn model cho các ngôn ngữ (gọi 1 lần khi app khởi động). Trả False nếu chỉ có pytesseract.
+    Mặc định chỉ 1 TessBaseAPI / ngôn ngữ (workers: số muốn nạp sẵn); pool tự tạo thêm tới POOL_SIZE khi cần.
+    """
+    if not _tesserocr_available:
+        return False
+    for lang in langs:
+        _get_pool(lang, oem).warm(workers or 1)
+    return True
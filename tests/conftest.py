@@ -0,0 +1,5 @@
+# Cho phép import các module ở thư mục gốc (repo không đóng gói) khi chạy `pytest` từ bất kỳ đâu
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pytest
+
+import batch_ocr
+
+
+def test_image_mode_passes_engine_and_model(monkeypatch, tmp_path):
+    image_to_text = pytest.importorskip("image_to_text")
+    calls = []
+
+    def fake(path, engine="auto", model=None, policy=None):
+        calls.append((path, engine, model))
+        return {"success": True, "text": "ok"}
+
+    monkeypatch.setattr(image_to_text, "image_to_text", fake)
+    img = tmp_path / "a.png"
+    img.write_bytes(b"")
+    result = batch_ocr._process_file(str(img), "gemini", "image", "Tiếng Việt", "gemini-2.5-pro")
+    assert result["success"] and calls == [(str(img), "gemini", "gemini-2.5-pro")]
+
+
+def _edit_during_run(path, engine, image_mode, lang, model):
+    with open(path, "ab") as f:
+        f.write(b" edited")
+    return {"success": True, "text": "ok"}
+
+
+def test_fingerprint_is_taken_before_the_run(monkeypatch, tmp_path):
+    img = tmp_path / "a.png"
+    img.write_bytes(b"noi dung goc")
+    before = batch_ocr._fingerprint(str(img))
+    monkeypatch.setattr(batch_ocr, "_process_file", _edit_during_run)  # worker fork kế thừa bản vá
+    out = tmp_path / "out.jsonl"
+    stats = batch_ocr.run_batch([str(img)], str(out), workers=1, quiet=True)
+    rec = json.loads(out.read_text(encoding="utf-8"))
+    assert stats["ok"] == 1 and rec["fingerprint"] == before
+
+
+def test_init_worker_caps_threads(monkeypatch):
+    monkeypatch.delenv("OMP_THREAD_LIMIT", raising=False)
+    monkeypatch.setenv("OCR_LAYOUT_WORKERS", "16")
+    monkeypatch.delenv("TESS_POOL_SIZE", raising=False)
+    batch_ocr._init_worker(2)
+    assert os.environ["OMP_THREAD_LIMIT"] == "1"
+    assert os.environ["OCR_LAYOUT_WORKERS"] == "2" and os.environ["TESS_POOL_SIZE"] == "2"
@@ -0,0 +1,166 @@
+import threading
+import time
+
+from concurrent_pages import ordered_map
+
+
+def test_results_keep_input_order_when_calls_finish_out_of_order():
+    delays = [0.2, 0.0, 0.1, 0.05, 0.0]
+
+    def fn(i):
+        time.sleep(delays[i])
+        return i * 10
+
+    assert list(ordered_map(fn, range(len(delays)), max_inflight=4)) == [(i * 10, None) for i in range(5)]
+
+
+def test_error_is_returned_per_item():
+    def fn(i):
+        if i == 2:
+            raise RuntimeError("trang 2 lỗi")
+        return i
+
+    out = list(ordered_map(fn, range(4), max_inflight=3))
+    assert [r for r, _ in out] == [0, 1, None, 3]
+    assert isinstance(out[2][1], RuntimeError) and all(e is None for i, (_, e) in enumerate(out) if i != 2)
+
+
+def test_max_inflight_is_respected():
+    lock, state = threading.Lock(), {"now": 0, "peak": 0}
+
+    def fn(i):
+        with lock:
+            state["now"] += 1
+            state["peak"] = max(state["peak"], state["now"])
+        time.sleep(0.02)
+        with lock:
+            state["now"] -= 1
+        return i
+
+    assert [r for r, _ in ordered_map(fn, range(20), max_inflight=3)] == list(range(20))
+    assert 1 < state["peak"] <= 3
+
+
+def test_items_are_pulled_lazily():
+    pulled = []
+
+    def items():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    it = ordered_map(lambda i: i, items(), max_inflight=2)
+    next(it)
+    assert len(pulled) <= 3
+    it.close()
+
+
+def test_sequential_mode():
+    out = list(ordered_map(lambda i: 1 // i, [1, 0, 2], max_inflight=1))
+    assert out[0] == (1, None) and out[2] == (0, None)
+    assert isinstance(out[1][1], ZeroDivisionError)
+
+
+# ----------------- Gemini OCR nhiều trang với client giả có độ trễ -----------------
+from io import BytesIO
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import concurrent_pages
+import gemini_transport
+import ocr_cache
+
+
+class SlowGemini:
+    """
+    models.generate_content giả: ảnh trang k là ảnh xám đều mức 20*k -> trả "trang k" sau độ trễ
+    lệch nhau (trang sau xong trước trang trước); trang trong `fail` ném lỗi 400.
+    Ghi lại số request đang bay cao nhất.
+    """
+
+    def __init__(self, delays, fail=()):
+        self.delays, self.fail = delays, set(fail)
+        self.models = self
+        self.lock = threading.Lock()
+        self.now = self.peak = self.calls = 0
+
+    def generate_content(self, model=None, contents=None):
+        part = next(c for c in contents if not isinstance(c, str))
+        data = part["data"] if isinstance(part, dict) else part.inline_data.data
+        img = Image.open(BytesIO(data)).convert("L")
+        page = round(img.resize((1, 1), Image.BOX).getpixel((0, 0)) / 20)
+        with self.lock:
+            self.now += 1
+            self.calls += 1
+            self.peak = max(self.peak, self.now)
+        try:
+            time.sleep(self.delays[page - 1])
+            if page in self.fail:
+                err = ValueError(f"400 trang {page} bị từ chối")
+                err.code = 400
+                raise err
+            return type("Resp", (), {"text": f"trang {page}", "candidates": []})()
+        finally:
+            with self.lock:
+                self.now -= 1
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    monkeypatch.setattr(concurrent_pages, "DEFAULT_MAX_INFLIGHT", 3)
+    monkeypatch.setattr(gemini_transport, "_breaker", gemini_transport.CircuitBreaker())
+    monkeypatch.setattr(ocr_cache, "_ENABLED", False)
+
+    def install(client):
+        gemini_transport.set_client(client)
+        return client
+
+    yield install
+    gemini_transport.set_client(None)
+
+
+def _page_images(n):
+    return [Image.new("L", (64, 64), 20 * k) for k in range(1, n + 1)]
+
+
+def _png(img):
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+DELAYS = [0.08, 0.01, 0.05, 0.0, 0.06, 0.02, 0.04, 0.0]
+
+
+def test_gemini_ocr_images_keeps_order_and_inflight_limit(fake_gemini):
+    ai_studio_ocr = pytest.importorskip("ai_studio_ocr")
+    client = fake_gemini(SlowGemini(DELAYS))
+    text = ai_studio_ocr.gemini_ocr_images([_png(im) for im in _page_images(8)], joiner="|", pack_pages=1)
+    assert text.split("|") == [f"trang {k}" for k in range(1, 9)]
+    assert client.calls == 8 and 1 < client.peak <= concurrent_pages.DEFAULT_MAX_INFLIGHT
+
+
+def test_gemini_ocr_images_annotates_failed_page_only(fake_gemini):
+    ai_studio_ocr = pytest.importorskip("ai_studio_ocr")
+    fake_gemini(SlowGemini(DELAYS, fail={3}))
+    pages = ai_studio_ocr.gemini_ocr_images([_png(im) for im in _page_images(5)], joiner="|",
+                                            pack_pages=1).split("|")
+    assert pages[2].startswith("[Lỗi OCR trang 3:")
+    assert [p for i, p in enumerate(pages) if i != 2] == ["trang 1", "trang 2", "trang 4", "trang 5"]
+
+
+def test_pdf_to_text_gemini_pages_in_order_with_failed_page(fake_gemini, monkeypatch):
+    pdf_to_text = pytest.importorskip("pdf_to_text")
+    client = fake_gemini(SlowGemini(DELAYS, fail={4}))
+    # chỉ thay bước render (poppler); OCR + gửi song song + gom kết quả chạy thật
+    monkeypatch.setattr(pdf_to_text, "_iter_pdf_pages", lambda *a, **k: iter(_page_images(6)))
+    r = pdf_to_text.pdf_to_text(b"%PDF-1.4 fake", engine="gemini", text_layer=False, pack_pages=1)
+    assert r["success"] and r["failed_pages"] == [4]
+    body = [chunk.split("\n", 1)[1] for chunk in r["text"].split("--- Trang ")[1:]]
+    assert [b.strip() for i, b in enumerate(body) if i != 3] == ["trang 1", "trang 2", "trang 3", "trang 5",
+                                                                   "trang 6"]
+    assert body[3].startswith(pdf_to_text._PAGE_ERROR_PREFIX)
+    assert [p["path"] for p in r["pages"]] == ["gemini"] * 3 + ["error"] + ["gemini"] * 2
+    assert 1 < client.peak <= concurrent_pages.DEFAULT_MAX_INFLIGHT
@@ -0,0 +1,141 @@
+import pytest
+
+import engine_router
+import gemini_transport
+from gemini_transport import GeminiUnavailable
+
+
+class FakeRunner:
+    """run(engine) giả: trả text / ném lỗi theo tên engine, ghi lại thứ tự được gọi."""
+
+    def __init__(self, answers):
+        self.answers, self.calls = answers, []
+
+    def __call__(self, eng):
+        self.calls.append(eng.name)
+        ans = self.answers.get(eng.name, "")
+        if isinstance(ans, Exception):
+            raise ans
+        return ans
+
+
+@pytest.fixture(autouse=True)
+def _gemini_up(monkeypatch):
+    monkeypatch.setattr(gemini_transport, "is_available", lambda: True)
+    monkeypatch.setattr(engine_router, "_history", {})
+
+
+GOOD = "Hóa đơn bán hàng số 123"
+CHAIN = ["tesseract", "hybrid", "gemini-2.5-flash"]
+
+
+def test_default_chain_excludes_pro():
+    chain, policy = engine_router.resolve("auto")
+    assert "gemini-2.5-pro" not in chain
+    assert policy == engine_router.DEFAULT_POLICY
+
+
+def test_resolve_pro_is_opt_in_via_model():
+    chain, _ = engine_router.resolve("auto", model="gemini-2.5-pro")
+    assert "gemini-2.5-pro" in chain
+    assert engine_router.resolve("gemini", model="gemini-2.5-pro") == (["gemini-2.5-pro", "tesseract"], "fixed")
+    assert engine_router.resolve("tesseract") == (["tesseract"], "fixed")
+
+
+def test_cascade_stops_at_first_accepted():
+    run = FakeRunner({"tesseract": GOOD})
+    r = engine_router.route(run, CHAIN, "cascade")
+    assert r["success"] and r["engine"] == "tesseract" and r["text"] == GOOD
+    assert run.calls == ["tesseract"]
+
+
+def test_cascade_escalates_cheapest_first():
+    run = FakeRunner({"tesseract": "", "hybrid": "#@!", "gemini-2.5-flash": GOOD})
+    r = engine_router.route(run, ["gemini-2.5-flash", "hybrid", "tesseract"], "cascade")
+    assert run.calls == ["tesseract", "hybrid", "gemini-2.5-flash"]
+    assert r["engine"] == "gemini-2.5-flash"
+    assert [s["outcome"] for s in r["route"]] == ["rejected", "rejected", "accepted"]
+
+
+def test_gemini_no_text_answer_is_final():
+    run = FakeRunner({"tesseract": "", "hybrid": "", "gemini-2.5-flash": engine_router.NoText("rỗng")})
+    r = engine_router.route(run, CHAIN + ["gemini-2.5-pro"], "cascade")
+    assert run.calls == ["tesseract", "hybrid", "gemini-2.5-flash"]
+    assert not r["success"] and r["no_text"]
+    assert r["route"][-1]["outcome"] == "empty"
+
+
+def test_blocked_gemini_answer_falls_back_to_tesseract():
+    blocked = RuntimeError("Gemini không trả text: finish_reason=SAFETY")
+    run = FakeRunner({"gemini-2.5-pro": blocked, "tesseract": GOOD})
+    r = engine_router.route(run, *engine_router.resolve("gemini", model="gemini-2.5-pro"))
+    assert run.calls == ["gemini-2.5-pro", "tesseract"]
+    assert r["success"] and r["engine"] == "tesseract" and "no_text" not in r
+
+
+class _Resp:
+    def __init__(self, text, finish):
+        self.text = text
+        self.candidates = [type("C", (), {"finish_reason": finish})()]
+
+
+@pytest.mark.parametrize("finish", ["SAFETY", "RECITATION", "MAX_TOKENS", None])
+def test_gemini_text_only_stop_means_no_text(finish):
+    with pytest.raises(RuntimeError) as e:
+        engine_router.gemini_text(_Resp("", finish))
+    assert not isinstance(e.value, engine_router.NoText)
+    with pytest.raises(engine_router.NoText):
+        engine_router.gemini_text(_Resp("", "FinishReason.STOP"))
+    assert engine_router.gemini_text(_Resp(" chữ ", "MAX_TOKENS")) == "chữ"
+
+
+def test_no_text_exception_is_final_and_keeps_best():
+    run = FakeRunner({"tesseract": "ab #@! cd", "gemini-2.5-flash": engine_router.NoText("rỗng")})
+    r = engine_router.route(run, ["tesseract", "gemini-2.5-flash", "gemini-2.5-pro"], "cascade",
+                            accept=lambda t: False)
+    assert run.calls == ["tesseract", "gemini-2.5-flash"]
+    assert r["success"] and r["low_quality"] and r["engine"] == "tesseract"
+
+
+def test_gemini_error_escalates_and_marks_degraded():
+    run = FakeRunner({"tesseract": "ab #@!", "gemini-2.5-flash": GeminiUnavailable("503")})
+    r = engine_router.route(run, ["tesseract", "gemini-2.5-flash"], "cascade")
+    assert r["success"] and r["low_quality"] and r["degraded"]
+    assert [s["outcome"] for s in r["route"]] == ["rejected", "error"]
+
+
+def test_unavailable_gemini_is_skipped(monkeypatch):
+    monkeypatch.setattr(gemini_transport, "is_available", lambda: False)
+    run = FakeRunner({"tesseract": ""})
+    r = engine_router.route(run, CHAIN, "cascade")
+    assert run.calls == ["tesseract"]
+    assert not r["success"]
+    assert [s["outcome"] for s in r["route"]] == ["rejected", "skipped", "skipped"]
+
+
+def test_fixed_keeps_given_order():
+    run = FakeRunner({"gemini-2.5-flash": GeminiUnavailable("down"), "tesseract": GOOD})
+    r = engine_router.route(run, ["gemini-2.5-flash", "tesseract"], "fixed")
+    assert run.calls == ["gemini-2.5-flash", "tesseract"]
+    assert r["engine"] == "tesseract"
+
+
+def test_adaptive_uses_cost_until_enough_samples():
+    engines = [engine_router.get_engine(n) for n in ["gemini-2.5-flash", "tesseract"]]
+    order = [e.name for e, _ in engine_router.POLICIES["adaptive"](engines, {})]
+    assert order == ["tesseract", "gemini-2.5-flash"]
+
+
+def test_adaptive_demotes_engine_that_keeps_failing():
+    engines = [engine_router.get_engine(n) for n in ["tesseract", "hybrid"]]
+    st = {"tesseract": {"n": 20, "success_rate": 0.01, "p50_s": 0.5},
+          "hybrid": {"n": 20, "success_rate": 1.0, "p50_s": 1.0}}
+    order = [e.name for e, _ in engine_router.POLICIES["adaptive"](engines, st)]
+    assert order == ["hybrid", "tesseract"]
+
+
+def test_unknown_policy_and_engine():
+    with pytest.raises(ValueError):
+        engine_router.route(FakeRunner({}), ["tesseract"], "nope")
+    with pytest.raises(ValueError):
+        engine_router.get_engine("paddle")
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+import gemini_transport
+from gemini_transport import CircuitBreaker, GeminiUnavailable
+
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} lỗi API")
+        self.code = code
+
+
+class FakeClient:
+    """models.generate_content giả: lần lượt ném lỗi / trả kết quả theo `script`."""
+
+    def __init__(self, *script):
+        self.script, self.calls = list(script), 0
+        self.models = self
+
+    def generate_content(self, model=None, contents=None):
+        self.calls += 1
+        step = self.script.pop(0) if self.script else "ok"
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+
+@pytest.fixture(autouse=True)
+def _fresh_breaker(monkeypatch):
+    monkeypatch.setattr(gemini_transport, "_breaker", CircuitBreaker(threshold=2, cooldown=0.05))
+    monkeypatch.setattr(gemini_transport, "_backoff", lambda attempt: 0.0)
+
+
+def test_transient_error_is_retried_then_succeeds():
+    client = FakeClient(ApiError(503), "xong")
+    assert gemini_transport.generate_content(["x"], client=client) == "xong"
+    assert client.calls == 2 and gemini_transport.breaker_state() == "closed"
+
+
+def test_non_transient_error_passes_through_without_retry():
+    client = FakeClient(ApiError(400))
+    with pytest.raises(ApiError):
+        gemini_transport.generate_content(["x"], client=client)
+    assert client.calls == 1 and gemini_transport.breaker_state() == "closed"
+
+
+def test_exhausted_retries_raise_unavailable():
+    client = FakeClient(*[ApiError(503)] * 3)
+    with pytest.raises(GeminiUnavailable):
+        gemini_transport.generate_content(["x"], client=client, max_retries=2)
+    assert client.calls == 3
+
+
+def test_breaker_opens_half_opens_and_recovers():
+    for _ in range(2):
+        with pytest.raises(GeminiUnavailable):
+            gemini_transport.generate_content(["x"], client=FakeClient(ApiError(503)), max_retries=0)
+    assert gemini_transport.breaker_state() == "open"
+    idle = FakeClient()
+    with pytest.raises(GeminiUnavailable):
+        gemini_transport.generate_content(["x"], client=idle)
+    assert idle.calls == 0  # mở -> không gọi API
+
+    time.sleep(0.06)
+    assert gemini_transport.breaker_state() == "half_open"
+    # thăm dò thất bại -> mở lại
+    with pytest.raises(GeminiUnavailable):
+        gemini_transport.generate_content(["x"], client=FakeClient(ApiError(503)), max_retries=0)
+    assert gemini_transport.breaker_state() == "open"
+
+    time.sleep(0.06)
+    assert gemini_transport.generate_content(["x"], client=FakeClient("ok")) == "ok"
+    assert gemini_transport.breaker_state() == "closed"
+
+
+def test_half_open_probe_allows_only_one_request():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.state() == "closed"
+
+
+def test_client_error_does_not_wedge_half_open_breaker(monkeypatch):
+    breaker = gemini_transport._breaker
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    def broken():
+        raise GeminiUnavailable("google-genai chưa được cài")
+
+    monkeypatch.setattr(gemini_transport, "get_client", broken)
+    with pytest.raises(GeminiUnavailable):
+        gemini_transport.generate_content(["x"])
+    assert breaker.allow(peek=True)  # lượt thăm dò chưa bị giữ
+    assert gemini_transport.generate_content(["x"], client=FakeClient("ok")) == "ok"
@@ -0,0 +1,40 @@
+from jobs import JobExecutor, run_callable
+
+
+def _flaky(results):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return results[len(calls) - 1]
+    return fn, calls
+
+
+def test_same_key_reuses_successful_job():
+    ex = JobExecutor(max_workers=1)
+    fn, calls = _flaky([{"success": True, "text": "a"}])
+    first = ex.submit("image", run_callable, fn, key="k")
+    assert ex.get(first).wait(5)
+    assert ex.submit("image", run_callable, fn, key="k") == first
+    assert len(calls) == 1
+
+
+def test_same_key_reruns_failed_result():
+    ex = JobExecutor(max_workers=1)
+    fn, calls = _flaky([{"success": False, "message": "Gemini 503"}, {"success": True, "text": "a"}])
+    first = ex.submit("image", run_callable, fn, key="k")
+    assert ex.get(first).wait(5)
+    second = ex.submit("image", run_callable, fn, key="k")
+    assert second != first and ex.get(second).wait(5)
+    assert ex.get(second).result["success"] and len(calls) == 2
+
+
+def test_same_key_reruns_after_exception():
+    ex = JobExecutor(max_workers=1)
+
+    def boom():
+        raise RuntimeError("ffmpeg chết")
+
+    first = ex.submit("speech", run_callable, boom, key="k")
+    assert ex.get(first).wait(5)
+    assert ex.submit("speech", run_callable, lambda: {"success": True}, key="k") != first
@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("pytesseract")
+
+from layout import reading_order
+
+
+def _columns(n_cols, n_pars, col_w=400, gutter=80, par_h=200, par_gap=90, top=0):
+    """Rect (x, y, w, h) theo tên "L0", "R0", ... cho trang n_cols cột x n_pars đoạn (khe đoạn thẳng hàng)."""
+    names = "LRM"
+    out = {}
+    for c in range(n_cols):
+        for p in range(n_pars):
+            out[f"{names[c]}{p}"] = (c * (col_w + gutter), top + p * (par_h + par_gap), col_w, par_h)
+    return out
+
+
+def _order(named):
+    by_rect = {v: k for k, v in named.items()}
+    return [by_rect[r] for r in reading_order(list(named.values()))]
+
+
+def test_aligned_paragraph_gaps_wider_than_gutter_keep_columns():
+    named = _columns(2, 3, gutter=80, par_gap=90)
+    assert _order(named) == ["L0", "L1", "L2", "R0", "R1", "R2"]
+
+
+def test_three_columns():
+    named = _columns(3, 2, gutter=40, par_gap=120)
+    assert _order(named) == ["L0", "L1", "R0", "R1", "M0", "M1"]
+
+
+def test_title_and_footer_around_columns():
+    named = _columns(2, 2, top=150)
+    named["title"] = (0, 0, 880, 60)
+    named["footer"] = (0, 800, 880, 40)
+    assert _order(named) == ["title", "L0", "L1", "R0", "R1", "footer"]
+
+
+def test_short_side_block_uses_widest_gap():
+    # khối bên phải chỉ cao bằng 1 dòng đầu -> không phải trang 2 cột: hàng trên trước
+    named = {"left_top": (0, 0, 400, 50), "right_top": (600, 0, 300, 50), "body": (0, 300, 900, 400)}
+    assert _order(named) == ["left_top", "right_top", "body"]
+
+
+def test_single_column_top_to_bottom():
+    named = {f"p{i}": (10, i * 100, 500, 60) for i in range(4)}
+    assert _order(named) == ["p0", "p1", "p2", "p3"]
+
+
+def test_overlapping_blocks_fall_back_to_top_left():
+    named = {"a": (0, 0, 300, 100), "b": (200, 50, 300, 100)}
+    assert _order(named) == ["a", "b"]
+
+
+def test_full_width_band_between_column_sections():
+    upper = _columns(2, 2, top=0)
+    lower = {k.lower(): v for k, v in _columns(2, 2, top=800).items()}
+    named = dict(upper, band=(0, 650, 880, 60), **lower)
+    assert _order(named) == ["L0", "L1", "R0", "R1", "band", "l0", "l1", "r0", "r1"]
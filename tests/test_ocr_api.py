@@ -0,0 +1,49 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+import ocr_api
+from jobs import run_callable
+
+
+@pytest.fixture
+def server():
+    srv = ocr_api.make_server(port=0, workers=1, max_queue=4, quiet=True)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _post(srv, path: str, body: bytes):
+    conn = http.client.HTTPConnection(*srv.server_address[:2], timeout=10)
+    try:
+        conn.request("POST", path, body=body)
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read())
+    finally:
+        conn.close()
+
+
+def test_identical_post_after_failure_runs_again(server, monkeypatch):
+    outcomes = [{"success": False, "message": "Gemini 503"}, {"success": True, "text": "xin chào"}]
+    calls = []
+
+    def fake_ocr(data, engine=None, model=None, policy=None):
+        calls.append(data)
+        return outcomes[len(calls) - 1]
+
+    monkeypatch.setitem(ocr_api.PIPELINES, "image",
+                        lambda data, q: (run_callable, (fake_ocr, data), {"engine": q.get("engine")}))
+
+    status, first = _post(server, "/v1/image?engine=gemini", b"same-bytes")
+    assert status == 422 and not first["success"]
+    status, second = _post(server, "/v1/image?engine=gemini", b"same-bytes")
+    assert status == 200 and second["text"] == "xin chào"
+    assert second["job_id"] != first["job_id"] and len(calls) == 2
+
+    # thành công rồi -> dùng lại job, không chạy lại
+    status, third = _post(server, "/v1/image?engine=gemini", b"same-bytes")
+    assert status == 200 and third["job_id"] == second["job_id"] and len(calls) == 2
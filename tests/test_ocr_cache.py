@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+
+import pytest
+
+import ocr_cache
+from ocr_cache import OCRCache
+
+
+def test_no_text_result_gets_short_ttl(tmp_path, monkeypatch):
+    monkeypatch.setattr(ocr_cache, "_NO_TEXT_TTL", 0.05)
+    cache = OCRCache(cache_dir=str(tmp_path), ttl=3600)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"success": False, "no_text": True}
+
+    kw = {"cacheable": ocr_cache._cacheable, "ttl_for": ocr_cache._ttl_for}
+    cache.get_or_compute("k", compute, **kw)
+    cache.get_or_compute("k", compute, **kw)
+    assert len(calls) == 1
+    time.sleep(0.1)
+    cache.get_or_compute("k", compute, **kw)
+    assert len(calls) == 2
+
+
+def _entry(text: str):
+    return {"success": True, "text": text}
+
+
+def test_ram_lru_evicts_least_recently_used_by_bytes():
+    size = len(json.dumps(_entry("x" * 100)))
+    cache = OCRCache(cache_dir=None, ram_bytes=size * 2 + 10)
+    for key in "abc":
+        cache.get_or_compute(key, lambda key=key: _entry(key * 100))
+        if key == "b":
+            cache.get_or_compute("a", lambda: pytest.fail("a phải còn trong RAM"))  # a mới dùng -> b cũ nhất
+    st = cache.stats()
+    assert st["ram_entries"] == 2 and st["evictions_ram"] == 1 and st["ram_bytes"] <= cache.ram_bytes
+    cache.get_or_compute("a", lambda: pytest.fail("a phải còn trong RAM"))
+    calls = []
+    cache.get_or_compute("b", lambda: calls.append(1) or _entry("b" * 100))
+    assert calls == [1]  # b đã bị đẩy ra
+
+
+def test_disk_lru_evicts_by_bytes_and_survives_restart(tmp_path):
+    cache = OCRCache(cache_dir=str(tmp_path), ram_bytes=0, disk_bytes=250)
+    for key in ("k1", "k2", "k3"):
+        cache.get_or_compute(key, lambda key=key: _entry(key * 20))
+    st = cache.stats()
+    assert st["disk_bytes"] <= 250 and st["evictions_disk"] >= 1
+    assert st["disk_entries"] == len(list(tmp_path.rglob("*.json")))
+
+    reopened = OCRCache(cache_dir=str(tmp_path), ram_bytes=0, disk_bytes=250)
+    assert reopened.get_or_compute("k3", lambda: pytest.fail("k3 phải còn trên đĩa")) == _entry("k3" * 20)
+    assert reopened.stats()["hits_disk"] == 1
+
+
+def test_ttl_expiry_in_ram_and_on_disk(tmp_path):
+    cache = OCRCache(cache_dir=str(tmp_path), ttl=0.05)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return _entry("t")
+
+    cache.get_or_compute("k", compute)
+    cache.get_or_compute("k", compute)
+    time.sleep(0.08)
+    cache.get_or_compute("k", compute)
+    assert len(calls) == 2 and cache.stats()["expired"] >= 1
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    cache = OCRCache(cache_dir=None)
+    started, release, calls = threading.Event(), threading.Event(), []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return _entry("chung")
+
+    with ThreadPoolExecutor(4) as pool:
+        futs = [pool.submit(cache.get_or_compute, "k", compute)]
+        started.wait(5)
+        futs += [pool.submit(cache.get_or_compute, "k", compute) for _ in range(3)]
+        while cache.stats()["coalesced"] < 3:
+            time.sleep(0.005)
+        release.set()
+        results = [f.result(5) for f in futs]
+    assert calls == [1] and all(r == _entry("chung") for r in results)
+
+
+def test_waiters_recompute_when_leader_result_is_not_cacheable():
+    cache = OCRCache(cache_dir=None)
+    started, release = threading.Event(), threading.Event()
+
+    def cancelled_leader():
+        started.set()
+        release.wait(5)
+        return {"success": False, "cancelled": True}
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(cache.get_or_compute, "k", cancelled_leader, ocr_cache._cacheable)
+        started.wait(5)
+        waiter = pool.submit(cache.get_or_compute, "k", lambda: _entry("của tôi"), ocr_cache._cacheable)
+        while cache.stats()["coalesced"] < 1:
+            time.sleep(0.005)
+        release.set()
+        assert leader.result(5)["cancelled"]
+        assert waiter.result(5) == _entry("của tôi")
@@ -0,0 +1,99 @@
+import pytest
+
+pytest.importorskip("PIL")
+
+from page_packing import split_pages
+
+
+def _answer(pages):
+    return "".join(f"<<<PAGE {k}>>>\n{text}\n" for k, text in pages)
+
+
+def test_all_labels_present():
+    assert split_pages(_answer(zip(range(1, 4), "abc")), 3) == ["a", "b", "c"]
+
+
+def test_missing_last_page_drops_only_previous():
+    assert split_pages(_answer(zip(range(1, 5), "abcd")), 5) == ["a", "b", "c", None, None]
+
+
+def test_missing_middle_page_drops_only_previous():
+    assert split_pages(_answer(zip([1, 2, 3, 5], "abce")), 5) == ["a", "b", None, None, "e"]
+
+
+def test_several_missing_pages():
+    assert split_pages(_answer(zip([1, 3, 5], "ace")), 6) == [None, None, None, None, None, None]
+    assert split_pages(_answer(zip([1, 2, 4, 5], "abde")), 6) == ["a", None, None, "d", None, None]
+
+
+def test_untrusted_labels_reject_everything():
+    assert split_pages(_answer(zip([2, 1], "ba")), 2) == [None, None]      # sai thứ tự
+    assert split_pages(_answer(zip([1, 1], "aa")), 2) == [None, None]      # trùng
+    assert split_pages(_answer(zip([1, 3], "ac")), 2) == [None, None]      # ngoài khoảng
+    assert split_pages("không có nhãn", 2) == [None, None]
+
+
+def test_blank_page_keeps_empty_string():
+    assert split_pages("<<<PAGE 1>>>\n\n<<<PAGE 2>>>\nb\n", 2) == ["", "b"]
+
+
+# ----------------- packed_ordered_map với client giả -----------------
+from types import SimpleNamespace
+
+from page_packing import packed_ordered_map
+
+
+class FakeClient:
+    """models.generate_content giả: trả "trang <nội dung ảnh>" theo nhãn; drop = các nhãn k bỏ khỏi câu trả lời."""
+
+    def __init__(self, drop=(), fail=False):
+        self.drop, self.fail, self.requests = set(drop), fail, []
+        self.models = self
+
+    def generate_content(self, model=None, contents=None):
+        labels = [c for c in contents if isinstance(c, str) and c.startswith("<<<PAGE ")]
+        images = [c["data"].decode() for c in contents if isinstance(c, dict)]
+        self.requests.append(images)
+        if self.fail:
+            raise ValueError("400 bad request")
+        parts = [f"{label}\npage {img}" for k, (label, img) in enumerate(zip(labels, images), start=1)
+                 if k not in self.drop]
+        return SimpleNamespace(text="\n".join(parts), candidates=[])
+
+
+def _run(client, n=5, max_pages=3):
+    singles = []
+
+    def single(item):
+        singles.append(item)
+        return f"single {item}"
+
+    out = list(packed_ordered_map(range(n), encode=lambda i: (str(i).encode(), "image/png"), single=single,
+                                  task="OCR", client=client, max_pages=max_pages, max_inflight=2))
+    return out, singles
+
+
+def test_packed_groups_and_order():
+    client = FakeClient()
+    out, singles = _run(client)
+    assert [r for r, _ in out] == ["page 0", "page 1", "page 2", "page 3", "page 4"]
+    assert client.requests == [["0", "1", "2"], ["3", "4"]] and singles == []
+
+
+def test_missing_label_resends_only_affected_pages():
+    client = FakeClient(drop={3})
+    out, singles = _run(client, n=3)
+    assert [r for r, _ in out] == ["page 0", "single 1", "single 2"]
+    assert singles == [1, 2]
+
+
+def test_failed_packed_request_falls_back_to_single():
+    out, singles = _run(FakeClient(fail=True), n=3)
+    assert [r for r, _ in out] == ["single 0", "single 1", "single 2"]
+    assert sorted(singles) == [0, 1, 2]
+
+
+def test_max_pages_one_disables_packing():
+    client = FakeClient()
+    out, singles = _run(client, n=3, max_pages=1)
+    assert client.requests == [] and singles == [0, 1, 2]
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+pdf_to_text = pytest.importorskip("pdf_to_text")
+
+
+@pytest.fixture
+def fresh_pool(monkeypatch):
+    monkeypatch.setattr(pdf_to_text, "_pool", None)
+    monkeypatch.setattr(pdf_to_text, "_pool_workers", 0)
+    yield
+    with pdf_to_text._pool_lock:
+        if pdf_to_text._pool is not None:
+            pdf_to_text._pool.shutdown(wait=True)
+
+
+def test_growing_pool_does_not_cancel_running_work(fresh_pool):
+    slow = [pdf_to_text._submit(1, time.sleep, 0.3) for _ in range(3)]  # job A: 1 worker, còn việc đang chờ
+    first = pdf_to_text._pool
+    assert pdf_to_text._submit(2, sum, [1, 2]).result(10) == 3          # job B cần pool lớn hơn
+    assert pdf_to_text._pool is not first and pdf_to_text._pool_workers == 2
+    assert [f.result(10) for f in slow] == [None, None, None]           # việc của job A vẫn xong, không bị huỷ
+    assert pdf_to_text._submit(1, sum, [2, 2]).result(10) == 4          # job A gửi tiếp -> pool mới
+    assert pdf_to_text._pool_workers == 2                               # yêu cầu nhỏ hơn dùng lại pool lớn
+
+
+def test_concurrent_callers_share_one_pool(fresh_pool, monkeypatch):
+    created = []
+
+    class CountingPool(pdf_to_text.ProcessPoolExecutor):
+        def __init__(self, *a, **kw):
+            created.append(self)
+            super().__init__(*a, **kw)
+
+    monkeypatch.setattr(pdf_to_text, "ProcessPoolExecutor", CountingPool)
+    with ThreadPoolExecutor(8) as threads:
+        futs = list(threads.map(lambda i: pdf_to_text._submit(2, sum, [i, 1]), range(16)))
+    assert sorted(f.result(10) for f in futs) == list(range(1, 17))
+    assert len(created) == 1 and pdf_to_text._pool_workers == 2
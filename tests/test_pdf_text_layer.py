@@ -0,0 +1,59 @@
+import ctypes
+
+import pytest
+from PIL import Image
+
+pdfium = pytest.importorskip("pypdfium2")
+pdfium_c = pytest.importorskip("pypdfium2.raw")
+pdf_to_text = pytest.importorskip("pdf_to_text")
+
+HEADER = "CONG TY TNHH ABC - BAN SAO Y BAN CHINH - SO 123/2025"
+
+
+def _add_text(pdf, page, text, x, y, size=10):
+    obj = pdfium_c.FPDFPageObj_NewTextObj(pdf, b"Helvetica", ctypes.c_float(size))
+    buf = ctypes.create_string_buffer((text + "\0").encode("utf-16-le"))
+    pdfium_c.FPDFText_SetText(obj, ctypes.cast(buf, ctypes.POINTER(pdfium_c.FPDF_WCHAR)))
+    pdfium_c.FPDFPageObj_Transform(obj, 1, 0, 0, 1, x, y)
+    pdfium_c.FPDFPage_InsertObject(page, obj)
+
+
+def _add_image(pdf, page, x, y, w, h):
+    img = pdfium.PdfImage.new(pdf)
+    img.set_bitmap(pdfium.PdfBitmap.from_pil(Image.new("RGB", (80, 100), (200, 200, 200))))
+    img.set_matrix(pdfium.PdfMatrix().scale(w, h).translate(x, y))
+    page.insert_obj(img)
+
+
+def _pdf(lines, image=False) -> bytes:
+    pdf = pdfium.PdfDocument.new()
+    page = pdf.new_page(595, 842)
+    if image:
+        _add_image(pdf, page, 0, 0, 595, 842)
+    for i, line in enumerate(lines):
+        _add_text(pdf, page.raw, line, 50, 800 - i * 14)
+    page.gen_content()
+    out = []
+
+    class _Buf:
+        def write(self, b):
+            out.append(bytes(b))
+
+    pdf.save(_Buf())
+    return b"".join(out)
+
+
+def test_scanned_page_with_stamped_header_still_needs_ocr():
+    assert pdf_to_text._text_layer_pages(_pdf([HEADER], image=True)) == [None]
+
+
+def test_digital_page_uses_text_layer():
+    lines = [f"Dong {i}: noi dung van ban so xuat tu Word, du dai de tinh la mot trang that." for i in range(50)]
+    pages = pdf_to_text._text_layer_pages(_pdf(lines))
+    assert pages[0] is not None and "Dong 49" in pages[0]
+
+
+def test_header_without_background_image_is_kept():
+    # trang số ngắn (không có ảnh nền) vẫn dùng lớp chữ
+    pages = pdf_to_text._text_layer_pages(_pdf([HEADER]))
+    assert pages[0] is not None and HEADER in pages[0]
@@ -0,0 +1,150 @@
+import threading
+import time
+import wave
+from io import BytesIO
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pydub")
+pytest.importorskip("speech_recognition")
+
+from speech_to_text import _PAD_MS, _plan_chunks, speech_to_text as transcribe
+
+
+# ----------------- _plan_chunks -----------------
+def test_plan_empty():
+    assert _plan_chunks([], 10_000) == []
+
+
+def test_plan_merges_close_ranges_up_to_max():
+    ranges = [(1000, 3000), (3500, 6000), (6500, 9000)]
+    assert _plan_chunks(ranges, 20_000, max_ms=10_000) == [(1000 - _PAD_MS, 9000 + _PAD_MS)]
+
+
+def test_plan_starts_new_chunk_when_max_exceeded():
+    ranges = [(0, 6000), (7000, 12000)]
+    assert _plan_chunks(ranges, 12_000, max_ms=10_000) == [(0, 6000 + _PAD_MS), (7000 - _PAD_MS, 12_000)]
+
+
+def test_plan_pad_clamped_to_audio_bounds():
+    assert _plan_chunks([(50, 900)], 1000, max_ms=10_000) == [(0, 1000)]
+
+
+def test_plan_hard_splits_long_speech():
+    chunks = _plan_chunks([(1000, 26_000)], 30_000, max_ms=10_000)
+    assert chunks == [(800, 10_800), (10_800, 20_800), (20_800, 26_200)]
+    assert all(end - start <= 10_000 for start, end in chunks)
+
+
+def test_plan_chunk_of_exactly_max():
+    assert _plan_chunks([(_PAD_MS, 10_000 - _PAD_MS)], 20_000, max_ms=10_000) == [(0, 10_000)]
+
+
+# ----------------- _transcribe_chunked với recognizer giả -----------------
+RATE = 16000
+
+
+def _wav(bursts_s, pause_s=1.0, lead_s=1.5):
+    """WAV 16 kHz mono: lặng lead_s, rồi các tiếng beep (độ dài bursts_s) cách nhau pause_s, lặng lead_s."""
+    t = np.arange(int(RATE * max(bursts_s))) / RATE
+    tone = (0.3 * 32767 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    silence = lambda s: np.zeros(int(RATE * s), np.int16)
+    parts = [silence(lead_s)]
+    for i, b in enumerate(bursts_s):
+        if i:
+            parts.append(silence(pause_s))
+        parts.append(tone[:int(RATE * b)])
+    parts.append(silence(lead_s))
+    buf = BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(RATE)
+        w.writeframes(np.concatenate(parts).tobytes())
+    return buf.getvalue()
+
+
+class FakeRecognizer:
+    """Trả độ dài đoạn (giây, làm tròn); đoạn ngắn hơn trả chậm hơn để các đoạn xong lệch thứ tự."""
+
+    def __init__(self, fail_on=()):
+        self.fail_on, self.calls = set(fail_on), 0
+        self._lock = threading.Lock()
+
+    def __call__(self, wav_bytes, language):
+        with wave.open(BytesIO(wav_bytes)) as w:
+            assert (w.getnchannels(), w.getframerate()) == (1, RATE)
+            dur = round(w.getnframes() / RATE)
+        with self._lock:
+            self.calls += 1
+        time.sleep(max(0.0, 0.3 - dur / 100))
+        if dur in self.fail_on:
+            raise RuntimeError(f"lỗi đoạn {dur}s")
+        return f"dur{dur}"
+
+
+# 12s / 18s / 14s: 2 đoạn liền nhau luôn > 30s -> mỗi tiếng beep 1 đoạn
+BURSTS = [12, 18, 14]
+
+
+def test_chunks_joined_in_order_with_timestamps():
+    rec = FakeRecognizer()
+    r = transcribe(_wav(BURSTS), lang="Tiếng Việt", chunked=True, recognizer=rec)
+    assert r["success"], r
+    assert rec.calls == 3
+    assert r["text"].splitlines() == ["dur12", "dur18", "dur14"]
+    segs = r["segments"]
+    assert [s["status"] for s in segs] == ["ok", "ok", "ok"]
+    # lặng đầu 1.5s (trừ lề 0.2s); beep 12s; quãng nghỉ 1s
+    expected = [(1.3, 13.7), (14.3, 32.7), (33.3, 47.7)]
+    for s, (start, end) in zip(segs, expected):
+        assert s["start"] == pytest.approx(start, abs=0.05)
+        assert s["end"] == pytest.approx(end, abs=0.05)
+    assert segs[0]["timestamp"] == "00:00:01.3 - 00:00:13.7"
+    assert r["audio_seconds"] == pytest.approx(1.5 * 2 + sum(BURSTS) + 2, abs=0.01)
+    assert "failed_segments" not in r
+
+
+def test_failed_segment_keeps_others():
+    r = transcribe(_wav(BURSTS), chunked=True, recognizer=FakeRecognizer(fail_on={18}))
+    assert r["success"]
+    assert r["text"].splitlines() == ["dur12", "dur14"]
+    assert r["failed_segments"] == [1]
+    assert r["segments"][1]["status"] == "error" and "lỗi đoạn 18s" in r["segments"][1]["error"]
+
+
+def test_all_segments_failed():
+    r = transcribe(_wav([12, 18]), chunked=True, recognizer=FakeRecognizer(fail_on={12, 18}))
+    assert not r["success"]
+    assert "lỗi đoạn 12s" in r["message"]
+
+
+def test_silence_only():
+    buf = BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(RATE)
+        w.writeframes(np.zeros(RATE * 3, np.int16).tobytes())
+    rec = FakeRecognizer()
+    r = transcribe(buf.getvalue(), chunked=True, recognizer=rec)
+    assert not r["success"] and rec.calls == 0
+
+
+def test_uploaded_file_object_is_streamed():
+    import audio_ingest
+
+    wav = _wav([12, 18])
+    f = BytesIO(wav)
+    f.seek(7)  # vị trí đọc bất kỳ: speech_to_text đọc lại từ đầu
+    r = transcribe(uploaded_file=f, chunked=True, recognizer=FakeRecognizer())
+    assert r["success"] and r["text"].splitlines() == ["dur12", "dur18"]
+    f.seek(0)
+    assert audio_ingest.to_wav(f) == wav
+    assert bytes(audio_ingest.decode_pcm(BytesIO(wav))) == bytes(audio_ingest.decode_pcm(wav))
+
+
+def test_empty_uploaded_file():
+    r = transcribe(uploaded_file=BytesIO(b""), chunked=True, recognizer=FakeRecognizer())
+    assert not r["success"] and "rỗng" in r["message"]
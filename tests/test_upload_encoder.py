@@ -0,0 +1,41 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import upload_encoder
+
+
+def _noisy_png(side: int) -> bytes:
+    rng = np.random.default_rng(0)
+    buf = BytesIO()
+    Image.fromarray(rng.integers(0, 256, (side, side, 3), dtype=np.uint8)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _count_encodes(monkeypatch):
+    calls = []
+    save = upload_encoder._save
+
+    def _counting(im, fmt, quality):
+        calls.append((im.size, fmt, quality))
+        return save(im, fmt, quality)
+
+    monkeypatch.setattr(upload_encoder, "_save", _counting)
+    return calls
+
+
+def test_oversized_image_is_bounded_and_fits_budget(monkeypatch):
+    calls = _count_encodes(monkeypatch)
+    budget = 300 * 1024
+    data, mime = upload_encoder.encode_for_upload(_noisy_png(2400), budget=budget, max_side=2400)
+    assert len(calls) <= upload_encoder.MAX_ENCODES
+    assert len(data) <= budget or max(calls[-1][0]) == upload_encoder.MIN_SIDE
+    assert Image.open(BytesIO(data)).format == mime.split("/")[1].upper()
+
+
+def test_image_that_fits_at_top_quality_is_encoded_once_per_format(monkeypatch):
+    calls = _count_encodes(monkeypatch)
+    flat = Image.new("RGB", (2000, 1500), (255, 255, 255))
+    upload_encoder.encode_for_upload(flat, budget=500 * 1024)
+    assert calls == [((2000, 1500), "JPEG", upload_encoder._QUALITIES[0])]
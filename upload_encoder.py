@@ -0,0 +1,156 @@
+# upload_encoder.py — Nén ảnh trước khi gửi Gemini (dùng chung cho mọi module)
+# - Ảnh JPEG đầu vào: dùng draft mode của PIL (giải mã thẳng ở 1/2, 1/4, 1/8 kích thước) -> thu nhỏ gần như miễn phí
+# - Nhắm theo ngân sách byte (GEMINI_UPLOAD_BUDGET_KB) thay vì cạnh dài cố định:
+#   giữ chất lượng cao nhất còn vừa ngân sách, thử WebP trước khi hạ chất lượng, cuối cùng mới thu nhỏ
+#   (kích thước thu nhỏ ước lượng từ số byte đã mã hoá; tổng số lần mã hoá có giới hạn)
+# - Ảnh gần như không màu (tài liệu, scan) -> mã hoá 1 kênh xám
+# - Ảnh đã đủ nhỏ (và không cần xoay theo EXIF) -> gửi nguyên bytes, không giải mã
+# - Ảnh có EXIF orientation (chụp điện thoại) -> xoay đúng chiều trước khi mã hoá lại
+# - Ghi nhận số byte vào/ra (metrics + stats())
+from io import BytesIO
+from typing import Dict, Optional, Tuple, Union
+import math
+import os
+import threading
+
+from PIL import Image, ImageChops, ImageOps, ImageStat, features
+
+import metrics
+
+# Tăng khi đổi cách mã hoá để cache kết quả Gemini cũ không còn khớp
+VERSION = "3"
+
+BUDGET_BYTES = int(float(os.getenv("GEMINI_UPLOAD_BUDGET_KB", "500")) * 1024)
+MAX_SIDE = int(os.getenv("GEMINI_UPLOAD_MAX_SIDE", "2400"))
+# Không thu nhỏ dưới mức này khi cố ép vào ngân sách (chữ nhỏ sẽ không đọc được)
+MIN_SIDE = int(os.getenv("GEMINI_UPLOAD_MIN_SIDE", "1200"))
+_QUALITIES = (85, 75, 65)
+# Số lần mã hoá tối đa cho 1 ảnh (mỗi lần là 1 lượt nén cả ảnh)
+MAX_ENCODES = int(os.getenv("GEMINI_UPLOAD_MAX_ENCODES", "6"))
+# Ước lượng thô: số byte ở chất lượng thấp nhất / cao nhất. Cần giảm nhiều hơn -> bỏ qua mức giữa
+_QUALITY_GAIN = 0.45
+_USE_WEBP = os.getenv("GEMINI_UPLOAD_WEBP", "1") != "0" and features.check("webp")
+# Độ lệch trung bình giữa các kênh màu (0-255) dưới mức này -> coi là ảnh xám
+_GRAY_TOLERANCE = float(os.getenv("GEMINI_UPLOAD_GRAY_TOL", "6"))
+
+_ORIENTATION = 0x0112  # thẻ EXIF Orientation
+_PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+_lock = threading.Lock()
+_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "passthrough": 0, "gray": 0, "webp": 0, "downscaled": 0}
+
+
+def stats() -> Dict[str, int]:
+    """Số liệu cộng dồn trong process. bytes_in: kích thước file gốc (ảnh PIL: số byte pixel thô)."""
+    with _lock:
+        out = dict(_stats)
+    out["bytes_saved"] = out["bytes_in"] - out["bytes_out"]
+    return out
+
+
+def _record(n_in: int, n_out: int, **flags) -> None:
+    with _lock:
+        _stats["images"] += 1
+        _stats["bytes_in"] += n_in
+        _stats["bytes_out"] += n_out
+        for k, v in flags.items():
+            _stats[k] += int(bool(v))
+    metrics.incr("gemini_upload_bytes_in_total", n_in)
+    metrics.incr("gemini_upload_bytes_out_total", n_out)
+
+
+def _is_grayish(im: Image.Image) -> bool:
+    if im.mode in ("1", "L", "LA", "I", "I;16", "F"):
+        return True
+    small = im.convert("RGB").resize((64, 64), Image.BILINEAR)
+    r, g, b = small.split()
+    diff = ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b))
+    return ImageStat.Stat(diff).mean[0] < _GRAY_TOLERANCE
+
+
+def _save(im: Image.Image, fmt: str, quality: int) -> bytes:
+    buf = BytesIO()
+    if fmt == "WEBP":
+        im.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        im.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _fit(im: Image.Image, max_side: int) -> Image.Image:
+    w, h = im.size
+    if max(w, h) <= max_side:
+        return im
+    s = max_side / max(w, h)
+    # reducing_gap: thu nhỏ nhanh bằng reduce() trước, LANCZOS chỉ cho bước cuối
+    return im.resize((max(1, round(w * s)), max(1, round(h * s))), Image.LANCZOS, reducing_gap=2.0)
+
+
+@metrics.timed("gemini.encode_upload")
+def encode_for_upload(image: Union[bytes, Image.Image], budget: Optional[int] = None,
+                      max_side: int = MAX_SIDE) -> Tuple[bytes, str]:
+    """
+    Ảnh (bytes hoặc PIL) -> (bytes, mime) gọn nhất còn giữ chữ đọc được, để gửi Gemini.
+    budget: ngân sách byte (None = GEMINI_UPLOAD_BUDGET_KB).
+    """
+    budget = BUDGET_BYTES if budget is None else budget
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        data = bytes(image)
+        im = Image.open(BytesIO(data))  # chỉ đọc header
+        n_in = len(data)
+        upright = im.getexif().get(_ORIENTATION, 1) == 1
+        if im.format in _PASSTHROUGH_FORMATS and upright and n_in <= budget and max(im.size) <= max_side:
+            _record(n_in, n_in, passthrough=True)
+            return data, _PASSTHROUGH_FORMATS[im.format]
+        if im.format == "JPEG":
+            # giải mã DCT ở tỉ lệ nhỏ nhất vẫn >= kích thước cần
+            s = min(1.0, max_side / max(im.size))
+            im.draft(None, (max(1, int(im.size[0] * s)), max(1, int(im.size[1] * s))))
+        if not upright:
+            im = ImageOps.exif_transpose(im)
+    else:
+        im = image
+        n_in = im.width * im.height * len(im.getbands())
+
+    gray = _is_grayish(im)
+    im = im.convert("L" if gray else "RGB")
+    im = _fit(im, max_side)
+
+    formats = ("JPEG", "WEBP") if _USE_WEBP else ("JPEG",)
+    state = {"smallest": None, "encodes": 0}
+
+    def _try(fmt: str, q: int):
+        cand = (_save(im, fmt, q), f"image/{fmt.lower()}")
+        state["encodes"] += 1
+        if state["smallest"] is None or len(cand[0]) < len(state["smallest"][0]):
+            state["smallest"] = cand
+        return cand if len(cand[0]) <= budget else None
+
+    # 1) chất lượng cao nhất, mọi định dạng -> biết định dạng nào gọn hơn với ảnh này
+    best = next((c for c in (_try(f, _QUALITIES[0]) for f in formats) if c), None)
+    fmt = "WEBP" if state["smallest"][1] == "image/webp" else "JPEG"
+    # 2) hạ chất lượng với định dạng đó; chắc chắn không vừa thì nhảy thẳng xuống mức thấp nhất
+    if best is None:
+        hopeless = len(state["smallest"][0]) * _QUALITY_GAIN > budget
+        for q in _QUALITIES[-1:] if hopeless else _QUALITIES[1:]:
+            best = _try(fmt, q)
+            if best is not None:
+                break
+    # 3) thu nhỏ theo ước lượng số byte ~ cạnh^k (ở chất lượng thấp nhất): lần đầu k = 2 (tỉ lệ số pixel),
+    #    các lần sau k đo từ 2 lần mã hoá gần nhất (ảnh mờ thu nhỏ thì "đặc" chi tiết hơn, k < 2)
+    downscaled = False
+    k, prev = 2.0, None
+    last = (max(im.size), len(state["smallest"][0]))
+    while best is None and max(im.size) > MIN_SIDE and state["encodes"] < MAX_ENCODES:
+        if prev is not None and last[1] < prev[1]:
+            k = min(2.0, max(0.5, math.log(prev[1] / last[1]) / math.log(prev[0] / last[0])))
+        target = int(last[0] * min(0.9, (0.95 * budget / last[1]) ** (1 / k)))
+        im = _fit(im, max(MIN_SIDE, target))
+        downscaled = True
+        best = _try(fmt, _QUALITIES[-1])
+        prev, last = last, (max(im.size), len(state["smallest"][0]))
+    if best is None:
+        best = state["smallest"]  # không thể vừa ngân sách: dùng bản nhỏ nhất đã thử
+
+    _record(n_in, len(best[0]), gray=gray, webp=best[1] == "image/webp", downscaled=downscaled)
+    return best